@@ -0,0 +1,59 @@
+'''
+Politecnico di Milano.
+_common.pxd
+
+Description: This file contains the inline helpers shared by the Cython
+             kernels: the number of OpenMP threads to use and the bounded
+             min-heap used to select the best k elements of a row.
+'''
+
+cimport cython
+cimport openmp
+
+
+cdef inline int _check_num_threads(object num_threads) except -1:
+    # Returns the number of threads to use, all the available ones if
+    # `num_threads` is None or not positive.
+    if num_threads is None or num_threads < 1:
+        return openmp.omp_get_max_threads()
+    return num_threads
+
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline void _heap_sift_down(float *heap_val, int *heap_idx, int size, int pos) nogil:
+    # restore the min-heap property from `pos` downwards
+    cdef int child, smallest
+    cdef float tmp_val
+    cdef int tmp_idx
+    while True:
+        smallest = pos
+        child = 2 * pos + 1
+        if child < size and heap_val[child] < heap_val[smallest]:
+            smallest = child
+        child += 1
+        if child < size and heap_val[child] < heap_val[smallest]:
+            smallest = child
+        if smallest == pos:
+            return
+        tmp_val, tmp_idx = heap_val[pos], heap_idx[pos]
+        heap_val[pos], heap_idx[pos] = heap_val[smallest], heap_idx[smallest]
+        heap_val[smallest], heap_idx[smallest] = tmp_val, tmp_idx
+        pos = smallest
+
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline void _heap_sift_up(float *heap_val, int *heap_idx, int pos) nogil:
+    # restore the min-heap property from `pos` upwards
+    cdef int parent
+    cdef float tmp_val
+    cdef int tmp_idx
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if heap_val[parent] <= heap_val[pos]:
+            return
+        tmp_val, tmp_idx = heap_val[pos], heap_idx[pos]
+        heap_val[pos], heap_idx[pos] = heap_val[parent], heap_idx[parent]
+        heap_val[parent], heap_idx[parent] = tmp_val, tmp_idx
+        pos = parent
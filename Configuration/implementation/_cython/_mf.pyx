@@ -3,7 +3,7 @@ Politecnico di Milano.
 _mf.py
 
 Description: This file contains the Cython implementation of some recommender
-             algorithms as: FunkSVD, BPR-MF, AsymSVD.
+             algorithms as: FunkSVD, BPR-MF, AsymSVD, IALS.
 
 Created by: Massimo Quadrana.
 Modified by Fernando Pérez.
@@ -18,10 +18,25 @@ cimport numpy as np
 import numpy as np
 import scipy.sparse as sps
 
+from libc.math cimport sqrt
+from cython.parallel cimport prange, threadid
+from scipy.linalg.cython_lapack cimport dposv
+from implementation._cython._common cimport _check_num_threads
+
 import sys
 
+def _init_factors(F_init, n_rows, num_factors, init_mean, init_std):
+    # Draws the latent factors from a Normal distribution. If initial factors
+    # are given, they are copied instead, so the caller's array is not modified.
+    if F_init is None:
+        return np.random.normal(init_mean, init_std, (n_rows, num_factors)).astype(np.float32)
+    if F_init.shape != (n_rows, num_factors):
+        raise ValueError('The initial factors must have shape {}, got {}'.format((n_rows, num_factors), F_init.shape))
+    return np.array(F_init, dtype=np.float32)
+
 @cython.boundscheck(False)
-def FunkSVD_sgd(R, num_factors=50, lrate=0.01, reg=0.015, iters=10, init_mean=0.0, init_std=0.1, lrate_decay=1.0, rnd_seed=42):
+@cython.wraparound(False)
+def FunkSVD_sgd(R, num_factors=50, lrate=0.01, reg=0.015, iters=10, init_mean=0.0, init_std=0.1, lrate_decay=1.0, rnd_seed=42, U_init=None, V_init=None, n_threads=1, callback=None):
     if not isinstance(R, sps.csr_matrix):
         raise ValueError('R must be an instance of scipy.sparse.csr_matrix')
 
@@ -30,64 +45,78 @@ def FunkSVD_sgd(R, num_factors=50, lrate=0.01, reg=0.015, iters=10, init_mean=0.
     cdef float [:] data = R.data
     cdef int M = R.shape[0], N = R.shape[1]
     cdef int nnz = len(R.data)
+    cdef int n_factors = num_factors, threads = _check_num_threads(n_threads)
 
     # in csr format, indices correspond to column indices
     # let's build the vector of row_indices
-    cdef np.ndarray[np.int64_t, ndim=1] row_nnz = np.diff(indptr).astype(np.int64)
-    cdef np.ndarray[np.int64_t, ndim=1] row_indices = np.repeat(np.arange(M), row_nnz).astype(np.int64)
+    cdef int [:] row_indices = np.repeat(np.arange(M, dtype=np.int32), np.diff(indptr))
 
     # set the seed of the random number generator
     np.random.seed(rnd_seed)
 
-    # randomly initialize the user and item latent factors
-    cdef np.ndarray[np.float32_t, ndim=2] U = np.random.normal(init_mean, init_std, (M, num_factors)).astype(np.float32)
-    cdef np.ndarray[np.float32_t, ndim=2] V = np.random.normal(init_mean, init_std, (N, num_factors)).astype(np.float32)
+    # randomly initialize the user and item latent factors, unless the initial
+    # factors are given (warm start)
+    U = _init_factors(U_init, M, num_factors, init_mean, init_std)
+    V = _init_factors(V_init, N, num_factors, init_mean, init_std)
+    cdef float [:, ::1] U_v = U, V_v = V
 
     # build random index to iterate over the non-zero elements in R
-    cdef np.ndarray[np.int64_t, ndim=1] shuffled_idx = np.random.permutation(nnz).astype(np.int64)
+    cdef int [:] shuffled_idx = np.random.permutation(nnz).astype(np.int32)
 
     # here we define some auxiliary variables
-    cdef int i, j, idx, it, n
-    cdef float rij, rij_pred, err, loss
-    cdef np.ndarray[np.float32_t, ndim=1] U_i = np.zeros(num_factors, dtype=np.float32)
-    cdef np.ndarray[np.float32_t, ndim=1] V_j = np.zeros(num_factors, dtype=np.float32)
+    cdef int i, j, f, idx, it, n
+    cdef float rij, rij_pred, err, u_if, v_jf
+    cdef float lr, c_reg = reg
+    cdef double loss
 
     #
     # Stochastic Gradient Descent starts here
+    # the non-zero values are split in contiguous shards of the shuffled
+    # index, one for each thread, and the threads update the shared latent
+    # factors without locks (Hogwild!)
     #
     for it in range(iters):     # for each iteration
         loss = 0.0
-        for n in range(nnz):    # iterate over non-zero values in R only
+        lr = lrate
+        for n in prange(nnz, nogil=True, schedule='static', num_threads=threads):
             idx = shuffled_idx[n]
             rij = data[idx]
-            # get the row and col indices of x_ij
+            # get the row and col indices of x_ij
             i = row_indices[idx]
             j = col_indices[idx]
-            U_i = U[i].copy()
-            V_j = V[j].copy()
 
             # compute the predicted value of R
-            rij_pred = np.dot(U_i, V_j)
+            rij_pred = 0.0
+            for f in range(n_factors):
+                rij_pred = rij_pred + U_v[i, f] * V_v[j, f]
 
             # compute the prediction error
             err = rij - rij_pred
 
             # update the loss
-            loss += err**2
+            loss += err * err
 
-            # adjust the latent factors
-            U[i] += lrate * (err * V_j - reg * U_i)
-            V[j] += lrate * (err * U_i - reg * V_j)
+            # adjust the latent factors, using the values before the update
+            for f in range(n_factors):
+                u_if = U_v[i, f]
+                v_jf = V_v[j, f]
+                U_v[i, f] = u_if + lr * (err * v_jf - c_reg * u_if)
+                V_v[j, f] = v_jf + lr * (err * u_if - c_reg * v_jf)
 
         loss /= nnz
         print('Iter {} - loss: {:.4f}'.format(it+1, loss))
+        # the callback receives the epoch, the loss and the current factors,
+        # and stops the training by returning True
+        if callback is not None and callback(it, loss, U, V):
+            break
         # update the learning rate
         lrate *= lrate_decay
 
     return U, V
 
 @cython.boundscheck(False)
-def AsySVD_sgd(R, num_factors=50, lrate=0.01, reg=0.015, iters=10, init_mean=0.0, init_std=0.1, lrate_decay=1.0, rnd_seed=42):
+@cython.wraparound(False)
+def AsySVD_sgd(R, num_factors=50, lrate=0.01, reg=0.015, iters=10, init_mean=0.0, init_std=0.1, lrate_decay=1.0, rnd_seed=42, X_init=None, Y_init=None, n_threads=1, callback=None):
     if not isinstance(R, sps.csr_matrix):
         raise ValueError('R must be an instance of scipy.sparse.csr_matrix')
 
@@ -96,104 +125,256 @@ def AsySVD_sgd(R, num_factors=50, lrate=0.01, reg=0.015, iters=10, init_mean=0.0
     cdef float [:] data = R.data
     cdef int M = R.shape[0], N = R.shape[1]
     cdef int nnz = len(R.data)
-
-    # in csr format, indices correspond to column indices
-    # let's build the vector of row_indices
-    cdef np.ndarray[np.int64_t, ndim=1] row_nnz = np.diff(indptr).astype(np.int64)
-    cdef np.ndarray[np.int64_t, ndim=1] row_indices = np.repeat(np.arange(M), row_nnz).astype(np.int64)
+    cdef int n_factors = num_factors, threads = _check_num_threads(n_threads)
 
     # set the seed of the random number generator
     np.random.seed(rnd_seed)
 
-    # randomly initialize the item latent factors
-    cdef np.ndarray[np.float32_t, ndim=2] X = np.random.normal(init_mean, init_std, (N, num_factors)).astype(np.float32)
-    cdef np.ndarray[np.float32_t, ndim=2] Y = np.random.normal(init_mean, init_std, (N, num_factors)).astype(np.float32)
-
-    # build random index to iterate over the non-zero elements in R
-    cdef np.ndarray[np.int64_t, ndim=1] shuffled_idx = np.random.permutation(nnz).astype(np.int64)
-
-    # here we define some auxiliary variables
-    cdef int i, j, it, n, idx, n_rated, start, end
-    cdef float rij, rij_pred, err, loss
-    cdef np.ndarray[np.float32_t, ndim=1] X_j = np.zeros(num_factors, dtype=np.float32)
-    cdef np.ndarray[np.float32_t, ndim=1] Y_acc = np.zeros(num_factors, dtype=np.float32)
-    cdef np.ndarray[np.float32_t, ndim=2] Y_copy = np.zeros_like(Y, dtype=np.float32)
+    # randomly initialize the item latent factors, unless the initial factors
+    # are given (warm start)
+    X = _init_factors(X_init, N, num_factors, init_mean, init_std)
+    Y = _init_factors(Y_init, N, num_factors, init_mean, init_std)
+    cdef float [:, ::1] X_v = X, Y_v = Y
+
+    # build random index to iterate over the users with at least one rating
+    cdef int [:] shuffled_users = np.random.permutation(np.flatnonzero(np.diff(indptr))).astype(np.int32)
+    cdef int n_users = len(shuffled_users)
+
+    # here we define some auxiliary variables, the accumulated user profile
+    # and the gradient of its items factors are private to each thread
+    cdef int i, j, l, f, it, n, tid, n_rated, pos
+    cdef float rij, rij_pred, err, norm, x_jf, decay
+    cdef float lr, c_reg = reg
+    cdef double loss
+    cdef float [:, ::1] Y_acc = np.zeros((threads, num_factors), dtype=np.float32)
+    cdef float [:, ::1] Y_grad = np.zeros((threads, num_factors), dtype=np.float32)
 
     #
     # Stochastic Gradient Descent starts here
+    # the users are split among the threads, which update the shared latent
+    # factors without locks (Hogwild!). The profile of each user is
+    # accumulated once per epoch, then the ratings of the user update the
+    # item factors in X, and finally the factors in Y of the items rated by
+    # the user are updated at once with the gradients of all the ratings.
     #
     for it in range(iters):     # for each iteration
         loss = 0.0
-        for n in range(nnz):    # iterate over non-zero values in R only
-            idx = shuffled_idx[n]
-            rij = data[idx]
-            # get the row and col indices of x_ij
-            i = row_indices[idx]
-            j = col_indices[idx]
-            # get the latent factor of item j
-            X_j = X[j].copy()
-            # accumulate the item latent factors over the other items rated by i
-            Y_acc = np.zeros(num_factors, dtype=np.float32)
-            n_rated = 0
-            start, end = indptr[i], indptr[i+1]
-            for l in col_indices[start:end]:
-                x_il = data[start + n_rated]
-                Y_acc += x_il * Y[l]
-                n_rated += 1
-            if n_rated > 0:
-                Y_acc /= np.sqrt(n_rated)
-            # compute the predicted rating
-            rij_pred = np.dot(X_j, Y_acc)
-            # compute the prediction error
-            err = rij - rij_pred
-            # update the loss
-            loss += err**2
-            # adjust the latent factors
-            X[j] += lrate * (err * Y_acc - reg * X_j)
-            # copy the current item preference factors
-            Y_copy = Y.copy()
-            for l in col_indices[indptr[i]:indptr[i+1]]:
-                Y_l = Y_copy[l]
-                Y[l] += lrate * (err * X_j - reg * Y_l)
+        lr = lrate
+        for n in prange(n_users, nogil=True, schedule='dynamic', num_threads=threads):
+            tid = threadid()
+            i = shuffled_users[n]
+            # accumulate the item latent factors over the items rated by i
+            n_rated = indptr[i+1] - indptr[i]
+            norm = sqrt(<float> n_rated)
+            for f in range(n_factors):
+                Y_acc[tid, f] = 0.0
+                Y_grad[tid, f] = 0.0
+            for pos in range(indptr[i], indptr[i+1]):
+                l = col_indices[pos]
+                for f in range(n_factors):
+                    Y_acc[tid, f] = Y_acc[tid, f] + data[pos] * Y_v[l, f]
+            for f in range(n_factors):
+                Y_acc[tid, f] = Y_acc[tid, f] / norm
+
+            for pos in range(indptr[i], indptr[i+1]):
+                rij = data[pos]
+                j = col_indices[pos]
+                # compute the predicted rating
+                rij_pred = 0.0
+                for f in range(n_factors):
+                    rij_pred = rij_pred + X_v[j, f] * Y_acc[tid, f]
+                # compute the prediction error
+                err = rij - rij_pred
+                # update the loss
+                loss += err * err
+                # adjust the latent factors of item j and accumulate the
+                # gradient of the factors in Y
+                for f in range(n_factors):
+                    x_jf = X_v[j, f]
+                    Y_grad[tid, f] = Y_grad[tid, f] + err * x_jf
+                    X_v[j, f] = x_jf + lr * (err * Y_acc[tid, f] - c_reg * x_jf)
+
+            # the regularization is compounded as in n_rated separate updates
+            decay = (1.0 - lr * c_reg) ** n_rated
+            for pos in range(indptr[i], indptr[i+1]):
+                l = col_indices[pos]
+                for f in range(n_factors):
+                    Y_v[l, f] = decay * Y_v[l, f] + lr * Y_grad[tid, f]
 
         loss /= nnz
         print('Iter {} - loss: {:.4f}'.format(it+1, loss))
+        # the callback receives the epoch, the loss and the current factors,
+        # and stops the training by returning True
+        if callback is not None and callback(it, loss, X, Y):
+            break
         # update the learning rate
         lrate *= lrate_decay
 
     return X, Y
 
-@cython.boundscheck(False)
 def AsySVD_compute_user_factors(user_profile, Y):
+    """
+    Computes the user factors of AsySVD for one or more users at once, as the
+    sparse product between their profiles and Y, where each row is divided by
+    the square root of the number of items rated by the user.
+    :param user_profile: instance of scipy.sparse.csr_matrix, one row for each
+        user
+    :param Y: the item factors
+    :return: the factors of the users, a vector if user_profile has one row
+    """
     if not isinstance(user_profile, sps.csr_matrix):
         raise ValueError('user_profile must be an instance of scipy.sparse.csr_matrix')
-    assert user_profile.shape[0] == 1, 'user_profile must be a 1-dimensional vector'
-
-    # use Cython MemoryViews for fast access to the sparse structure of user_profile
-    cdef int [:] col_indices = user_profile.indices
-    cdef float [:] data = user_profile.data
-
-    # intialize the accumulated user profile
-    cdef int num_factors = Y.shape[1]
-    cdef np.ndarray[np.float32_t, ndim=1] Y_acc = np.zeros(num_factors, dtype=np.float32)
-    cdef int n_rated = len(col_indices)
-    # aux variables
-    cdef int n
-    # accumulate the item vectors for the items rated by the user
-    for n in range(n_rated):
-        ril = data[n]
-        Y_acc += ril * Y[col_indices[n]]
-    if n_rated > 0:
-        Y_acc /= np.sqrt(n_rated)
-    return Y_acc
+    n_rated = np.diff(user_profile.indptr)
+    norm = 1.0 / np.sqrt(np.maximum(n_rated, 1))
+    U = np.asarray(sps.diags(norm).dot(user_profile).dot(Y), dtype=np.float32)
+    if user_profile.shape[0] == 1:
+        return U[0]
+    return U
+
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline double _ddot(double *a, double *b, int n) nogil:
+    cdef int f
+    cdef double out = 0.0
+    for f in range(n):
+        out += a[f] * b[f]
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def IALS_least_squares(C, X, Y, double reg, solver='cholesky', int cg_steps=3, n_threads=1):
+    """
+    Solves, for each row i of X, the regularized least-squares problem of IALS
+    (Y^T C_i Y + reg I) x_i = Y^T C_i p_i, where C_i holds the confidences of
+    the row and p_i is one on its non-zero values. X is updated in place.
+    Y^T (C_i - I) Y is accumulated directly from the non-zero values of the
+    row, added to the precomputed Y^T Y, and the rows are distributed among
+    the threads. The rows whose system is not positive definite, for which the
+    Cholesky factorization fails, are solved again with numpy.linalg.solve.
+    :param C: instance of scipy.sparse.csr_matrix with the confidences, one row
+        for each row of X
+    :param X: C-contiguous float64 array with the factors to solve for
+    :param Y: C-contiguous float64 array with the fixed factors
+    :param reg: regularization term
+    :param solver: 'cholesky' to solve each system exactly (LAPACK dposv) or
+        'cg' to run `cg_steps` conjugate-gradient steps starting from the
+        current x_i, without building the factors x factors system
+    :param cg_steps: number of conjugate-gradient steps
+    :param n_threads: number of threads among which the rows are distributed,
+        all the available ones if None
+    :return: X
+    """
+    if not isinstance(C, sps.csr_matrix):
+        raise ValueError('C must be an instance of scipy.sparse.csr_matrix')
+    if solver not in ('cholesky', 'cg'):
+        raise ValueError('Unsupported solver: {}'.format(solver))
+
+    cdef int [:] indices = C.indices, indptr = C.indptr
+    cdef double [:] conf = C.data.astype(np.float64)
+    cdef double [:, ::1] X_v = X, Y_v = Y
+    cdef int rows = X.shape[0], n_factors = X.shape[1]
+    cdef int threads = _check_num_threads(n_threads)
+    cdef bint use_cg = solver == 'cg'
+
+    # precompute YtY + reg * I
+    cdef double [:, ::1] YtY = np.dot(Y.T, Y) + reg * np.eye(n_factors)
+
+    # per-thread scratch
+    cdef double [:, :, ::1] A = np.zeros((threads, n_factors, n_factors), dtype=np.float64)
+    cdef double [:, ::1] b = np.zeros((threads, n_factors), dtype=np.float64)
+    cdef double [:, ::1] p = np.zeros((threads, n_factors), dtype=np.float64)
+    cdef double [:, ::1] Ap = np.zeros((threads, n_factors), dtype=np.float64)
+    failed = np.zeros(rows, dtype=np.int8)
+    cdef char [:] failed_v = failed
+
+    cdef int i, pos, j, f, g, step, tid, info, one = 1, n_failed = 0
+    cdef double c, coef, alpha, rs_old, rs_new
+    cdef double *x
+    cdef double *y
+    cdef double *r
+    # A is symmetric, so its upper triangle in row-major order is the lower
+    # one in the column-major order expected by LAPACK
+    cdef char *uplo = 'L'
+
+    for i in prange(rows, nogil=True, schedule='dynamic', num_threads=threads):
+        tid = threadid()
+        x = &X_v[i, 0]
+        if use_cg:
+            # r = Y^T C_i p_i - (Y^T C_i Y + reg I) x_i, in b
+            r = &b[tid, 0]
+            for f in range(n_factors):
+                r[f] = -_ddot(&YtY[f, 0], x, n_factors)
+            for pos in range(indptr[i], indptr[i+1]):
+                j = indices[pos]
+                c = conf[pos]
+                y = &Y_v[j, 0]
+                coef = c - (c - 1.0) * _ddot(y, x, n_factors)
+                for f in range(n_factors):
+                    r[f] = r[f] + coef * y[f]
+            for f in range(n_factors):
+                p[tid, f] = r[f]
+            rs_old = _ddot(r, r, n_factors)
+            for step in range(cg_steps):
+                if rs_old < 1e-20:
+                    break
+                # Ap = (Y^T C_i Y + reg I) p
+                for f in range(n_factors):
+                    Ap[tid, f] = _ddot(&YtY[f, 0], &p[tid, 0], n_factors)
+                for pos in range(indptr[i], indptr[i+1]):
+                    y = &Y_v[indices[pos], 0]
+                    coef = (conf[pos] - 1.0) * _ddot(y, &p[tid, 0], n_factors)
+                    for f in range(n_factors):
+                        Ap[tid, f] = Ap[tid, f] + coef * y[f]
+                alpha = rs_old / _ddot(&p[tid, 0], &Ap[tid, 0], n_factors)
+                for f in range(n_factors):
+                    x[f] = x[f] + alpha * p[tid, f]
+                    r[f] = r[f] - alpha * Ap[tid, f]
+                rs_new = _ddot(r, r, n_factors)
+                for f in range(n_factors):
+                    p[tid, f] = r[f] + rs_new / rs_old * p[tid, f]
+                rs_old = rs_new
+        else:
+            # accumulate YtY + Yt(Ci - I)Y + reg I in A and YtCip(i) in b
+            for f in range(n_factors):
+                b[tid, f] = 0.0
+                for g in range(n_factors):
+                    A[tid, f, g] = YtY[f, g]
+            for pos in range(indptr[i], indptr[i+1]):
+                c = conf[pos]
+                y = &Y_v[indices[pos], 0]
+                for f in range(n_factors):
+                    coef = (c - 1.0) * y[f]
+                    for g in range(f, n_factors):
+                        A[tid, f, g] = A[tid, f, g] + coef * y[g]
+                    b[tid, f] = b[tid, f] + c * y[f]
+            dposv(uplo, &n_factors, &one, &A[tid, 0, 0], &n_factors, &b[tid, 0], &n_factors, &info)
+            if info != 0:
+                # b holds a partial factorization, x_i is left unchanged
+                failed_v[i] = 1
+                n_failed += 1
+            else:
+                for f in range(n_factors):
+                    x[f] = b[tid, f]
+
+    if n_failed > 0:
+        YtY_np = np.asarray(YtY)
+        for row in np.flatnonzero(failed):
+            J = C.indices[C.indptr[row]:C.indptr[row+1]]
+            c_row = np.asarray(conf[C.indptr[row]:C.indptr[row+1]])
+            YJ = Y[J]
+            X[row] = np.linalg.solve(YtY_np + np.dot(YJ.T * (c_row - 1.0), YJ), np.dot(c_row, YJ))
+    return X
 
 
 from libc.math cimport exp, log
 
 @cython.boundscheck(False)
+@cython.wraparound(False)
 def BPRMF_sgd(R, num_factors=50, lrate=0.01, user_reg=0.015, pos_reg=0.015, neg_reg=0.0015, iters=10,
               sampling_type='user_uniform_item_uniform',sample_with_replacement=True, use_resampling=False, sampling_pop_alpha=1.0,
-     init_mean=0.0, init_std=0.1, lrate_decay=1.0, rnd_seed=42,verbose=False):
+     init_mean=0.0, init_std=0.1, lrate_decay=1.0, rnd_seed=42,verbose=False, X_init=None, Y_init=None, n_threads=1, callback=None):
     if not isinstance(R, sps.csr_matrix):
         raise ValueError('R must be an instance of scipy.sparse.csr_matrix')
 
@@ -202,175 +383,277 @@ def BPRMF_sgd(R, num_factors=50, lrate=0.01, user_reg=0.015, pos_reg=0.015, neg_
     cdef float [:] data = R.data
     cdef int M = R.shape[0], N = R.shape[1]
     cdef int nnz = len(R.data)
+    cdef int n_factors = num_factors, threads = _check_num_threads(n_threads)
 
     # set the seed of the random number generator
     np.random.seed(rnd_seed)
-    # randomly initialize the user and item latent factors
-    cdef np.ndarray[np.float32_t, ndim=2] X = np.random.normal(init_mean, init_std, (M, num_factors)).astype(np.float32)
-    cdef np.ndarray[np.float32_t, ndim=2] Y = np.random.normal(init_mean, init_std, (N, num_factors)).astype(np.float32)
-
-    # sample the training triples
-    cdef np.ndarray[np.int64_t, ndim=2] sample
-    if sampling_type == 'user_uniform_item_uniform':
-        sample = user_uniform_item_uniform_sampling(R, nnz, replace=sample_with_replacement, seed=rnd_seed, verbose=verbose)
-    elif sampling_type == 'user_uniform_item_pop':
-        sample = user_uniform_item_pop_sampling(R, nnz, alpha=sampling_pop_alpha, seed=rnd_seed, verbose=verbose)
-    else:
-        raise RuntimeError('Unknown sampling procedure "{}"'.format(sampling_type))
+    # randomly initialize the user and item latent factors, unless the initial
+    # factors are given (warm start)
+    X = _init_factors(X_init, M, num_factors, init_mean, init_std)
+    Y = _init_factors(Y_init, N, num_factors, init_mean, init_std)
+
+    # the sampler keeps the sorted positive items of each user and draws the
+    # training triples lazily, inside the SGD loop
+    cdef BPRSampler sampler = BPRSampler(R, sampling_type=sampling_type, replace=sample_with_replacement,
+                                         alpha=sampling_pop_alpha)
+    cdef int n_samples = sampler.n_samples
 
     # here we define some auxiliary variables
-    cdef int i, j, k, idx, it, n
-    cdef float rij, rik, loss, deriv
-    cdef np.ndarray[np.float32_t, ndim=1] X_i = np.zeros(num_factors, dtype=np.float32)
-    cdef np.ndarray[np.float32_t, ndim=1] Y_j = np.zeros(num_factors, dtype=np.float32)
-    cdef np.ndarray[np.float32_t, ndim=1] Y_k = np.zeros(num_factors, dtype=np.float32)
+    cdef int i, j, k, f, it, n, tid
+    cdef float zijk, sig, deriv, x_if, y_jf, y_kf
+    cdef float lr, c_user_reg = user_reg, c_pos_reg = pos_reg, c_neg_reg = neg_reg
+    cdef double loss
+    cdef float [:, ::1] X_v = X, Y_v = Y
+    cdef int [:, ::1] triple = np.zeros((threads, 3), dtype=np.int32)
 
     #
     # Stochastic Gradient Descent starts here
+    # the samples of an epoch are split in contiguous shards, one for each
+    # thread, and the threads update the shared latent factors without locks
+    # (Hogwild!). Without resampling every epoch draws the same triples.
     #
     for it in range(iters):     # for each iteration
         loss = 0.0
-        for n in range(nnz):
-            i, j, k = sample[n]
-            # get the user and item factors
-            X_i = X[i].copy()
-            Y_j = Y[j].copy()
-            Y_k = Y[k].copy()
+        lr = lrate
+        sampler.start_epoch(threads, rnd_seed + it if use_resampling else rnd_seed)
+        for n in prange(n_samples, nogil=True, schedule='static', num_threads=threads):
+            tid = threadid()
+            sampler.draw(tid, n, &triple[tid, 0])
+            i = triple[tid, 0]
+            j = triple[tid, 1]
+            k = triple[tid, 2]
             # compute the difference of the predicted scores
-            diff_yjk = Y_j - Y_k
-            zijk = np.dot(X_i, diff_yjk)
-            # compute the sigmoid
+            zijk = 0.0
+            for f in range(n_factors):
+                zijk = zijk + X_v[i, f] * (Y_v[j, f] - Y_v[k, f])
+            # compute the sigmoid
             sig = 1. / (1. + exp(-zijk))
             # update the loss
             loss += log(sig)
 
-            # adjust the latent factors
+            # adjust the latent factors, using the values before the update
             deriv = 1. - sig
-            X[i] += lrate * (deriv * diff_yjk - user_reg * X_i)
-            Y[j] += lrate * (deriv * X_i - pos_reg * Y_j)
-            Y[k] += lrate * (-deriv * X_i - neg_reg * Y_k)
-
-        loss /= nnz
+            for f in range(n_factors):
+                x_if = X_v[i, f]
+                y_jf = Y_v[j, f]
+                y_kf = Y_v[k, f]
+                X_v[i, f] = x_if + lr * (deriv * (y_jf - y_kf) - c_user_reg * x_if)
+                Y_v[j, f] = y_jf + lr * (deriv * x_if - c_pos_reg * y_jf)
+                Y_v[k, f] = y_kf + lr * (-deriv * x_if - c_neg_reg * y_kf)
+
+        loss /= n_samples
         if verbose:
             print('Iter {} - loss: {:.4f}'.format(it+1, loss))
+        # the callback receives the epoch, the loss and the current factors,
+        # and stops the training by returning True
+        if callback is not None and callback(it, loss, X, Y):
+            break
         # update the learning rate
         lrate *= lrate_decay
-        if use_resampling:
-            if sampling_type == 'user_uniform_item_uniform':
-                sample = user_uniform_item_uniform_sampling(R, nnz, replace=sample_with_replacement, seed=rnd_seed, verbose=verbose)
-            elif sampling_type == 'user_uniform_item_pop':
-                sample = user_uniform_item_pop_sampling(R, nnz, alpha=sampling_pop_alpha, seed=rnd_seed, verbose=verbose)
 
     return X, Y
 
-def user_uniform_item_uniform_sampling(R, size, replace=True, seed=1234, verbose=True):
-    # use Cython MemoryViews for fast access to the sparse structure of R
-    cdef int [:] col_indices = R.indices, indptr = R.indptr
-    cdef int M = R.shape[0], N = R.shape[1]
-    cdef int nnz = len(R.data)
-
-    cdef np.ndarray[np.int64_t, ndim=2] sample = np.zeros((size, 3), dtype=np.int64)
-    cdef np.ndarray[np.int8_t, ndim=1] is_sampled # boolean arrays are not yet supported by Cython
-    if not replace:
-        is_sampled = np.zeros(nnz, dtype=np.int8)
-
-    # set the seed of the random number generator
-    np.random.seed(seed)
-
-    cdef int i=0, start, end, iid, jid, kid, idx
-    cdef np.ndarray[np.int64_t, ndim=1] aux, neg_candidates
-    cdef int [:] pos_candidates
-
-    sys.stderr.write("Generating %s random training samples\n" % str(size))
-    while i < size:
-        # 1) sample a user from a uniform distribution
-        iid  = np.random.choice(M)
-
-        # 2) sample a positive item uniformly at random
-        start = indptr[iid]
-        end = indptr[iid+1]
-        pos_candidates = col_indices[start:end]
-        if start == end:
-            # empty candidate set
-            continue
-        if replace:
-            # sample positive items with replacement
-            jid = np.random.choice(pos_candidates)
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline unsigned long long _xorshift(unsigned long long *state) nogil:
+    # xorshift64* generator, one state for each thread
+    cdef unsigned long long x = state[0]
+    x ^= x >> 12
+    x ^= x << 25
+    x ^= x >> 27
+    state[0] = x
+    return x * 2685821657736338717ULL
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline int _randint(unsigned long long *state, int n) nogil:
+    # uniform integer in [0, n)
+    return <int> ((_xorshift(state) >> 11) % <unsigned long long> n)
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline double _rand(unsigned long long *state) nogil:
+    # uniform double in [0, 1)
+    return (_xorshift(state) >> 11) * (1.0 / 9007199254740992.0)
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline bint _contains(int *indices, int start, int end, int item) nogil:
+    # binary search of item in the sorted indices[start:end]
+    cdef int mid
+    while start < end:
+        mid = (start + end) // 2
+        if indices[mid] < item:
+            start = mid + 1
+        elif indices[mid] > item:
+            end = mid
         else:
-            # sample positive items without replacement
-            # use a index vector between start and end
-            aux = np.arange(start, end)
-            if np.all(is_sampled[aux]):
-                # all positive items have been already sampled
+            return True
+    return False
+
+
+cdef class BPRSampler:
+    """
+    Sampler of the (user, positive item, negative item) training triples of BPR.
+    It is built once per fit: it keeps the sorted positive items of each user
+    and, for the 'user_uniform_item_pop' sampling, an alias table over the
+    positive items of each user, so that each triple is drawn in constant time
+    (the negative item by rejection against the sorted positive items) and
+    without the GIL. The triples of an epoch are drawn lazily by `draw`, after
+    `start_epoch` has seeded one random generator for each thread.
+    With sampling_type='user_uniform_item_uniform' the user is drawn uniformly
+    among the ones with at least one positive and one negative item, then the
+    positive item is drawn uniformly among its positive items (with replace)
+    or each positive pair is used once per epoch in a random order (without
+    replace). With sampling_type='user_uniform_item_pop' the positive item is
+    drawn proportionally to its popularity to the power alpha, always with
+    replacement.
+    """
+    cdef int [:] indptr, indices, users, row_of, pairs, order, alias
+    cdef float [:] prob
+    cdef unsigned long long [:] states
+    cdef int n_users, n_items
+    cdef bint replace, pop
+    cdef readonly int n_samples
+
+    def __init__(self, R, sampling_type='user_uniform_item_uniform', replace=True, alpha=1.0):
+        if sampling_type not in ('user_uniform_item_uniform', 'user_uniform_item_pop'):
+            raise RuntimeError('Unknown sampling procedure "{}"'.format(sampling_type))
+        R = sps.csr_matrix(R)
+        if not R.has_sorted_indices:
+            R = R.copy()
+            R.sort_indices()
+        self.n_users, self.n_items = R.shape
+        self.indptr = R.indptr.astype(np.int32)
+        self.indices = R.indices.astype(np.int32)
+        self.pop = sampling_type == 'user_uniform_item_pop'
+        self.replace = replace or self.pop
+
+        # only the users with at least one positive and one negative item
+        row_nnz = np.diff(R.indptr)
+        valid = (row_nnz > 0) & (row_nnz < self.n_items)
+        self.users = np.flatnonzero(valid).astype(np.int32)
+        if len(self.users) == 0:
+            raise ValueError('No user has both positive and negative items')
+        self.row_of = np.repeat(np.arange(self.n_users, dtype=np.int32), row_nnz)
+        # the positive pairs of the valid users, shuffled in `order` by each epoch
+        self.pairs = np.flatnonzero(np.repeat(valid, row_nnz)).astype(np.int32)
+        self.order = self.pairs
+        self.n_samples = R.nnz if self.replace else len(self.pairs)
+
+        if self.pop:
+            # smooth the item popularity with an exponential factor alpha
+            item_pop = np.asarray((R > 0).sum(axis=0), dtype=np.float64).ravel()
+            self._build_alias(np.power(item_pop, alpha)[R.indices])
+        self.states = np.zeros(8, dtype=np.uint64)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _build_alias(self, weights):
+        # Vose's alias method on the positive items of each user, the aliases
+        # are positions relative to the start of the row of the user
+        cdef double [:] w = np.asarray(weights, dtype=np.float64)
+        cdef int nnz = len(w)
+        self.prob = np.ones(nnz, dtype=np.float32)
+        self.alias = np.zeros(nnz, dtype=np.int32)
+        cdef int max_row = max(np.max(np.diff(self.indptr)), 1)
+        cdef double [:] scaled = np.zeros(max_row, dtype=np.float64)
+        cdef int [:] small = np.zeros(max_row, dtype=np.int32), large = np.zeros(max_row, dtype=np.int32)
+        cdef int u, t, start, length, n_small, n_large, s, l
+        cdef double total
+        for u in range(self.n_users):
+            start = self.indptr[u]
+            length = self.indptr[u+1] - start
+            total = 0.0
+            for t in range(length):
+                total += w[start + t]
+            if length == 0 or total <= 0.0:
                 continue
-            idx = np.random.choice(aux)
-            while is_sampled[idx]:
-                # TODO: remove idx from aux to speed up the sampling
-                idx = np.random.choice(aux)
-            is_sampled[idx] = 1
-            jid = col_indices[idx]
-
-        # 3) sample a negative item uniformly at random
-        # build the candidate set of negative items
-        # TODO: precompute the negative candidate set for speed-up
-        neg_candidates = np.delete(np.arange(N), pos_candidates)
-        kid = np.random.choice(neg_candidates)
-        sample[i, :] = [iid, jid, kid]
-        i += 1
-        if verbose and i % 10000 == 0:
-            # print('Sampling... {:.2f}% complete'.format(i/size*100))
-            sys.stderr.write('\rSampling... %.2f complete'% (i/size*100))
-            sys.stderr.flush()
-    return sample
-
+            n_small = n_large = 0
+            for t in range(length):
+                scaled[t] = w[start + t] * length / total
+                if scaled[t] < 1.0:
+                    small[n_small] = t
+                    n_small += 1
+                else:
+                    large[n_large] = t
+                    n_large += 1
+            while n_small > 0 and n_large > 0:
+                n_small -= 1
+                s = small[n_small]
+                l = large[n_large - 1]
+                self.prob[start + s] = scaled[s]
+                self.alias[start + s] = l
+                scaled[l] = scaled[l] + scaled[s] - 1.0
+                if scaled[l] < 1.0:
+                    n_large -= 1
+                    small[n_small] = l
+                    n_small += 1
+            # the remaining slots keep probability one
+
+    def start_epoch(self, n_threads=1, seed=1234):
+        """
+        Seeds the random generators of the threads for a new epoch and, without
+        replacement, shuffles the positive pairs. The same seed and number of
+        threads give the same triples.
+        """
+        rng = np.random.RandomState(seed)
+        # the states are 8 slots apart, so that each thread has its own cache line
+        self.states = rng.randint(1, 2 ** 62, size=8 * max(n_threads, 1), dtype=np.int64).astype(np.uint64)
+        if not self.replace:
+            self.order = rng.permutation(self.pairs).astype(np.int32)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.profile(False)
+    @cython.linetrace(False)
+    cdef void draw(self, int tid, int n, int *triple) nogil:
+        # writes the n-th triple of the epoch, drawn by thread tid
+        cdef unsigned long long *state = &self.states[8 * tid]
+        cdef int u, pos, start, length, k
+        if self.replace:
+            # 1) sample a user from a uniform distribution
+            u = self.users[_randint(state, self.users.shape[0])]
+            start = self.indptr[u]
+            length = self.indptr[u+1] - start
+            # 2) sample a positive item, uniformly or with the alias table
+            pos = start + _randint(state, length)
+            if self.pop and _rand(state) >= self.prob[pos]:
+                pos = start + self.alias[pos]
+        else:
+            pos = self.order[n]
+            u = self.row_of[pos]
+        # 3) sample a negative item uniformly, rejecting the positive ones
+        k = _randint(state, self.n_items)
+        while _contains(&self.indices[0], self.indptr[u], self.indptr[u+1], k):
+            k = _randint(state, self.n_items)
+        triple[0] = u
+        triple[1] = self.indices[pos]
+        triple[2] = k
+
+    def sample(self, size, seed=1234):
+        """
+        Draws `size` triples at once, as an int64 array of shape (size, 3).
+        """
+        if not self.replace and size > self.n_samples:
+            raise ValueError('Cannot draw {} samples without replacement out of {}'.format(size, self.n_samples))
+        self.start_epoch(1, seed)
+        sample = np.zeros((size, 3), dtype=np.int64)
+        cdef int [:] triple = np.zeros(3, dtype=np.int32)
+        cdef int n
+        for n in range(size):
+            self.draw(0, n, &triple[0])
+            sample[n, 0], sample[n, 1], sample[n, 2] = triple[0], triple[1], triple[2]
+        return sample
 
-def user_uniform_item_pop_sampling(R, size, alpha=1., seed=1234, verbose=True):
-    # use Cython MemoryViews for fast access to the sparse structure of R
-    cdef int [:] col_indices = R.indices, indptr = R.indptr
-    cdef int M = R.shape[0], N = R.shape[1]
-    cdef int nnz = len(R.data)
 
-    cdef np.ndarray[np.int64_t, ndim=2] sample = np.zeros((size, 3), dtype=np.int64)
+def user_uniform_item_uniform_sampling(R, size, replace=True, seed=1234, verbose=True):
+    if verbose:
+        sys.stderr.write("Generating %s random training samples\n" % str(size))
+    return BPRSampler(R, 'user_uniform_item_uniform', replace=replace).sample(size, seed=seed)
 
-    # compute the item popularity
-    cdef np.ndarray[np.float32_t, ndim=1] item_pop = np.asarray(np.sum(R > 0, axis=0)).squeeze().astype(np.float32)
-    # smooth popularity with an exponential factor alpha
-    item_pop = np.power(item_pop, alpha)
 
-    # set the seed of the random number generator
-    np.random.seed(seed)
-
-    cdef int i=0, start, end, iid, jid, kid, idx
-    cdef np.ndarray[np.int64_t, ndim=1] aux, neg_candidates
-    cdef int [:] pos_candidates
-    cdef np.ndarray[np.float32_t, ndim=1] p
-
-    sys.stderr.write("Generating %s random training samples\n" % str(size))
-    while i < size:
-        # 1) sample a user from a uniform distribution
-        iid  = np.random.choice(M)
-
-        # 2) sample a positive item proportionally to its popularity
-        start = indptr[iid]
-        end = indptr[iid+1]
-        pos_candidates = col_indices[start:end]
-        if start == end:
-            # empty candidate set
-            continue
-        # always sample with replacement
-        p = item_pop[pos_candidates]
-        p /= np.sum(p)
-        jid = np.random.choice(pos_candidates, p=p)
-
-        # 3) sample a negative item uniformly at random
-        # build the candidate set of negative items
-        # TODO: precompute the negative candidate set for speed-up
-        neg_candidates = np.delete(np.arange(N), pos_candidates)
-        kid = np.random.choice(neg_candidates)
-        sample[i, :] = [iid, jid, kid]
-        i += 1
-        if verbose and i % 10000 == 0:
-            # print('Sampling... {:.2f}% complete'.format(i/size*100))
-            sys.stderr.write('\rSampling... %.2f complete'% (i/size*100))
-            sys.stderr.flush()
-    return sample
+def user_uniform_item_pop_sampling(R, size, alpha=1., seed=1234, verbose=True):
+    if verbose:
+        sys.stderr.write("Generating %s random training samples\n" % str(size))
+    return BPRSampler(R, 'user_uniform_item_pop', alpha=alpha).sample(size, seed=seed)
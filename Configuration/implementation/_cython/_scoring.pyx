@@ -0,0 +1,255 @@
+'''
+Politecnico di Milano.
+_scoring.pyx
+
+Description: This file contains the Cython implementation of the scoring and
+             ranking of users with a sparse item-item weights matrix, as used
+             by the ItemKNN and SLIM recommenders.
+'''
+
+# cython: profile=True
+cimport cython
+cimport numpy as np
+import numpy as np
+import scipy.sparse as sps
+from libc.math cimport fabs
+from cython.parallel cimport prange, threadid
+from implementation._cython._common cimport _check_num_threads, _heap_sift_down, _heap_sift_up
+
+
+def _check_csr(X):
+    # the kernels read the float32 data and int32 indices of a csr_matrix
+    if not isinstance(X, sps.csr_matrix):
+        X = sps.csr_matrix(X)
+    if X.dtype != np.float32:
+        X = X.astype(np.float32)
+    if X.indices.dtype != np.int32 or X.indptr.dtype != np.int32:
+        # e.g. a matrix built from int64 coordinates
+        X = sps.csr_matrix((X.data, X.indices.astype(np.int32), X.indptr.astype(np.int32)), shape=X.shape)
+    return X
+
+
+def _check_dims(profiles, W):
+    # the kernels index the rows of W with the items of the profiles without
+    # bounds checking
+    if profiles.shape[1] != W.shape[0]:
+        raise ValueError('profiles has {} columns but W has {} rows'.format(profiles.shape[1], W.shape[0]))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sparse_scores(profiles, W, bint normalize=False, out=None, num_threads=1):
+    """
+    Function that computes the scores profiles.dot(W) of a block of users.
+    If normalize is True, the score of each item is divided by the sum of the
+    weights between the item and the items rated by the user, i.e. by
+    rated.dot(W) where rated holds ones in place of the ratings. The numerator
+    and the denominator are accumulated in the same traversal of the ratings
+    of the user and the rows of W.
+    :param profiles: scipy.sparse matrix, n_users x n_rows
+    :param W: scipy.sparse matrix, n_rows x n_items, converted to csr if
+        needed
+    :param normalize: normalize the scores
+    :param out: optional float32 C-contiguous array of shape (n_users, n_items)
+        where the scores are written, it is overwritten
+    :param num_threads: number of threads among which the users are
+        distributed, all the available ones if None
+    :return: the dense float32 scores, with shape (n_users, n_items)
+    """
+    profiles = _check_csr(profiles)
+    W = _check_csr(W)
+    _check_dims(profiles, W)
+
+    cdef int [:] p_indices = profiles.indices, p_indptr = profiles.indptr
+    cdef float [:] p_data = profiles.data
+    cdef int [:] w_indices = W.indices, w_indptr = W.indptr
+    cdef float [:] w_data = W.data
+    cdef int n_threads = _check_num_threads(num_threads)
+
+    cdef int n_users = profiles.shape[0], n_items = W.shape[1]
+    if out is None:
+        out = np.zeros((n_users, n_items), dtype=np.float32)
+    else:
+        if out.shape != (n_users, n_items):
+            raise ValueError('out must have shape {}'.format((n_users, n_items)))
+        out[...] = 0.0
+    cdef float [:, ::1] out_v = out
+
+    # each thread has its own denominators of a single user and the list of
+    # the items that have at least one weight with the items rated by it
+    cdef int scratch_rows = n_threads if normalize else 1
+    cdef float [:, ::1] den = np.zeros((scratch_rows, n_items), dtype=np.float32)
+    cdef char [:, ::1] seen = np.zeros((scratch_rows, n_items), dtype=np.int8)
+    cdef int [:, ::1] touched = np.zeros((scratch_rows, n_items), dtype=np.int32)
+
+    cdef int u, pp, ww, v, j, t, tid, n_touched
+    cdef float r, w, d
+
+    for u in prange(n_users, nogil=True, schedule='dynamic', num_threads=n_threads):
+        tid = threadid()
+        n_touched = 0
+        for pp in range(p_indptr[u], p_indptr[u+1]):
+            v = p_indices[pp]
+            r = p_data[pp]
+            for ww in range(w_indptr[v], w_indptr[v+1]):
+                j = w_indices[ww]
+                w = w_data[ww]
+                out_v[u, j] += r * w
+                if normalize:
+                    if not seen[tid, j]:
+                        seen[tid, j] = 1
+                        touched[tid, n_touched] = j
+                        n_touched = n_touched + 1
+                    den[tid, j] += w
+
+        if normalize:
+            for t in range(n_touched):
+                j = touched[tid, t]
+                d = den[tid, j]
+                if fabs(d) < 1e-6:
+                    d = 1.0  # to avoid NaNs
+                out_v[u, j] = out_v[u, j] / d
+                den[tid, j] = 0.0
+                seen[tid, j] = 0
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sparse_top_n(profiles, W, int n, bint normalize=False, bint exclude_seen=True, num_threads=1):
+    """
+    Function that computes the top-n items of a block of users, ranked by
+    the scores profiles.dot(W), without building the dense matrix of scores.
+    The scores of each user are accumulated in a scratch row reused across the
+    users of the same thread, the items rated by the user are skipped during
+    the accumulation if exclude_seen is True, and the n best items are kept in
+    a bounded min-heap, so that only those are sorted.
+    As in the dense scores, the items not reached by any weight from the items
+    rated by the user have a score of 0: when less than n items have a
+    non-negative score, the list is filled with them, by increasing index,
+    before the items with a negative score. The lists are padded with -1 only
+    if the user has less than n items to rank.
+    :param profiles: scipy.sparse matrix, n_users x n_rows
+    :param W: scipy.sparse matrix, n_rows x n_items, converted to csr if
+        needed
+    :param n: size of the lists
+    :param normalize: normalize the scores as in sparse_scores
+    :param exclude_seen: skip the items rated by each user
+    :param num_threads: number of threads among which the users are
+        distributed, all the available ones if None
+    :return: an int32 array of shape (n_users, n) with the items of each user
+        sorted by decreasing score
+    """
+    profiles = _check_csr(profiles)
+    W = _check_csr(W)
+    _check_dims(profiles, W)
+    if n < 0:
+        raise ValueError('n must be a non-negative integer')
+
+    cdef int [:] p_indices = profiles.indices, p_indptr = profiles.indptr
+    cdef float [:] p_data = profiles.data
+    cdef int [:] w_indices = W.indices, w_indptr = W.indptr
+    cdef float [:] w_data = W.data
+    cdef int n_threads = _check_num_threads(num_threads)
+
+    cdef int n_users = profiles.shape[0], n_items = W.shape[1]
+    out = np.full((n_users, n), -1, dtype=np.int32)
+    cdef int [:, ::1] out_v = out
+
+    # per-thread scratch: the scores and the denominators of a single user,
+    # the state of each item (1 = reached by a weight, 2 = rated by the user),
+    # the list of the reached items, the heap with the best n of them and the
+    # items not reached used to fill the list
+    cdef float [:, ::1] acc = np.zeros((n_threads, n_items), dtype=np.float32)
+    cdef float [:, ::1] den = np.zeros((n_threads if normalize else 1, n_items), dtype=np.float32)
+    cdef char [:, ::1] state = np.zeros((n_threads, n_items), dtype=np.int8)
+    cdef int [:, ::1] touched = np.zeros((n_threads, n_items), dtype=np.int32)
+    cdef float [:, ::1] heap_val = np.zeros((n_threads, max(n, 1)), dtype=np.float32)
+    cdef int [:, ::1] heap_idx = np.zeros((n_threads, max(n, 1)), dtype=np.int32)
+    cdef int [:, ::1] fill = np.zeros((n_threads, max(n, 1)), dtype=np.int32)
+
+    cdef int u, pp, ww, v, j, t, tid, n_touched, heap_size, n_nonneg, n_neg, n_fill
+    cdef float r, w, d, score
+
+    for u in prange(n_users, nogil=True, schedule='dynamic', num_threads=n_threads):
+        tid = threadid()
+        n_touched = 0
+        heap_size = 0
+        if exclude_seen:
+            for pp in range(p_indptr[u], p_indptr[u+1]):
+                state[tid, p_indices[pp]] = 2
+
+        for pp in range(p_indptr[u], p_indptr[u+1]):
+            v = p_indices[pp]
+            r = p_data[pp]
+            for ww in range(w_indptr[v], w_indptr[v+1]):
+                j = w_indices[ww]
+                if state[tid, j] == 2:
+                    continue
+                if state[tid, j] == 0:
+                    state[tid, j] = 1
+                    touched[tid, n_touched] = j
+                    n_touched = n_touched + 1
+                w = w_data[ww]
+                acc[tid, j] += r * w
+                if normalize:
+                    den[tid, j] += w
+
+        # select the best n reached items
+        for t in range(n_touched):
+            j = touched[tid, t]
+            score = acc[tid, j]
+            if normalize:
+                d = den[tid, j]
+                if fabs(d) < 1e-6:
+                    d = 1.0  # to avoid NaNs
+                score = score / d
+                den[tid, j] = 0.0
+            acc[tid, j] = 0.0
+            if n == 0:
+                continue
+            if heap_size < n:
+                heap_val[tid, heap_size] = score
+                heap_idx[tid, heap_size] = j
+                _heap_sift_up(&heap_val[tid, 0], &heap_idx[tid, 0], heap_size)
+                heap_size = heap_size + 1
+            elif score > heap_val[tid, 0]:
+                heap_val[tid, 0] = score
+                heap_idx[tid, 0] = j
+                _heap_sift_down(&heap_val[tid, 0], &heap_idx[tid, 0], heap_size, 0)
+
+        # pop the heap from the worst item, filling the list from the end
+        n_neg = 0
+        for t in range(heap_size - 1, -1, -1):
+            if heap_val[tid, 0] < 0.0:
+                n_neg = n_neg + 1
+            out_v[u, t] = heap_idx[tid, 0]
+            heap_val[tid, 0] = heap_val[tid, t]
+            heap_idx[tid, 0] = heap_idx[tid, t]
+            _heap_sift_down(&heap_val[tid, 0], &heap_idx[tid, 0], t, 0)
+        n_nonneg = heap_size - n_neg
+
+        # the items not reached (score 0) go between the non-negative and the
+        # negative reached items, the negative ones past n are dropped
+        n_fill = 0
+        j = 0
+        while n_nonneg + n_fill < n and j < n_items:
+            if state[tid, j] == 0:
+                fill[tid, n_fill] = j
+                n_fill = n_fill + 1
+            j = j + 1
+        if n_fill > 0:
+            for t in range(min(heap_size, n - n_fill) - 1, n_nonneg - 1, -1):
+                out_v[u, t + n_fill] = out_v[u, t]
+            for t in range(n_fill):
+                out_v[u, n_nonneg + t] = fill[tid, t]
+
+        # reset the scratch of the user
+        for t in range(n_touched):
+            state[tid, touched[tid, t]] = 0
+        if exclude_seen:
+            for pp in range(p_indptr[u], p_indptr[u+1]):
+                state[tid, p_indices[pp]] = 0
+    return out
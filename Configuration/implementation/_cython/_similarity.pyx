@@ -3,7 +3,8 @@ Politecnico di Milano.
 _similarity.pyx
 
 Description: This file contains the Cython implementation of the cosine and
-             pearson correlation similarities.
+             pearson correlation similarities. The kernels release the GIL
+             and distribute the columns across `num_threads` OpenMP threads.
 
 Created by: Massimo Quadrana.
 Modified by Fernando Pérez.
@@ -16,13 +17,31 @@ cimport cython
 cimport numpy as np
 import numpy as np
 import scipy.sparse as sps
+from libc.math cimport sqrt
+from cython.parallel cimport prange, threadid
+from implementation._cython._common cimport _check_num_threads, _heap_sift_down, _heap_sift_up
+
+
+def _check_columns(columns, int ncols):
+    # the kernels index the columns of X without bounds checking
+    if columns is None:
+        return np.arange(ncols, dtype=np.int32)
+    columns = np.asarray(columns, dtype=np.int32)
+    if len(columns) > 0 and (columns.min() < 0 or columns.max() >= ncols):
+        raise ValueError('columns must be between 0 and {}'.format(ncols - 1))
+    return columns
+
 
 @cython.boundscheck(False)
-def cosine_common(X):
+@cython.wraparound(False)
+@cython.cdivision(True)
+def cosine_common(X, num_threads=1):
     """
     Function that pairwise cosine similarity of the columns in X.
     It takes only the values in common between each pair of columns
     :param X: instance of scipy.sparse.csc_matrix
+    :param num_threads: number of threads among which the columns are
+        distributed, all the available ones if None
     :return:
         the result of co_prodsum
         the number of co_rated elements for every column pair
@@ -33,11 +52,14 @@ def cosine_common(X):
     # use Cython MemoryViews for fast access to the sparse structure of X
     cdef int [:] indices = X.indices, indptr = X.indptr
     cdef float [:] data = X.data
+    cdef int n_threads = _check_num_threads(num_threads)
 
     # initialize the result variables
     cdef int ncols = X.shape[1]
     cdef np.ndarray[np.float32_t, ndim=2] result = np.zeros([ncols, ncols], dtype=np.float32)
     cdef np.ndarray[np.int32_t, ndim=2] common = np.zeros([ncols, ncols], dtype=np.int32)
+    cdef float [:, :] result_v = result
+    cdef int [:, :] common_v = common
 
     # let's declare all the variables that we'll use in the loop here
     # NOTE: declaring the type of your variables makes your Cython code run MUCH faster
@@ -46,7 +68,10 @@ def cosine_common(X):
     cdef int i, j, n_i, n_j, ii, jj, n_common
     cdef float ii_sum, jj_sum, ij_sum, x_i, x_j
 
-    for i in range(ncols):
+    # each thread takes a column i and fills the row and column i of the
+    # upper-right triangle, so the threads never write the same cell.
+    # the rows of the triangle have different lengths, hence the dynamic schedule.
+    for i in prange(ncols, nogil=True, schedule='dynamic', num_threads=n_threads):
         n_i = indptr[i+1] - indptr[i]
         # the correlation matrix is symmetric,
         # let's compute only the values for the upper-right triangle
@@ -63,32 +88,36 @@ def cosine_common(X):
             # contain the row indices of the non-zero items in columns i and j)
             while ii < n_i and jj < n_j:
                 if indices[indptr[i] + ii] < indices[indptr[j] + jj]:
-                    ii += 1
+                    ii = ii + 1
                 elif indices[indptr[i] + ii] > indices[indptr[j] + jj]:
-                    jj += 1
+                    jj = jj + 1
                 else:
                     x_i = data[indptr[i] + ii]
                     x_j = data[indptr[j] + jj]
-                    ij_sum += x_i * x_j
-                    ii_sum += x_i ** 2
-                    jj_sum += x_j ** 2
-                    ii += 1
-                    jj += 1
-                    n_common += 1
+                    ij_sum = ij_sum + x_i * x_j
+                    ii_sum = ii_sum + x_i * x_i
+                    jj_sum = jj_sum + x_j * x_j
+                    ii = ii + 1
+                    jj = jj + 1
+                    n_common = n_common + 1
 
             if n_common > 0:
-                result[i, j] = ij_sum / np.sqrt(ii_sum * jj_sum)
-                result[j, i] = result[i, j]
-                common[i, j] = n_common
-                common[j, i] = n_common
+                result_v[i, j] = ij_sum / sqrt(ii_sum * jj_sum)
+                result_v[j, i] = result_v[i, j]
+                common_v[i, j] = n_common
+                common_v[j, i] = n_common
     return result, common
 
 
 @cython.boundscheck(False)
-def pearson_corr(X):
+@cython.wraparound(False)
+@cython.cdivision(True)
+def pearson_corr(X, num_threads=1):
     """
     Pearson correlation
     :param X: instance of scipy.sparse.csc_matrix
+    :param num_threads: number of threads among which the columns are
+        distributed, all the available ones if None
     :return:
         the pairwise Pearson correlation matrix
         the number of co_rated elements for every column pair
@@ -99,16 +128,20 @@ def pearson_corr(X):
     # use MemoryViews for fast access to the sparse structure of X
     cdef int [:] indices = X.indices, indptr = X.indptr
     cdef float [:] data = X.data
+    cdef int n_threads = _check_num_threads(num_threads)
 
     # initialize the result variables
     cdef int ncols = X.shape[1]
     cdef np.ndarray[np.float32_t, ndim=2] result = np.zeros([ncols, ncols], dtype=np.float32)
     cdef np.ndarray[np.int32_t, ndim=2] common = np.zeros([ncols, ncols], dtype=np.int32)
+    cdef float [:, :] result_v = result
+    cdef int [:, :] common_v = common
 
     cdef int i, j, n_i, n_j, ii, jj, n_common
-    cdef float i_sum, j_sum, ii_sum, jj_sum, ij_sum, x_i, x_j
+    cdef float i_sum, j_sum, ii_sum, jj_sum, ij_sum, x_i, x_j, num, den, c
 
-    for i in range(ncols):
+    # same work distribution as in cosine_common
+    for i in prange(ncols, nogil=True, schedule='dynamic', num_threads=n_threads):
         n_i = indptr[i+1] - indptr[i]
         # the correlation matrix is symmetric,
         # let's compute only the values for the upper-right triangle
@@ -122,30 +155,396 @@ def pearson_corr(X):
 
             while ii < n_i and jj < n_j:
                 if indices[indptr[i] + ii] < indices[indptr[j] + jj]:
-                    ii += 1
+                    ii = ii + 1
                 elif indices[indptr[i] + ii] > indices[indptr[j] + jj]:
-                    jj += 1
+                    jj = jj + 1
                 else:
                     x_i = data[indptr[i] + ii]
                     x_j = data[indptr[j] + jj]
-                    ij_sum += x_i * x_j
-                    i_sum += x_i
-                    j_sum += x_j
-                    ii_sum += x_i * x_i
-                    jj_sum += x_j * x_j
-                    ii += 1
-                    jj += 1
-                    n_common += 1
+                    ij_sum = ij_sum + x_i * x_j
+                    i_sum = i_sum + x_i
+                    j_sum = j_sum + x_j
+                    ii_sum = ii_sum + x_i * x_i
+                    jj_sum = jj_sum + x_j * x_j
+                    ii = ii + 1
+                    jj = jj + 1
+                    n_common = n_common + 1
 
             if n_common > 0:
                 num = n_common * ij_sum - i_sum * j_sum
-                den = np.sqrt((n_common * ii_sum - i_sum * i_sum) * (n_common * jj_sum - j_sum * j_sum))
+                den = sqrt((n_common * ii_sum - i_sum * i_sum) * (n_common * jj_sum - j_sum * j_sum))
                 if den > 0.0:
                     c = num / den
                 else:
                     c = 0.0
-                result[i, j] = c
-                result[j, i] = result[i, j]
-                common[i, j] = n_common
-                common[j, i] = n_common
+                result_v[i, j] = c
+                result_v[j, i] = c
+                common_v[i, j] = n_common
+                common_v[j, i] = n_common
     return result, common
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def similarity_topk(X, int k, float shrinkage=0.0, bint common=False, num_threads=1, columns=None):
+    """
+    Function that computes the top-k most similar columns of every column in X
+    without building the dense ncols x ncols similarity matrix.
+    The columns are processed one at a time: the dot products of a column with
+    all the others are accumulated by walking the rows of its non-zero values,
+    the shrinkage is applied in the same pass and only the k most similar
+    columns are kept in a bounded min-heap.
+    Only positive similarities are kept, the others would never be selected
+    over the (implicit) zero similarities of the columns without co-rated rows.
+    :param X: instance of scipy.sparse.csc_matrix
+    :param k: number of neighbours to keep for each column
+    :param shrinkage: shrinkage term, the similarity of each pair is
+        multiplied by co_counts / (co_counts + shrinkage)
+    :param common: if True, the norms are computed only on the values in common
+        between each pair of columns, as in `cosine_common`, otherwise the
+        columns of X are expected to be already normalized
+    :param num_threads: number of threads among which the columns are
+        distributed, all the available ones if None
+    :param columns: array of the indices of the columns whose neighbours are
+        computed, all of them if None
+    :return:
+        the indptr, indices and data arrays of a CSR matrix with shape
+        (len(columns), ncols) whose row t holds the top-k neighbours of the
+        column columns[t]
+    """
+    if not isinstance(X, sps.csc_matrix):
+        raise ValueError('X must be an instance of scipy.sparse.csc_matrix')
+
+    X_csr = X.tocsr()
+    # use Cython MemoryViews for fast access to the sparse structure of X,
+    # column-wise (users of each item) and row-wise (items of each user)
+    cdef int [:] c_indices = X.indices, c_indptr = X.indptr
+    cdef float [:] c_data = X.data
+    cdef int [:] r_indices = X_csr.indices, r_indptr = X_csr.indptr
+    cdef float [:] r_data = X_csr.data
+    cdef int n_threads = _check_num_threads(num_threads)
+
+    cdef int ncols = X.shape[1]
+    cdef int [:] cols = _check_columns(columns, ncols)
+    cdef int n_out = cols.shape[0]
+    if k > ncols:
+        k = ncols
+    cdef int k_slots = max(k, 1)
+
+    # each thread has its own dense accumulators of a single column, the
+    # list of the columns that have at least one row in common with it and
+    # a bounded min-heap of the k most similar columns
+    cdef float [:, :] acc = np.zeros((n_threads, ncols), dtype=np.float32)
+    cdef float [:, :] acc_ii = np.zeros((n_threads, ncols), dtype=np.float32)
+    cdef float [:, :] acc_jj = np.zeros((n_threads, ncols), dtype=np.float32)
+    cdef int [:, :] co_counts = np.zeros((n_threads, ncols), dtype=np.int32)
+    cdef int [:, :] touched = np.zeros((n_threads, ncols), dtype=np.int32)
+    cdef float [:, :] heap_val = np.zeros((n_threads, k_slots), dtype=np.float32)
+    cdef int [:, :] heap_idx = np.zeros((n_threads, k_slots), dtype=np.int32)
+
+    # preallocated output, each column has k slots and the number of
+    # neighbours actually found, the unused slots are removed at the end
+    cdef np.ndarray[np.int32_t, ndim=2] out_indices = np.zeros((n_out, k_slots), dtype=np.int32)
+    cdef np.ndarray[np.float32_t, ndim=2] out_data = np.zeros((n_out, k_slots), dtype=np.float32)
+    cdef np.ndarray[np.int32_t, ndim=1] out_nnz = np.zeros(n_out, dtype=np.int32)
+    cdef int [:, :] out_indices_v = out_indices
+    cdef float [:, :] out_data_v = out_data
+    cdef int [:] out_nnz_v = out_nnz
+
+    cdef int c, j, i, t, u, jj, ii, tid, n_touched, heap_size
+    cdef float x_j, x_i, sim, den
+
+    for c in prange(n_out, nogil=True, schedule='dynamic', num_threads=n_threads):
+        tid = threadid()
+        j = cols[c]
+        n_touched = 0
+        for jj in range(c_indptr[j], c_indptr[j+1]):
+            u = c_indices[jj]
+            x_j = c_data[jj]
+            for ii in range(r_indptr[u], r_indptr[u+1]):
+                i = r_indices[ii]
+                # the similarity of a column with itself is not computed
+                if i == j:
+                    continue
+                if co_counts[tid, i] == 0:
+                    touched[tid, n_touched] = i
+                    n_touched = n_touched + 1
+                x_i = r_data[ii]
+                acc[tid, i] += x_i * x_j
+                acc_ii[tid, i] += x_i * x_i
+                acc_jj[tid, i] += x_j * x_j
+                co_counts[tid, i] += 1
+
+        heap_size = 0
+        for t in range(n_touched):
+            i = touched[tid, t]
+            sim = acc[tid, i]
+            if common:
+                den = sqrt(acc_ii[tid, i] * acc_jj[tid, i])
+                if den > 0.0:
+                    sim = sim / den
+                else:
+                    sim = 0.0
+            if shrinkage > 0.0:
+                sim = sim * co_counts[tid, i] / (co_counts[tid, i] + shrinkage)
+
+            # reset the accumulators for the next column
+            acc[tid, i] = 0.0
+            acc_ii[tid, i] = 0.0
+            acc_jj[tid, i] = 0.0
+            co_counts[tid, i] = 0
+
+            if sim <= 0.0 or k == 0:
+                continue
+            if heap_size < k:
+                heap_val[tid, heap_size] = sim
+                heap_idx[tid, heap_size] = i
+                _heap_sift_up(&heap_val[tid, 0], &heap_idx[tid, 0], heap_size)
+                heap_size = heap_size + 1
+            elif sim > heap_val[tid, 0]:
+                heap_val[tid, 0] = sim
+                heap_idx[tid, 0] = i
+                _heap_sift_down(&heap_val[tid, 0], &heap_idx[tid, 0], heap_size, 0)
+
+        for t in range(heap_size):
+            out_indices_v[c, t] = heap_idx[tid, t]
+            out_data_v[c, t] = heap_val[tid, t]
+        out_nnz_v[c] = heap_size
+
+    # compact the slots of each column into the CSR arrays
+    out_indptr = np.zeros(n_out + 1, dtype=np.int32)
+    np.cumsum(out_nnz, out=out_indptr[1:])
+    valid = np.arange(k_slots, dtype=np.int32)[None, :] < out_nnz[:, None]
+    return out_indptr, out_indices[valid], out_data[valid]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def normalize_columns(X):
+    """
+    Function that divides in place every column of X by its L2 norm.
+    :param X: instance of scipy.sparse.csc_matrix with float32 data, it is modified
+    :return: the column norms (plus 1e-6 to avoid divisions by zero)
+    """
+    if not isinstance(X, sps.csc_matrix):
+        raise ValueError('X must be an instance of scipy.sparse.csc_matrix')
+
+    cdef int [:] indptr = X.indptr
+    cdef float [:] data = X.data
+    cdef int ncols = X.shape[1]
+    cdef np.ndarray[np.float32_t, ndim=1] norms = np.zeros(ncols, dtype=np.float32)
+    cdef float [:] norms_v = norms
+
+    cdef int j, jj
+    cdef float norm
+
+    with nogil:
+        for j in range(ncols):
+            norm = 0.0
+            for jj in range(indptr[j], indptr[j+1]):
+                norm = norm + data[jj] * data[jj]
+            norm = sqrt(norm) + 1e-6
+            for jj in range(indptr[j], indptr[j+1]):
+                data[jj] = data[jj] / norm
+            norms_v[j] = norm
+    return norms
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def dot_shrink(X, float shrinkage=0.0, num_threads=1):
+    """
+    Function that computes the dot product between every pair of columns in X,
+    multiplied by the shrinkage factor co_counts / (co_counts + shrinkage).
+    The dot products and the co-counts are accumulated in the same pass over
+    the rows of X, so neither the co-counts matrix nor a sparse intermediate
+    product is built. The similarity of a column with itself is zero.
+    :param X: instance of scipy.sparse.csc_matrix
+    :param shrinkage: shrinkage term, no shrinkage if 0
+    :param num_threads: number of threads among which the columns are
+        distributed, all the available ones if None
+    :return: dense matrix with shape (ncols, ncols)
+    """
+    if not isinstance(X, sps.csc_matrix):
+        raise ValueError('X must be an instance of scipy.sparse.csc_matrix')
+
+    X_csr = X.tocsr()
+    # column-wise (users of each item) and row-wise (items of each user) access
+    cdef int [:] c_indices = X.indices, c_indptr = X.indptr
+    cdef float [:] c_data = X.data
+    cdef int [:] r_indices = X_csr.indices, r_indptr = X_csr.indptr
+    cdef float [:] r_data = X_csr.data
+    cdef int n_threads = _check_num_threads(num_threads)
+
+    cdef int ncols = X.shape[1]
+    cdef np.ndarray[np.float32_t, ndim=2] result = np.zeros([ncols, ncols], dtype=np.float32)
+    cdef float [:, :] result_v = result
+
+    # each thread has its own co-counts of a single column and the list of
+    # the columns that have at least one row in common with it, the dot
+    # products are accumulated directly into the result
+    cdef int [:, :] co_counts = np.zeros((n_threads, ncols), dtype=np.int32)
+    cdef int [:, :] touched = np.zeros((n_threads, ncols), dtype=np.int32)
+
+    cdef int j, i, t, u, jj, ii, tid, n_touched
+
+    for j in prange(ncols, nogil=True, schedule='dynamic', num_threads=n_threads):
+        tid = threadid()
+        n_touched = 0
+        for jj in range(c_indptr[j], c_indptr[j+1]):
+            u = c_indices[jj]
+            for ii in range(r_indptr[u], r_indptr[u+1]):
+                i = r_indices[ii]
+                # the similarity of a column with itself is not computed
+                if i == j:
+                    continue
+                if co_counts[tid, i] == 0:
+                    touched[tid, n_touched] = i
+                    n_touched = n_touched + 1
+                result_v[i, j] += r_data[ii] * c_data[jj]
+                co_counts[tid, i] += 1
+
+        for t in range(n_touched):
+            i = touched[tid, t]
+            if shrinkage > 0.0:
+                result_v[i, j] = result_v[i, j] * co_counts[tid, i] / (co_counts[tid, i] + shrinkage)
+            co_counts[tid, i] = 0
+    return result
+
+
+@cython.profile(False)
+@cython.linetrace(False)
+cdef inline float _binary_similarity(int co_count, int n_i, int n_j, int jaccard, float shrinkage) nogil:
+    # similarity of two binary columns from their co-count and number of
+    # non-zeros, cosine: c / (|i|^0.5 * |j|^0.5), jaccard: c / (|i| + |j| - c)
+    cdef float sim
+    if jaccard:
+        sim = (<float> co_count) / (n_i + n_j - co_count)
+    else:
+        sim = co_count / ((sqrt(<float> n_i) + 1e-6) * (sqrt(<float> n_j) + 1e-6))
+    if shrinkage > 0.0:
+        sim = sim * co_count / (co_count + shrinkage)
+    return sim
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def binary_similarity(X, float shrinkage=0.0, bint jaccard=False, int k=-1, num_threads=1, columns=None):
+    """
+    Function that computes the cosine or jaccard similarity between the columns
+    of a binary matrix using only integer co-counts.
+    The values of X are ignored, each column is the sorted list of its non-zero
+    row indices. The co-counts of a column are accumulated by walking the rows
+    of its non-zero values, as in `similarity_topk`, and the similarities and
+    the shrinkage are derived from the co-counts and the column sizes.
+    :param X: instance of scipy.sparse.csc_matrix
+    :param shrinkage: shrinkage term, the similarity of each pair is
+        multiplied by co_counts / (co_counts + shrinkage)
+    :param jaccard: compute the jaccard similarity instead of the cosine
+    :param k: number of neighbours to keep for each column, if negative the
+        dense matrix of all the similarities is returned
+    :param num_threads: number of threads among which the columns are
+        distributed, all the available ones if None
+    :param columns: array of the indices of the columns whose neighbours are
+        computed when k is not negative, all of them if None
+    :return:
+        if k is negative, the dense similarity matrix with shape (ncols, ncols)
+        otherwise, the indptr, indices and data arrays of a CSR matrix with
+        shape (len(columns), ncols) whose row t holds the top-k neighbours of
+        the column columns[t]
+    """
+    if not isinstance(X, sps.csc_matrix):
+        raise ValueError('X must be an instance of scipy.sparse.csc_matrix')
+
+    X_csr = X.tocsr()
+    # only the sparsity structure of X is used
+    cdef int [:] c_indices = X.indices, c_indptr = X.indptr
+    cdef int [:] r_indices = X_csr.indices, r_indptr = X_csr.indptr
+    cdef int n_threads = _check_num_threads(num_threads)
+
+    cdef int ncols = X.shape[1]
+    cdef bint dense = k < 0
+    if dense and columns is not None:
+        raise ValueError('columns can only be given with a non-negative k')
+    cdef int [:] cols = _check_columns(columns, ncols)
+    cdef int n_out = cols.shape[0]
+    if k > ncols:
+        k = ncols
+    cdef int k_slots = max(k, 1)
+
+    cdef np.ndarray[np.float32_t, ndim=2] result = np.zeros([ncols if dense else 1, ncols if dense else 1], dtype=np.float32)
+    cdef float [:, :] result_v = result
+
+    # each thread has its own co-counts of a single column, the list of the
+    # columns that have at least one row in common with it and a bounded
+    # min-heap of the k most similar columns
+    cdef int [:, :] co_counts = np.zeros((n_threads, ncols), dtype=np.int32)
+    cdef int [:, :] touched = np.zeros((n_threads, ncols), dtype=np.int32)
+    cdef float [:, :] heap_val = np.zeros((n_threads, k_slots), dtype=np.float32)
+    cdef int [:, :] heap_idx = np.zeros((n_threads, k_slots), dtype=np.int32)
+
+    cdef np.ndarray[np.int32_t, ndim=2] out_indices = np.zeros((1 if dense else n_out, k_slots), dtype=np.int32)
+    cdef np.ndarray[np.float32_t, ndim=2] out_data = np.zeros((1 if dense else n_out, k_slots), dtype=np.float32)
+    cdef np.ndarray[np.int32_t, ndim=1] out_nnz = np.zeros(n_out, dtype=np.int32)
+    cdef int [:, :] out_indices_v = out_indices
+    cdef float [:, :] out_data_v = out_data
+    cdef int [:] out_nnz_v = out_nnz
+
+    cdef int c, j, i, t, u, jj, ii, tid, n_touched, heap_size, n_j
+    cdef float sim
+
+    for c in prange(n_out, nogil=True, schedule='dynamic', num_threads=n_threads):
+        tid = threadid()
+        j = cols[c]
+        n_touched = 0
+        n_j = c_indptr[j+1] - c_indptr[j]
+        for jj in range(c_indptr[j], c_indptr[j+1]):
+            u = c_indices[jj]
+            for ii in range(r_indptr[u], r_indptr[u+1]):
+                i = r_indices[ii]
+                # the similarity of a column with itself is not computed
+                if i == j:
+                    continue
+                if co_counts[tid, i] == 0:
+                    touched[tid, n_touched] = i
+                    n_touched = n_touched + 1
+                co_counts[tid, i] += 1
+
+        heap_size = 0
+        for t in range(n_touched):
+            i = touched[tid, t]
+            sim = _binary_similarity(co_counts[tid, i], c_indptr[i+1] - c_indptr[i], n_j, jaccard, shrinkage)
+            co_counts[tid, i] = 0
+
+            if dense:
+                result_v[i, j] = sim
+            elif k == 0:
+                continue
+            elif heap_size < k:
+                heap_val[tid, heap_size] = sim
+                heap_idx[tid, heap_size] = i
+                _heap_sift_up(&heap_val[tid, 0], &heap_idx[tid, 0], heap_size)
+                heap_size = heap_size + 1
+            elif sim > heap_val[tid, 0]:
+                heap_val[tid, 0] = sim
+                heap_idx[tid, 0] = i
+                _heap_sift_down(&heap_val[tid, 0], &heap_idx[tid, 0], heap_size, 0)
+
+        if not dense:
+            for t in range(heap_size):
+                out_indices_v[c, t] = heap_idx[tid, t]
+                out_data_v[c, t] = heap_val[tid, t]
+            out_nnz_v[c] = heap_size
+
+    if dense:
+        return result
+
+    # compact the slots of each column into the CSR arrays
+    out_indptr = np.zeros(n_out + 1, dtype=np.int32)
+    np.cumsum(out_nnz, out=out_indptr[1:])
+    valid = np.arange(k_slots, dtype=np.int32)[None, :] < out_nnz[:, None]
+    return out_indptr, out_indices[valid], out_data[valid]
@@ -8,6 +8,8 @@ import numpy as np
 import scipy.sparse as sps
 from ..utils.metrics import roc_auc, precision, recall, map, ndcg, rr
 from .Recommender_utils import check_matrix, areURMequals, removeTopPop
+from .base import mask_seen_scores, top_n_rows
+from .._cython._scoring import sparse_scores, sparse_top_n
 import multiprocessing
 import time
 import random
@@ -488,24 +490,7 @@ class Recommender(object):
             user_profile = self.URM_train[user_id]
 
         # compute the scores using the dot product
-        if self.sparse_weights:
-            # print("sparse")
-            scores = user_profile.dot(self.W_sparse).toarray().ravel()
-            #scores = self.scoresAll[user_id].toarray().ravel()
-        else:
-            # print("complete")
-            scores = user_profile.dot(self.W).ravel()
-        if self.normalize:
-            # normalization will keep the scores in the same range
-            # of value of the ratings in dataset
-            rated = user_profile.copy()
-            rated.data = np.ones_like(rated.data)
-            if self.sparse_weights:
-                den = rated.dot(self.W_sparse).toarray().ravel()
-            else:
-                den = rated.dot(self.W).ravel()
-            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
-            scores /= den
+        scores = self._scores(user_profile).ravel()
 
         if exclude_seen:
             scores = self._filter_seen_on_scores(user_id, scores)
@@ -528,6 +513,42 @@ class Recommender(object):
 
         return ranking[:n]
 
+    def score_batch(self, user_ids):
+        # compute the scores of the whole block using the dot product
+        return self._scores(self.URM_train[user_ids])
+
+    def _scores(self, user_profile):
+        # with sparse weights the numerator and the denominator of the
+        # normalized scores are computed in the same pass over the ratings of
+        # each user and the rows of W_sparse
+        if self.sparse_weights:
+            return sparse_scores(user_profile, self.W_sparse, normalize=self.normalize)
+
+        scores = user_profile.dot(self.W)
+        if self.normalize:
+            # normalization will keep the scores in the same range
+            # of value of the ratings in dataset
+            rated = user_profile.copy()
+            rated.data = np.ones_like(rated.data)
+            den = rated.dot(self.W)
+            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
+            scores /= den
+        return scores
+
+    def recommend_batch(self, user_ids, n=None, exclude_seen=True):
+        # the seen items are masked with -inf and the top-n items are selected
+        # without sorting all the scores, see `base.Recommender.recommend_batch`.
+        # With sparse weights the top-n items are selected by sparse_top_n
+        # while the scores are accumulated, without the dense scores
+        if self.sparse_weights and n is not None:
+            top_n = sparse_top_n(self.URM_train[user_ids], self.W_sparse, n,
+                                 normalize=self.normalize, exclude_seen=exclude_seen)
+            return [ranking[ranking >= 0] for ranking in top_n]
+        scores = np.asarray(self.score_batch(user_ids), dtype=np.float32)
+        if exclude_seen:
+            mask_seen_scores(scores, self.URM_train[user_ids])
+        return top_n_rows(scores, n)
+
     def recommendBatch(self, users_to_recommend_list, n=None, exclude_seen=False, relevant_items=None):
 
         # compute the scores using the dot product
@@ -564,21 +585,13 @@ class Recommender(object):
         # compute the scores using the dot product
         if self.sparse_weights:
             assert user_profile.shape[1] == self.W_sparse.shape[0], 'The number of items does not match!'
-            scores = user_profile.dot(self.W_sparse).toarray().ravel()
+            if n is not None:
+                ranking = sparse_top_n(user_profile, self.W_sparse, n, normalize=self.normalize,
+                                       exclude_seen=exclude_seen)[0]
+                return ranking[ranking >= 0]
         else:
             assert user_profile.shape[1] == self.W.shape[0], 'The number of items does not match!'
-            scores = user_profile.dot(self.W).ravel()
-        if self.normalize:
-            # normalization will keep the scores in the same range
-            # of value of the ratings in dataset
-            rated = user_profile.copy()
-            rated.data = np.ones_like(rated.data)
-            if self.sparse_weights:
-                den = rated.dot(self.W_sparse).toarray().ravel()
-            else:
-                den = rated.dot(self.W).ravel()
-            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
-            scores /= den
+        scores = self._scores(user_profile).ravel()
         # rank items
         ranking = scores.argsort()[::-1]
         if exclude_seen:
@@ -28,7 +28,62 @@ def check_matrix(X, format='csc', dtype=np.float32):
         return X.astype(dtype)
 
 
-def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100):
+def topKIndices(item_weights, k, block_size=1000):
+    """
+    Selects the k largest values of each column of a dense matrix
+    :param item_weights: dense matrix, nitems X ncols
+    :param k: number of values to keep in each column
+    :param block_size: number of columns processed at once
+    :return: Array of int32 with shape (min(k, nitems), ncols),
+             column j holds the row indices of the top-k values of column j, unordered
+    """
+    nrows, ncols = item_weights.shape
+    k = min(k, nrows)
+    top_k = np.empty((k, ncols), dtype=np.int32)
+
+    if k == 0:
+        return top_k
+
+    # argpartition on the negated values puts the k largest in the first k rows
+    for start in range(0, ncols, block_size):
+        block = item_weights[:, start:start + block_size]
+        top_k[:, start:start + block_size] = np.argpartition(-block, k - 1, axis=0)[:k]
+
+    return top_k
+
+
+def topKMatrix(item_weights, top_k, forceSparseOutput = True):
+    """
+    Builds the matrix holding only the values of item_weights selected by top_k
+    :param item_weights: dense matrix, nitems X ncols
+    :param top_k: row indices of the values to keep in each column, as returned by topKIndices
+    :param forceSparseOutput: return a csr_matrix instead of a dense matrix
+    :return: the pruned matrix
+    """
+    k, ncols = top_k.shape
+    cols = np.arange(ncols, dtype=np.int32)
+
+    if not forceSparseOutput:
+        # use numpy fancy indexing to keep only the values of the top-k
+        # without using a for loop
+        W = np.zeros_like(item_weights)
+        W[top_k, cols] = item_weights[top_k, cols]
+        return W
+
+    # every column has exactly k values, so the CSC arrays can be filled
+    # directly from the column-major view of top_k
+    indices = np.ascontiguousarray(top_k.T).ravel()
+    data = np.asarray(item_weights[top_k, cols], dtype=np.float32).T.ravel()
+    indptr = np.arange(ncols + 1, dtype=np.int32) * k
+
+    # During testing CSR is faster
+    W_sparse = sps.csc_matrix((data, indices, indptr), shape=item_weights.shape).tocsr()
+    # the zero similarities are not stored
+    W_sparse.eliminate_zeros()
+    return W_sparse
+
+
+def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, block_size=1000):
 
     assert (item_weights.shape[0] == item_weights.shape[1]), "selectTopK: ItemWeights is not a square matrix"
 
@@ -42,43 +97,46 @@ def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100):
 
     if not sparse_weights:
 
-        idx_sorted = np.argsort(item_weights, axis=0)  # sort data inside each column
-
-        W = item_weights.copy()
-        # index of the items that don't belong to the top-k similar items of each column
-        not_top_k = idx_sorted[:-k, :]
-        # use numpy fancy indexing to zero-out the values in sim without using a for loop
-        W[not_top_k, np.arange(nitems)] = 0.0
-
-        if forceSparseOutput:
-            W_sparse = sps.csr_matrix(W, shape=(nitems, nitems))
-            return W_sparse
+        top_k = topKIndices(item_weights, k, block_size=block_size)
+        W = topKMatrix(item_weights, top_k, forceSparseOutput=forceSparseOutput)
 
         print("TopK matrix generated in {:.2f} seconds".format(time.time()-start_time))
 
         return W
 
     else:
-        # iterate over each column and keep only the top-k similar items
-        values, rows, cols = [], [], []
-
+        # select the top-k values of a block of columns at once, the output
+        # is filled column by column into preallocated buffers
         item_weights = item_weights.tocsc()
+        item_weights.sort_indices()
+
+        indptr = item_weights.indptr
+        col_nnz = np.diff(indptr)
+        out_nnz = np.minimum(col_nnz, k)
+
+        out_indptr = np.zeros(nitems + 1, dtype=np.int32)
+        np.cumsum(out_nnz, out=out_indptr[1:])
+        out_indices = np.empty(out_indptr[-1], dtype=np.int32)
+        out_data = np.empty(out_indptr[-1], dtype=np.float32)
 
-        for item_idx in range(nitems):
+        for start in range(0, nitems, block_size):
+            end = min(start + block_size, nitems)
+            low, high = indptr[start], indptr[end]
+            block_nnz = col_nnz[start:end]
 
-            item_column = item_weights[:,item_idx]
-            dataValue = item_column.data
-            dataRow = item_column.indices
+            # sort the values of the block by column, then decreasingly by value
+            block_cols = np.repeat(np.arange(start, end), block_nnz)
+            order = np.lexsort((-item_weights.data[low:high], block_cols))
 
-            idx_sorted = np.argsort(dataValue)  # sort by column
-            top_k_idx = idx_sorted[-k:]
+            # position of each sorted value inside its column
+            ranks = np.arange(high - low) - np.repeat(indptr[start:end] - low, block_nnz)
+            keep = order[ranks < k] + low
 
-            values.extend(dataValue[top_k_idx])
-            rows.extend(dataRow[top_k_idx])
-            cols.extend(np.ones(len(top_k_idx), dtype=np.int) * item_idx)
+            out_indices[out_indptr[start]:out_indptr[end]] = item_weights.indices[keep]
+            out_data[out_indptr[start]:out_indptr[end]] = item_weights.data[keep]
 
         # During testing CSR is faster
-        W_sparse = sps.csr_matrix((values, (rows, cols)), shape=(nitems, nitems), dtype=np.float32)
+        W_sparse = sps.csc_matrix((out_data, out_indices, out_indptr), shape=(nitems, nitems)).tocsr()
 
         print("TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
 
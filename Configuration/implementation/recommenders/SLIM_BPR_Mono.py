@@ -19,6 +19,7 @@ import time
 import os
 from .Recommender import Recommender
 from .Recommender_utils import similarityMatrixTopK, check_matrix
+from .base import linear_keys, top_k_indices, pairs_dot
 import scipy.sparse as sps
 import subprocess
 
@@ -284,7 +285,7 @@ class SLIM_BPR_Mono(Recommender):
         SLIMsimilarity.close()
 
         self.W_sparse = sps.csr_matrix((values, (rows, cols)), shape=(self.n_items, self.n_items), dtype=np.float32)
-        self.W_sparse = self.W_sparse.T
+        self.W_sparse = self.W_sparse.T.tocsr()
         self.sparse_weights = True
 
         if self.topK != False:
@@ -379,7 +380,37 @@ class SLIM_BPR_Mono(Recommender):
         if deleteFiles:
             self.removeTemporaryFiles()
 
-    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='user'):
+    def score_pairs(self, users, items):
+        """Calculates the predicted score of a list of user-item pairs.
+
+            The score of each pair is the dot product between the profile of
+            the user and the column of the item in the similarity matrix,
+            normalized as in `calculate_scores_user`.
+
+            Args:
+                * users: the user index of each pair.
+                * items: the item index of each pair.
+
+            Args type:
+                * users: Numpy.ndarray of int
+                * items: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray with the predicted score of each pair.
+        """
+        W = self.W_sparse if self.sparse_weights else self.W
+        scores = pairs_dot(self.URM_train, W, users, items)
+        if self.normalize:
+            # normalization will keep the scores in the same range
+            # of value of the ratings in dataset
+            rated = check_matrix(self.URM_train, 'csr', dtype=np.float32)
+            rated.data = np.ones_like(rated.data)
+            den = pairs_dot(rated, W, users, items)
+            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
+            scores /= den
+        return scores
+
+    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='pairs'):
         """Rates new user-item pairs.
 
            This function is part of the Co-Training process in which we rate
@@ -407,7 +438,9 @@ class SLIM_BPR_Mono(Recommender):
                * score_mode: the type of score prediction, 'user' represents by
                              sequentially user-by-user, 'batch' represents by
                              taking batches of users, 'matrix' represents to
-                             make the preditions by a matrix multiplication.
+                             make the preditions by a matrix multiplication,
+                             'pairs' represents to score only the user-item
+                             pairs in the pool (see `score_pairs`).
 
            Args type:
                * unlabeled_list: Scipy.Sparse matrix.
@@ -425,7 +458,10 @@ class SLIM_BPR_Mono(Recommender):
         users,items = unlabeled_list.nonzero()
         n_scores = len(users)
         uniq_users, user_to_idx = np.unique(users,return_inverse=True)
-        if (score_mode == 'user'):
+        if (score_mode == 'pairs'):
+            filtered_scores = self.score_pairs(users, items)
+
+        elif (score_mode == 'user'):
             filtered_scores = np.zeros(shape=n_scores,dtype=np.float32)
             curr_user = None
             i = 0
@@ -449,10 +485,10 @@ class SLIM_BPR_Mono(Recommender):
         # filtered_scores[i] = scores[users[i],items[i]]
 
         # Filtered the scores to have the n-most and p-most.
-        # sorted_filtered_scores is sorted incrementally
-        sorted_filtered_scores = filtered_scores.argsort()
-        p_sorted_scores = sorted_filtered_scores[-p_most:]
-        n_sorted_scores = sorted_filtered_scores[:n_most]
+        # The p-most are sorted decreasingly.
+        # The n-most are sorted incrementally.
+        p_sorted_scores = top_k_indices(filtered_scores, p_most, largest=True)
+        n_sorted_scores = top_k_indices(filtered_scores, n_most, largest=False)
 
         if binary_ratings:
             scores = [(users[i], items[i], 1.0) for i in p_sorted_scores] + [(users[i], items[i], 0.0) for i in n_sorted_scores]
@@ -464,9 +500,9 @@ class SLIM_BPR_Mono(Recommender):
         meta['pos_labels'] = len(p_sorted_scores)
         meta['neg_labels'] = len(n_sorted_scores)
         meta['total_labels'] = len(p_sorted_scores) + len(n_sorted_scores)
-        meta['pos_set'] = set([(users[i], items[i]) for i in p_sorted_scores])
-        meta['neg_set'] = set([(users[i], items[i]) for i in n_sorted_scores])
-        meta['neutral_set'] = set()
+        meta['pos_keys'] = linear_keys(users[p_sorted_scores], items[p_sorted_scores], unlabeled_list.shape[1])
+        meta['neg_keys'] = linear_keys(users[n_sorted_scores], items[n_sorted_scores], unlabeled_list.shape[1])
+        meta['neutral_keys'] = linear_keys([], [], unlabeled_list.shape[1])
 
         # We sort the indices by user, then by item in order to make the
         # assignment to the LIL matrix faster.
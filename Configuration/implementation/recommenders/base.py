@@ -51,6 +51,246 @@ def check_matrix(X, format='csc', dtype=np.float32):
     else:
         return X.astype(dtype)
 
+def linear_keys(users, items, nitems):
+    """Encodes user-item pairs as int64 linear keys.
+
+        Each pair is represented by the key `user * nitems + item`, in this way,
+        sets of pairs are stored as sorted arrays and compared with Numpy set
+        routines instead of Python sets of tuples.
+
+        Args:
+            * users: the user index of each pair.
+            * items: the item index of each pair.
+            * nitems: the number of items in the dataset.
+
+        Args type:
+            * users: Numpy.ndarray of int
+            * items: Numpy.ndarray of int
+            * nitems: int
+
+        Returns:
+            A sorted Numpy.ndarray of unique int64 keys.
+    """
+    users = np.asarray(users, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    return np.unique(users * nitems + items)
+
+def top_k_indices(scores, k, largest=True):
+    """Selects the indices of the k highest (or lowest) scores.
+
+        The extremes are selected with `np.argpartition` in linear time, and
+        only the selected slice is sorted, instead of sorting all the scores.
+
+        Args:
+            * scores: the scores from which we select.
+            * k: the number of indices to select, if it is greater than the
+                 number of scores, all of them are selected.
+            * largest: select the highest scores, sorted decreasingly, if True,
+                       otherwise, the lowest scores, sorted incrementally.
+
+        Args type:
+            * scores: Numpy.ndarray
+            * k: int
+            * largest: bool
+
+        Returns:
+            A Numpy.ndarray with the indices of the selected scores.
+    """
+    n_scores = len(scores)
+    k = min(k, n_scores)
+    if (k <= 0):
+        return np.array([], dtype=np.intp)
+    if (k == n_scores):
+        selected = np.arange(n_scores)
+    elif (largest):
+        selected = np.argpartition(scores, n_scores - k)[n_scores - k:]
+    else:
+        selected = np.argpartition(scores, k - 1)[:k]
+
+    order = scores[selected].argsort()
+    if (largest):
+        order = order[::-1]
+    return selected[order]
+
+def label_extremes(unlabeled_list, score_pairs, user_scores, binary_ratings=False, p_most=1, n_most=3, score_mode='pairs'):
+    """Rates the p-most positive and n-most negative pairs of an unlabeled pool.
+
+        The user-item pairs of the pool are scored, the `p_most` highest
+        scored pairs are labeled as positive and the `n_most` lowest scored
+        ones as negative. It is the labeling shared by the recommenders whose
+        `label` only differs in the way the scores are computed.
+
+        Args:
+            * unlabeled_list: a matrix that holds the user-item pairs that we
+                              must label.
+            * score_pairs: function that returns the score of each pair, given
+                           the users and the items (used by 'pairs').
+            * user_scores: function that returns the scores of all the items
+                           for a user or an array of users (used by 'user' and
+                           'matrix').
+            * binary_ratings: label with (0,1) ratings instead of (1,5).
+            * p_most: the number of p-most positive pairs.
+            * n_most: the number of n-most negative pairs.
+            * score_mode: 'pairs' scores only the pairs of the pool, 'user'
+                          scores the items user-by-user and 'matrix' scores
+                          all the users of the pool at once.
+
+        Args type:
+            * unlabeled_list: Scipy.Sparse matrix
+            * score_pairs: function
+            * user_scores: function
+            * binary_ratings: bool
+            * p_most: int
+            * n_most: int
+            * score_mode: str
+
+        Returns:
+            A list containing the user-item-rating triplets, sorted by user and
+            item, and the meta dictionary for statistics.
+    """
+    unlabeled_list = check_matrix(unlabeled_list, 'lil', dtype=np.float32)
+    users, items = unlabeled_list.nonzero()
+
+    # filtered_scores[i] is the predicted score of the pair (users[i],items[i])
+    if (score_mode == 'pairs'):
+        filtered_scores = score_pairs(users, items)
+    elif (score_mode == 'user'):
+        filtered_scores = np.zeros(shape=len(users), dtype=np.float32)
+        curr_user = None
+        for i, (user, item) in enumerate(zip(users, items)):
+            if (curr_user != user):
+                curr_user = user
+                scores = user_scores(curr_user)
+            filtered_scores[i] = scores[item]
+    elif (score_mode == 'matrix'):
+        # As scores is not a n_user/n_item matrix but a partial matrix
+        # then we will need to see which user is mapped to which index.
+        uniq_users, user_to_idx = np.unique(users, return_inverse=True)
+        scores = user_scores(uniq_users)
+        filtered_scores = scores[user_to_idx, items]
+    else:
+        raise ValueError('Unknown score_mode: {}'.format(score_mode))
+
+    # The p-most are sorted decreasingly.
+    # The n-most are sorted incrementally.
+    p_sorted_scores = top_k_indices(filtered_scores, p_most, largest=True)
+    n_sorted_scores = top_k_indices(filtered_scores, n_most, largest=False)
+
+    if binary_ratings:
+        scores = [(users[i], items[i], 1.0) for i in p_sorted_scores] + [(users[i], items[i], 0.0) for i in n_sorted_scores]
+    else:
+        scores = [(users[i], items[i], 5.0) for i in p_sorted_scores] + [(users[i], items[i], 1.0) for i in n_sorted_scores]
+
+    meta = dict()
+    meta['pos_labels'] = len(p_sorted_scores)
+    meta['neg_labels'] = len(n_sorted_scores)
+    meta['total_labels'] = len(p_sorted_scores) + len(n_sorted_scores)
+    meta['pos_keys'] = linear_keys(users[p_sorted_scores], items[p_sorted_scores], unlabeled_list.shape[1])
+    meta['neg_keys'] = linear_keys(users[n_sorted_scores], items[n_sorted_scores], unlabeled_list.shape[1])
+    meta['neutral_keys'] = linear_keys([], [], unlabeled_list.shape[1])
+
+    # We sort the indices by user, then by item in order to make the
+    # assignment to the LIL matrix faster.
+    return sorted(scores, key=lambda triplet: (triplet[0],triplet[1])), meta
+
+def pairs_dot(A, B, rows, cols, block_size=100000):
+    """Computes the entries (rows[p], cols[p]) of the product A.dot(B).
+
+        Instead of computing the whole product, for each pair the row of A is
+        multiplied element-wise by the column of B and the result is summed.
+        The pairs are processed in blocks to bound the memory used. If one of
+        the matrices is dense, only its entries matching the non-zeros of the
+        sparse one are gathered, so no dense row or column is copied.
+
+        Args:
+            * A: the left matrix of the product.
+            * B: the right matrix of the product.
+            * rows: the row index in A of each pair.
+            * cols: the column index in B of each pair.
+            * block_size: number of pairs processed at once.
+
+        Args type:
+            * A: Scipy.Sparse matrix or Numpy.ndarray
+            * B: Scipy.Sparse matrix or Numpy.ndarray, sparse if A is dense.
+            * rows: Numpy.ndarray of int
+            * cols: Numpy.ndarray of int
+            * block_size: int
+
+        Returns:
+            A Numpy.ndarray with the value of the product for each pair.
+    """
+    if (not sps.issparse(A)):
+        # the entry (r,c) of A.dot(B) is the entry (c,r) of B.T.dot(A.T)
+        return pairs_dot(B.T, A.T, cols, rows, block_size=block_size)
+
+    A = check_matrix(A, 'csr', dtype=np.float32)
+    if (sps.issparse(B)):
+        # the columns of B are taken as rows of its transpose.
+        Bt = B.T.tocsr()
+    result = np.zeros(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        end = min(start + block_size, len(rows))
+        A_rows = A[rows[start:end]]
+        if (sps.issparse(B)):
+            B_cols = Bt[cols[start:end]]
+            result[start:end] = np.asarray(A_rows.multiply(B_cols).sum(axis=1)).ravel()
+        else:
+            # each non-zero A[r,k] of the block is multiplied by B[k,c] and
+            # the products are summed by pair.
+            pair = np.repeat(np.arange(end - start), np.diff(A_rows.indptr))
+            values = A_rows.data * B[A_rows.indices, cols[start:end][pair]]
+            result[start:end] = np.bincount(pair, weights=values, minlength=end - start)
+    return result
+
+def mask_seen_scores(scores, profiles):
+    """Sets to -inf the scores of the items already seen by each user.
+
+        Args:
+            * scores: the scores of all the items for a block of users, it is
+                      modified in place.
+            * profiles: the ratings of the same block of users, the structure
+                        of the matrix tells which items are seen.
+
+        Args type:
+            * scores: Numpy.ndarray of shape (n_users, n_items)
+            * profiles: Scipy.Sparse.csr_matrix
+    """
+    profiles = check_matrix(profiles, 'csr', dtype=np.float32)
+    rows = np.repeat(np.arange(profiles.shape[0]), np.diff(profiles.indptr))
+    scores[rows, profiles.indices] = -np.inf
+
+def top_n_rows(scores, n=None):
+    """Makes a top-N ranked list for each row of a matrix of scores.
+
+        The top-N items of each row are selected with `np.argpartition` and
+        only they are sorted. The items with a score of -inf (e.g. the seen
+        items) are removed from the lists.
+
+        Args:
+            * scores: the scores of all the items for a block of users.
+            * n: size of the lists, if None, all the items are ranked.
+
+        Args type:
+            * scores: Numpy.ndarray of shape (n_users, n_items)
+            * n: int
+
+        Returns:
+            A list with a ranked Numpy.ndarray of item indices for each row.
+    """
+    n_rows, n_items = scores.shape
+    if (n is None or n >= n_items):
+        top_n = np.argsort(-scores, axis=1)
+    elif (n <= 0):
+        return [np.array([], dtype=np.intp) for _ in range(n_rows)]
+    else:
+        top_n = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        row_idx = np.arange(n_rows)[:, None]
+        top_n = top_n[row_idx, np.argsort(-scores[row_idx, top_n], axis=1)]
+
+    top_scores = scores[np.arange(n_rows)[:, None], top_n]
+    valid = top_scores > -np.inf
+    return [top_n[i][valid[i]] for i in range(n_rows)]
+
 
 class Recommender(object):
     """Class that serves as an abstract base for all our recommender classes.
@@ -132,5 +372,67 @@ class Recommender(object):
     def label(self, unlabeled_list, n=None, exclude_seen=True, p_most=1, n_most=3):
         pass
 
+    def score_batch(self, user_ids):
+        """Calculates the scores of all the items for a block of users.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray of shape (len(user_ids), n_items) with the
+                scores of each user for all the items.
+        """
+        pass
+
+    def recommend_batch(self, user_ids, n=None, exclude_seen=True):
+        """Makes a top-N recommendation list for each user in a block.
+
+            The scores of the block are calculated at once by `score_batch`,
+            the seen items are masked using the structure of the dataset and
+            the top-N items of each user are selected without sorting all the
+            scores.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+                * n: size of the lists.
+                * exclude_seen: tells if we should remove already-seen items from
+                                the lists.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+                * n: int
+                * exclude_seen: bool
+
+            Returns:
+                A list with a ranked list of items, represented by their indices,
+                for each user in the block.
+        """
+        scores = np.asarray(self.score_batch(user_ids), dtype=np.float32)
+        if exclude_seen:
+            mask_seen_scores(scores, self._get_user_ratings(user_ids))
+        return top_n_rows(scores, n)
+
+    def score_pairs(self, users, items):
+        """Calculates the predicted score of a list of user-item pairs.
+
+            Only the scores of the given pairs are computed, instead of the
+            scores of all the items for each user.
+
+            Args:
+                * users: the user index of each pair.
+                * items: the item index of each pair.
+
+            Args type:
+                * users: Numpy.ndarray of int
+                * items: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray with the predicted score of each pair.
+        """
+        pass
+
     def predict(self, user_id):
         pass
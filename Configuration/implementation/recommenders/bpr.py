@@ -32,7 +32,7 @@ import theano.tensor as T
 import time
 import sys
 from collections import defaultdict
-from .base import Recommender, check_matrix
+from .base import Recommender, check_matrix, label_extremes
 
 class BPRMF_THEANO(Recommender):
     """Class that implements a BPRMF recommender using THEANO for fast computations.
@@ -399,7 +399,26 @@ class BPRMF_THEANO(Recommender):
         """
         return self.prediction(user_index=user_id,item_index=rated_indices)
 
-    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='user'):
+    def score_batch(self, user_ids):
+        """
+          Computes item predictions for each user in `user_ids`.
+          Returns an array of prediction values of shape
+          (len(user_ids), n_items).
+        """
+        return self.predictions(user_index=user_ids)
+
+    def score_pairs(self, users, items):
+        """
+          Computes the predictions of the `users`-`items` pairs as the
+          row-wise dot product of the gathered user and item factors.
+          Returns an array of prediction values for each pair.
+        """
+        w = self.W.get_value()
+        h = self.H.get_value()
+        b = self.B.get_value()
+        return numpy.einsum('ij,ij->i', w[users], h[items]) + b[items]
+
+    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='pairs'):
         """Rates new user-item pairs.
 
            This function is part of the Co-Training process in which we rate
@@ -425,9 +444,10 @@ class BPRMF_THEANO(Recommender):
                * n_most: tells the number of n-most negative items that we
                          should choose.
                * score_mode: the type of score prediction, 'user' represents by
-                             sequentially user-by-user, 'batch' represents by
-                             taking batches of users, 'matrix' represents to
-                             make the preditions by a matrix multiplication.
+                             sequentially user-by-user, 'matrix' represents to
+                             make the preditions by a matrix multiplication,
+                             'pairs' represents to score only the user-item
+                             pairs in the pool (see `score_pairs`).
 
            Args type:
                * unlabeled_list: Scipy.Sparse matrix.
@@ -442,62 +462,8 @@ class BPRMF_THEANO(Recommender):
                dictionary for statistics.
         """
 
-        unlabeled_list = check_matrix(unlabeled_list, 'lil', dtype=numpy.float32)
-
-        users,items = unlabeled_list.nonzero()
-        n_scores = len(users)
-        uniq_users, user_to_idx = numpy.unique(users,return_inverse=True)
-
-        # At this point, we have all the predicted scores for the users inside
-        # U'. Now we will filter the scores by keeping only the scores of the
-        # items presented in U'. This will be an array where:
-        # filtered_scores[i] = scores[users[i],items[i]]
-        if (score_mode == 'user'):
-            filtered_scores = numpy.zeros(shape=n_scores,dtype=numpy.float32)
-            curr_user = None
-            i = 0
-            for user,item in zip(users,items):
-                if (curr_user != user):
-                    curr_user = user
-                    scores = self.predictions(user_index=curr_user)
-
-                filtered_scores[i] = scores[item]
-                i += 1
-
-        elif (score_mode == 'batch'):
-            pass
-
-        elif (score_mode == 'matrix'):
-            # As scores is not a n_user/n_item matrix but a partial matrix
-            # then we will need to see which user is mapped to which index.
-            scores = self.predictions(user_index=uniq_users)
-            filtered_scores = scores[user_to_idx,items]
-
-        # Filtered the scores to have the n-most and p-most.
-        # sorted_filtered_scores is sorted incrementally
-        sorted_filtered_scores = filtered_scores.argsort()
-        p_sorted_scores = sorted_filtered_scores[-p_most:]
-        n_sorted_scores = sorted_filtered_scores[:n_most]
-
-        # creating the user-item-rating triplets to be returned based on the
-        # dataset interaction type.
-        if binary_ratings:
-            scores = [(users[i], items[i], 1.0) for i in p_sorted_scores] + [(users[i], items[i], 0.0) for i in n_sorted_scores]
-        else:
-            scores = [(users[i], items[i], 5.0) for i in p_sorted_scores] + [(users[i], items[i], 1.0) for i in n_sorted_scores]
-
-        # Creation of statistic sets begin here.
-        meta = dict()
-        meta['pos_labels'] = len(p_sorted_scores)
-        meta['neg_labels'] = len(n_sorted_scores)
-        meta['total_labels'] = len(p_sorted_scores) + len(n_sorted_scores)
-        meta['pos_set'] = set([(users[i], items[i]) for i in p_sorted_scores])
-        meta['neg_set'] = set([(users[i], items[i]) for i in n_sorted_scores])
-        meta['neutral_set'] = set()
-
-        # We sort the indices by user, then by item in order to make the
-        # assignment to the LIL matrix faster.
-        return sorted(scores, key=lambda triplet: (triplet[0],triplet[1])), meta
+        return label_extremes(unlabeled_list, self.score_pairs, lambda users: self.predictions(user_index=users),
+                              binary_ratings=binary_ratings, p_most=p_most, n_most=n_most, score_mode=score_mode)
 
     def test(self, test_data):
         """
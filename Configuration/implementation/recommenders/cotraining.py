@@ -10,10 +10,13 @@ Created by: Fernando Benjamín Pérez Maurera.
 Last modified on 05/09/2017.
 '''
 
+import copy
 import random as random
 import logging
+import pickle
 import traceback
 from datetime import datetime as dt
+import multiprocessing
 
 import numpy as np
 import scipy.sparse as sp
@@ -25,6 +28,210 @@ logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
 
+# The recommenders are fitted in spawned processes instead of forked ones, a
+# child forked after the parent ran an OpenMP parallel region deadlocks.
+_mp = multiprocessing.get_context('spawn')
+
+# Size of the chunks used to send the fitted models through a pipe, which
+# cannot send more than 2 GiB in a single message.
+_CHUNK_SIZE = 2 ** 28
+
+class TrainingSet(object):
+    """Class that holds a Co-Training training set as cached sparse matrices.
+
+        The labeled user-item-rating triplets of each iteration are not written
+        element by element into the matrix, instead, they are accumulated as
+        a COO delta and merged into the cached CSR matrix in one vectorized
+        operation the next time the matrix is requested.
+
+        As in a LIL assignment, a new rating overwrites the previous one for
+        the same user-item pair and zero ratings are not stored.
+
+        The cached matrix only replaces the LIL matrix and its conversion to
+        CSR on each iteration. The recommenders still pass it through
+        `check_matrix`, which returns a copy that they may modify in place, so
+        the cached matrix is not shared with them.
+
+        Attributes:
+            * shape: the shape of the training set.
+            * dtype: the data type of the ratings.
+
+        Attributes types:
+            * shape: (int, int)
+            * dtype: numpy.dtype
+    """
+
+    def __init__(self, URM, dtype=np.float32):
+        """Constructor of the class.
+
+            Args:
+                * URM: the initial training set.
+                * dtype: the data type of the ratings.
+
+            Args type:
+                * URM: Scipy.Sparse matrix
+                * dtype: numpy.dtype
+        """
+        super(TrainingSet, self).__init__()
+        self.shape = URM.shape
+        self.dtype = dtype
+        self._csr = sp.csr_matrix(URM, dtype=dtype, copy=True)
+        self._csr.sum_duplicates()
+        self._csr.eliminate_zeros()
+        self._delta_rows = []
+        self._delta_cols = []
+        self._delta_data = []
+
+    @property
+    def csr(self):
+        """ The training set as a Scipy.Sparse.csr_matrix. """
+        if (len(self._delta_data) > 0):
+            self.merge()
+        return self._csr
+
+    def tocoo(self):
+        """ The training set as a Scipy.Sparse.coo_matrix, used for backups. """
+        return self.csr.tocoo()
+
+    def add(self, triplets):
+        """Accumulates new user-item-rating triplets into the delta.
+
+            Args:
+                * triplets: the labeled user-item-rating triplets.
+
+            Args type:
+                * triplets: list of (int, int, float)
+        """
+        if (len(triplets) == 0):
+            return
+        triplets = np.asarray(triplets, dtype=np.float64).reshape(-1, 3)
+        self._delta_rows.append(triplets[:, 0].astype(np.int32))
+        self._delta_cols.append(triplets[:, 1].astype(np.int32))
+        self._delta_data.append(triplets[:, 2].astype(self.dtype))
+
+    def merge(self):
+        """Merges the accumulated delta into the cached CSR matrix.
+
+            Triplets added later overwrite earlier ones for the same user-item
+            pair. The ratings already stored in the training set are
+            overwritten by adding their difference with the new rating, in
+            this way the merge is a single sparse addition.
+        """
+        rows = np.concatenate(self._delta_rows)
+        cols = np.concatenate(self._delta_cols)
+        data = np.concatenate(self._delta_data)
+        self._delta_rows, self._delta_cols, self._delta_data = [], [], []
+
+        # Keeping only the last rating of each user-item pair, by taking the
+        # first occurrence of each key in the reversed arrays.
+        keys = rows.astype(np.int64) * self.shape[1] + cols
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        rows, cols, data = rows[last], cols[last], data[last]
+
+        current = np.asarray(self._csr[rows, cols], dtype=self.dtype).ravel()
+        delta = sp.csr_matrix((data - current, (rows, cols)), shape=self.shape, dtype=self.dtype)
+        self._csr = self._csr + delta
+        self._csr.eliminate_zeros()
+
+def _share_csr(X):
+    """Copies the arrays of a CSR matrix into shared memory.
+
+        Args:
+            * X: the matrix to be shared.
+
+        Args type:
+            * X: Scipy.Sparse.csr_matrix
+
+        Returns:
+            A tuple containing the shared data, indices and indptr arrays,
+            their dtypes and the shape of the matrix.
+    """
+    arrays = []
+    for arr in (X.data, X.indices, X.indptr):
+        shared = _mp.RawArray(arr.dtype.char, arr.size)
+        np.frombuffer(shared, dtype=arr.dtype)[:] = arr
+        arrays.append((shared, arr.dtype))
+    return arrays, X.shape
+
+def _csr_from_shared(shared_X):
+    """Builds a CSR matrix on top of the shared memory arrays, without copies.
+
+        Args:
+            * shared_X: the output of `_share_csr`.
+
+        Args type:
+            * shared_X: tuple
+
+        Returns:
+            A Scipy.Sparse.csr_matrix instance.
+    """
+    arrays, shape = shared_X
+    data, indices, indptr = [np.frombuffer(shared, dtype=dtype) for shared, dtype in arrays]
+    return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+def _send_chunked(conn, obj):
+    """Pickles an object and sends it through a pipe in chunks.
+
+        Args:
+            * conn: the end of the pipe where the object is sent.
+            * obj: the object to send.
+
+        Args type:
+            * conn: multiprocessing.Connection
+            * obj: any picklable object
+    """
+    payload = memoryview(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    conn.send(len(payload))
+    for start in range(0, len(payload), _CHUNK_SIZE):
+        conn.send_bytes(payload[start:start + _CHUNK_SIZE])
+
+def _recv_chunked(conn):
+    """Receives an object sent by `_send_chunked`.
+
+        Args:
+            * conn: the end of the pipe where the object is received.
+
+        Args type:
+            * conn: multiprocessing.Connection
+
+        Returns:
+            The unpickled object.
+    """
+    size = conn.recv()
+    payload = bytearray(size)
+    received = 0
+    while received < size:
+        received += conn.recv_bytes_into(payload, received)
+    return pickle.loads(payload)
+
+def _fit_worker(recommender, shared_X, conn):
+    """Fits a recommender inside a child process and sends back its state.
+
+        The state sent back is the dictionary of attributes of the fitted
+        recommender without its training set, which the parent process
+        already holds.
+
+        Args:
+            * recommender: the recommender to fit.
+            * shared_X: the training set in shared memory.
+            * conn: the end of the pipe where the state is sent.
+
+        Args type:
+            * recommender: A Recommender instance
+            * shared_X: tuple
+            * conn: multiprocessing.Connection
+    """
+    try:
+        recommender.fit(_csr_from_shared(shared_X))
+        state = dict(recommender.__dict__)
+        state.pop('dataset', None)
+        _send_chunked(conn, (state, None))
+    except:
+        _send_chunked(conn, (None, traceback.format_exc()))
+    finally:
+        conn.close()
+
 class CoTraining(object):
     """Class that implements a Co-Training process between two recommenders.
 
@@ -77,9 +284,12 @@ class CoTraining(object):
             * p_most: number of p-most positive samples to label.
             * n_most: number of n-most positive samples to label.
             * seed: seed for random number generators.
+            * parallel_fit: fit both recommenders concurrently in child processes.
+            * parallel_baselines: also fit the baselines concurrently, only
+                                  used if `parallel_fit` is True.
     """
 
-    def __init__(self, rec_1, rec_2, eval_obj, n_iters = 30, n_labels = 10, p_most = 1, n_most = 3, seed=1024):
+    def __init__(self, rec_1, rec_2, eval_obj, n_iters = 30, n_labels = 10, p_most = 1, n_most = 3, seed=1024, parallel_fit=False, parallel_baselines=False):
         """Constructor of the class.
 
             Args:
@@ -91,6 +301,10 @@ class CoTraining(object):
                 * p_most: number of p-most positive samples to label.
                 * n_most: number of n-most positive samples to label.
                 * seed: seed for random number generators.
+                * parallel_fit: fit both recommenders concurrently in child
+                                processes.
+                * parallel_baselines: also fit the baselines concurrently, only
+                                      used if `parallel_fit` is True.
 
             Args type:
                 * rec_1: A Recommender instance
@@ -101,6 +315,8 @@ class CoTraining(object):
                 * p_most: int
                 * n_most: int
                 * seed: int
+                * parallel_fit: bool
+                * parallel_baselines: bool
 
         """
         super(CoTraining, self).__init__()
@@ -112,6 +328,8 @@ class CoTraining(object):
         self.p_most = p_most
         self.n_most = n_most
         self.seed = seed
+        self.parallel_fit = parallel_fit
+        self.parallel_baselines = parallel_baselines
 
     def short_str(self):
         """ Short string used for dictionaries. """
@@ -174,18 +392,19 @@ class CoTraining(object):
         # If we must resume Co-Training, then the training sets must be loaded
         if (recover_cotraining):
             begin_iter = recover_iter
-            URM_1 = sp.load_npz(file=self.eval.results_path + 'training_set_1_iter{}.npz'.format(recover_iter)).tolil()
-            URM_2 = sp.load_npz(file=self.eval.results_path + 'training_set_2_iter{}.npz'.format(recover_iter)).tolil()
+            URM_1 = TrainingSet(sp.load_npz(file=self.eval.results_path + 'training_set_1_iter{}.npz'.format(recover_iter)))
+            URM_2 = TrainingSet(sp.load_npz(file=self.eval.results_path + 'training_set_2_iter{}.npz'.format(recover_iter)))
         else:
             begin_iter = 0
-            URM_2 = URM_1.copy()
+            URM_2 = TrainingSet(URM_1)
+            URM_1 = TrainingSet(URM_1)
 
         # Co-Training iterations begin here.
         for i_iter in range(begin_iter,self.n_iters+1):
             logger.info("Iteration: {}".format(i_iter))
 
-            u_prime = self.generate_unlabeled_pool(URM_1=URM_1,
-                                                   URM_2=URM_2,
+            u_prime = self.generate_unlabeled_pool(URM_1=URM_1.csr,
+                                                   URM_2=URM_2.csr,
                                                    nusers=nusers,
                                                    nitems=nitems,
                                                    random_state=random_state
@@ -196,39 +415,48 @@ class CoTraining(object):
                 sp.save_npz(file=self.eval.results_path + 'training_set_1_iter{}.npz'.format(i_iter),matrix=URM_1.tocoo(), compressed=True)
                 sp.save_npz(file=self.eval.results_path + 'training_set_2_iter{}.npz'.format(i_iter),matrix=URM_2.tocoo(), compressed=True)
 
-            # Try to fit the first recommender.
-            try:
-                logger.info('\tRecommender: {}'.format(self.rec_1))
-                tic = dt.now()
-                logger.info('\t\tTraining started for recommender: {}'.format(self.rec_1))
-                self.rec_1.fit(URM_1)
-                if (self.rec_1.short_str() == "SLIM_BPR_Mono"):
-                    print(self.rec_1.evaluateRecommendations(URM_test_new=self.eval.test_set, at=self.eval.at, minRatingsPerUser=1, exclude_seen=True,mode='sequential', filterTopPop = False,fastValidation=True))
-                logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, self.rec_1))
-            except:
-                logger.info('Could not fit the recommender 1: {}'.format(sys.exc_info()))
-                traceback.print_exc(file=error_file)
+            # Fit the recommenders, concurrently or one after the other.
+            if (self.parallel_fit):
+                to_fit = [(self.rec_1, 1), (self.rec_2, 2)]
+                if (baselines and self.parallel_baselines):
+                    to_fit += [(ge_1, 1), (ge_2, 2), (tp_1, 1), (tp_2, 2), (random, 1)]
+                self.fit_parallel(recommenders=to_fit,
+                                  training_sets={1: URM_1.csr, 2: URM_2.csr},
+                                  error_file=error_file)
+            else:
+                # Try to fit the first recommender.
+                try:
+                    logger.info('\tRecommender: {}'.format(self.rec_1))
+                    tic = dt.now()
+                    logger.info('\t\tTraining started for recommender: {}'.format(self.rec_1))
+                    self.rec_1.fit(URM_1.csr)
+                    if (self.rec_1.short_str() == "SLIM_BPR_Mono"):
+                        print(self.rec_1.evaluateRecommendations(URM_test_new=self.eval.test_set, at=self.eval.at, minRatingsPerUser=1, exclude_seen=True,mode='sequential', filterTopPop = False,fastValidation=True))
+                    logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, self.rec_1))
+                except:
+                    logger.info('Could not fit the recommender 1: {}'.format(sys.exc_info()))
+                    traceback.print_exc(file=error_file)
 
-            # Try to fit the second recommender.
-            try:
-                logger.info('\tRecommender: {}'.format(self.rec_2))
-                tic = dt.now()
-                logger.info('\t\tTraining started for recommender: {}'.format(self.rec_2))
-                self.rec_2.fit(URM_2)
-                if (self.rec_2.short_str() == "SLIM_BPR_Mono"):
-                    print(self.rec_2.evaluateRecommendations(URM_test_new=self.eval.test_set, at=self.eval.at, minRatingsPerUser=1, exclude_seen=True,mode='sequential', filterTopPop = False,fastValidation=True))
-                logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, self.rec_2))
-            except:
-                logger.info('Could not fit the recommender 2: {}'.format(sys.exc_info()))
-                traceback.print_exc(file=error_file)
+                # Try to fit the second recommender.
+                try:
+                    logger.info('\tRecommender: {}'.format(self.rec_2))
+                    tic = dt.now()
+                    logger.info('\t\tTraining started for recommender: {}'.format(self.rec_2))
+                    self.rec_2.fit(URM_2.csr)
+                    if (self.rec_2.short_str() == "SLIM_BPR_Mono"):
+                        print(self.rec_2.evaluateRecommendations(URM_test_new=self.eval.test_set, at=self.eval.at, minRatingsPerUser=1, exclude_seen=True,mode='sequential', filterTopPop = False,fastValidation=True))
+                    logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, self.rec_2))
+                except:
+                    logger.info('Could not fit the recommender 2: {}'.format(sys.exc_info()))
+                    traceback.print_exc(file=error_file)
 
             # If evaluating with baselines, then train them.
-            if (baselines):
+            if (baselines and not (self.parallel_fit and self.parallel_baselines)):
                 try:
                     logger.info('\tRecommender: {}'.format(ge_1))
                     tic = dt.now()
                     logger.info('\t\tTraining started for recommender: {}'.format(ge_1))
-                    ge_1.fit(URM_1)
+                    ge_1.fit(URM_1.csr)
                     logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, ge_1))
                 except:
                     logger.info('Could not fit the recommender global effects: {}'.format(sys.exc_info()))
@@ -238,7 +466,7 @@ class CoTraining(object):
                     logger.info('\tRecommender: {}'.format(ge_2))
                     tic = dt.now()
                     logger.info('\t\tTraining started for recommender: {}'.format(ge_2))
-                    ge_2.fit(URM_2)
+                    ge_2.fit(URM_2.csr)
                     logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, ge_2))
                 except:
                     logger.info('Could not fit the recommender global effects: {}'.format(sys.exc_info()))
@@ -248,7 +476,7 @@ class CoTraining(object):
                     logger.info('\tRecommender: {}'.format(tp_1))
                     tic = dt.now()
                     logger.info('\t\tTraining started for recommender: {}'.format(tp_1))
-                    tp_1.fit(URM_1)
+                    tp_1.fit(URM_1.csr)
                     logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, tp_1))
                 except:
                     logger.info('Could not fit the recommender top-pop: {}'.format(sys.exc_info()))
@@ -258,7 +486,7 @@ class CoTraining(object):
                     logger.info('\tRecommender: {}'.format(tp_2))
                     tic = dt.now()
                     logger.info('\t\tTraining started for recommender: {}'.format(tp_2))
-                    tp_2.fit(URM_2)
+                    tp_2.fit(URM_2.csr)
                     logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, tp_2))
                 except:
                     logger.info('Could not fit the recommender top-pop: {}'.format(sys.exc_info()))
@@ -268,7 +496,7 @@ class CoTraining(object):
                     logger.info('\tRecommender: {}'.format(random))
                     tic = dt.now()
                     logger.info('\t\tTraining started for recommender: {}'.format(random))
-                    random.fit(URM_1)
+                    random.fit(URM_1.csr)
                     logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, random))
                 except:
                     logger.info('Could not fit the recommender random: {}'.format(sys.exc_info()))
@@ -355,24 +583,80 @@ class CoTraining(object):
                 logger.info('Could not log the new labeled items: {}'.format(sys.exc_info()))
                 traceback.print_exc(file=error_file)
 
-            # Add the labeled examples from recommender1 into T2.
+            # Add the labeled examples from recommender1 into T2. They are
+            # merged into the training set the next time it is requested.
             try:
-                for user_idx, item_idx, label in labeled1:
-                    URM_2[user_idx,item_idx] = label
+                URM_2.add(labeled1)
             except:
                 logger.info('Could not include labeled into URM_2: {}'.format(sys.exc_info()))
                 traceback.print_exc(file=error_file)
 
             # Add the labeled examples from recommender2 into T1.
             try:
-                for user_idx, item_idx, label in labeled2:
-                    URM_1[user_idx,item_idx] = label
+                URM_1.add(labeled2)
             except:
                 logger.info('Could not include labeled into URM_1: {}'.format(sys.exc_info()))
                 traceback.print_exc(file=error_file)
 
         error_file.close()
 
+    def fit_parallel(self, recommenders, training_sets, error_file=None):
+        """Fits several recommenders concurrently, each one in a child process.
+
+           The training sets are copied once into shared memory and each child
+           process builds its CSR matrix on top of it, in this way, the
+           training sets are not pickled. The children are spawned, not forked,
+           so they do not inherit the OpenMP state of this process. Once a
+           recommender is fitted, its learned attributes are sent back to this
+           process and replace the state of the original instance, so the
+           references held by the caller remain valid, and its training set is
+           attached again from `training_sets`.
+
+           Args:
+               * recommenders: the recommenders to fit and the key of the
+                               training set of each one.
+               * training_sets: the training sets by key.
+               * error_file: if the algorithms cannot be fitted, the exception
+                             is logged into a file.
+
+           Args type:
+               * recommenders: list of (Recommender, int)
+               * training_sets: Dictionary<int:Scipy.Sparse.csr_matrix>
+               * error_file: File instance.
+        """
+        shared = {key: _share_csr(URM) for key, URM in training_sets.items()}
+
+        tic = dt.now()
+        jobs = []
+        for recommender, key in recommenders:
+            logger.info('\t\tTraining started for recommender: {}'.format(recommender))
+            # the training set of the previous fit is not sent to the child
+            unfitted = copy.copy(recommender)
+            unfitted.__dict__.pop('dataset', None)
+            parent_conn, child_conn = _mp.Pipe(duplex=False)
+            process = _mp.Process(target=_fit_worker, args=(unfitted, shared[key], child_conn))
+            process.start()
+            child_conn.close()
+            jobs.append((recommender, key, process, parent_conn))
+
+        for recommender, key, process, conn in jobs:
+            try:
+                state, error = _recv_chunked(conn)
+            except EOFError:
+                state, error = None, 'The process exited with code {}.\n'.format(process.exitcode)
+            process.join()
+            conn.close()
+
+            if (state is None):
+                logger.info('Could not fit the recommender {}: {}'.format(recommender, error))
+                if (error_file is not None):
+                    error_file.write(error)
+                continue
+
+            recommender.__dict__.update(state)
+            recommender.dataset = training_sets[key]
+            logger.info('\t\tTraining completed in {} for recommender: {}'.format(dt.now() - tic, recommender))
+
     def label(self, unlabeled_set, binary_ratings=False, exclude_seen=True, p_most=1000, n_most=100000, error_file=None):
         """Rates new user-item pairs.
 
@@ -383,7 +667,9 @@ class CoTraining(object):
            The `label` method of each recommender is called.
 
            After those methods returns, we apply set operations using the
-           dictionary of meta statistics they return. Specifically, we determine
+           dictionary of meta statistics they return, where the labeled
+           user-item pairs are represented as sorted arrays of int64 linear
+           keys (see `base.linear_keys`). Specifically, we determine
            how many items both label as positive, negative and neutral, also,
            how many items only the first recommender label as positive, negative
            and neutral, lastly, how many items only the second recommender label
@@ -427,26 +713,30 @@ class CoTraining(object):
             logger.info('Could not label new items for recomemnder 2: {}'.format(sys.exc_info()))
             traceback.print_exc(file=error_file)
 
+        # The labeled pairs are sorted arrays of unique int64 linear keys, the
+        # pairs labeled only by one recommender are the ones not in common.
         meta_both = dict()
-        meta_both['both_pos'] = len(meta_1['pos_set'].intersection(meta_2['pos_set']))
-        meta_both['both_neg'] = len(meta_1['neg_set'].intersection(meta_2['neg_set']))
-        meta_both['both_neutral'] = len(meta_1['neutral_set'].intersection(meta_2['neutral_set']))
-        meta_both['pos_only_first'] = len(meta_1['pos_set'].difference(meta_2['pos_set']))
-        meta_both['neg_only_first'] = len(meta_1['neg_set'].difference(meta_2['neg_set']))
-        meta_both['neutral_only_first'] = len(meta_1['neutral_set'].difference(meta_2['neutral_set']))
-        meta_both['pos_only_second'] = len(meta_2['pos_set'].difference(meta_1['pos_set']))
-        meta_both['neg_only_second'] = len(meta_2['neg_set'].difference(meta_1['neg_set']))
-        meta_both['neutral_only_second'] = len(meta_2['neutral_set'].difference(meta_1['neutral_set']))
-
+        for label in ['pos', 'neg', 'neutral']:
+            keys_1, keys_2 = meta_1[label + '_keys'], meta_2[label + '_keys']
+            n_common = len(np.intersect1d(keys_1, keys_2, assume_unique=True))
+            meta_both['both_' + label] = n_common
+            meta_both[label + '_only_first'] = len(keys_1) - n_common
+            meta_both[label + '_only_second'] = len(keys_2) - n_common
 
         return labeled1, labeled2, meta_1, meta_2, meta_both
 
     def generate_unlabeled_pool(self, URM_1, URM_2, nusers, nitems, random_state):
         """Generates random user-item pairs that are not labeled in both training sets.
 
-           The function generates a random user and a random item and if the pair
-           is not rated neither in URM_1 nor URM_2, then it is considered as
-           an unlabeled sample.
+           The function draws random users and random items in large batches
+           and if a pair is not rated neither in URM_1 nor URM_2, then it is
+           considered as an unlabeled sample.
+
+           Each pair is represented by its linear key `user * nitems + item`,
+           the rated pairs are rejected by a binary search over the sorted keys
+           of both training sets and the duplicated pairs are removed keeping
+           the order in which they were drawn. The pool has `n_labels` pairs
+           or, if there are fewer unrated pairs, all of them.
 
            All the users and items are drawn from an Uniform Distribution.
 
@@ -465,27 +755,67 @@ class CoTraining(object):
                * random_state: Numpy.Random.RandomState instance
 
            Returns:
-               A Scipy.Sparse.LilMatrix instance where the nonzero elements
+               A Scipy.Sparse.csr_matrix instance where the nonzero elements
                are the random users and items.
         """
-        # Using a LIL matrix to have a A[row[k], col[k]] = Data[k] representation
-        # without having an efficiency tradeoff.
         logger.info("Creating a pool of unlabeled samples.")
-        u_prime = sp.lil_matrix((nusers,nitems), dtype=np.int32)
+        rated_keys = np.union1d(self._rated_keys(URM_1), self._rated_keys(URM_2))
+
+        # The pool cannot be larger than the number of unrated pairs.
+        n_unrated = nusers * nitems - len(rated_keys)
+        n_pool = min(self.n_labels, n_unrated)
+        if (n_pool < self.n_labels):
+            logger.info("Only {} unrated pairs are left, the pool is reduced to them.".format(n_unrated))
 
         # Feed U' with unlabeled samples.
-        users_items = set()
-        while (len(users_items) < self.n_labels):
-            rnd_user = random_state.randint(0, high=nusers, dtype=np.int32)
-            rnd_item = random_state.randint(0, high=nitems, dtype=np.int32)
-            if (URM_1[rnd_user,rnd_item] == 0.0 and URM_2[rnd_user,rnd_item] == 0.0 ): # TODO: user better precision (machine epsilon instead of == 0.0)
-                users_items.add((rnd_user,rnd_item))
-
-        # As LIL matrices works better if the (user,item) pairs are sorted
-        # first by user and then by item.
-        for user,item in sorted(users_items, key=lambda u_i: (u_i[0], u_i[1])):
-            u_prime[user,item] = 1
+        pool_keys = np.zeros(0, dtype=np.int64)
+        if (2 * n_pool >= n_unrated):
+            # Most of the unrated pairs are needed, so they are drawn directly
+            # instead of rejecting the rated ones.
+            unrated_keys = np.setdiff1d(np.arange(nusers * nitems, dtype=np.int64), rated_keys, assume_unique=True)
+            pool_keys = random_state.choice(unrated_keys, size=n_pool, replace=False)
+        while (len(pool_keys) < n_pool):
+            batch_size = max(2 * (n_pool - len(pool_keys)), 1000)
+            rnd_users = random_state.randint(0, high=nusers, size=batch_size).astype(np.int64)
+            rnd_items = random_state.randint(0, high=nitems, size=batch_size).astype(np.int64)
+            keys = rnd_users * nitems + rnd_items
+
+            # Rejecting the rated pairs.
+            if (len(rated_keys) > 0):
+                pos = np.searchsorted(rated_keys, keys)
+                pos[pos == len(rated_keys)] = 0
+                keys = keys[rated_keys[pos] != keys]
+            pool_keys = np.concatenate([pool_keys, keys])
+
+            # Removing duplicates while keeping the drawing order.
+            _, first = np.unique(pool_keys, return_index=True)
+            pool_keys = pool_keys[np.sort(first)]
+
+        pool_keys = np.sort(pool_keys[:n_pool])
+        users = (pool_keys // nitems).astype(np.int32)
+        items = (pool_keys % nitems).astype(np.int32)
+        u_prime = sp.csr_matrix((np.ones(len(pool_keys), dtype=np.int32), (users, items)),
+                                shape=(nusers,nitems),
+                                dtype=np.int32)
 
         logger.info("Pool created. Its size is: {}.".format(u_prime.nnz))
 
         return u_prime
+
+    def _rated_keys(self, URM):
+        """Returns the sorted linear keys `user * nitems + item` of the rated pairs.
+
+           Args:
+               * URM: the training set.
+
+           Args type:
+               * URM: Scipy.Sparse matrix
+
+           Returns:
+               A Numpy.Array of int64 keys sorted increasingly.
+        """
+        URM = sp.csr_matrix(URM)
+        nusers, nitems = URM.shape
+        users = np.repeat(np.arange(nusers, dtype=np.int64), np.diff(URM.indptr))
+        keys = users * nitems + URM.indices
+        return np.unique(keys[URM.data != 0.0])
@@ -15,8 +15,10 @@ import random as random
 
 import numpy as np
 import scipy.sparse as sps
-from .base import Recommender, check_matrix
-from .similarity import Cosine, Pearson, AdjustedCosine
+from .base import Recommender, check_matrix, linear_keys, top_k_indices, pairs_dot
+from .similarity import Cosine, LSHCosine, Pearson, AdjustedCosine, Jaccard, changed_columns
+from .Recommender_utils import topKIndices, topKMatrix
+from .._cython._scoring import sparse_scores, sparse_top_n
 
 
 class ItemKNNRecommender(Recommender):
@@ -38,9 +40,14 @@ class ItemKNNRecommender(Recommender):
             * distance: instance of the similarity function to apply.
             * W: the top-k most similar items for each item in a dense representation.
             * W_sparse: the top-k most similar items for each item in a sparse representation.
+            * incremental: update only the similarities of the items that
+                           changed since the previous fit.
+            * num_threads: number of threads used to compute the similarities.
+            * approximate: approximate similarity search to use, None for
+                           the exact similarities.
     """
 
-    def __init__(self, k=50, shrinkage=100, similarity='cosine', normalize=False, sparse_weights=True):
+    def __init__(self, k=50, shrinkage=100, similarity='cosine', normalize=False, sparse_weights=True, incremental=False, num_threads=1, approximate=None, lsh_bands=32, lsh_band_size=2):
         """Constructor of the ItemKNNRecommender class.
 
            Args:
@@ -51,6 +58,19 @@ class ItemKNNRecommender(Recommender):
                 * similarity: name of similarity function to apply.
                 * sparse_weights: consider sparse or dense representation to
                                   store the k-most-similar items.
+                * incremental: update only the similarities of the items that
+                               changed since the previous fit, instead of
+                               computing all of them again.
+                * num_threads: number of threads used to compute the
+                               similarities, all the available ones if None.
+                * approximate: approximate similarity search to use, only
+                               'lsh' (Locality Sensitive Hashing) with the
+                               cosine similarity is available. None computes
+                               the exact similarities.
+                * lsh_bands: number of bands of the LSH signatures, more
+                             bands find more neighbours.
+                * lsh_band_size: number of MinHash values in each band, larger
+                                 bands find less but more similar candidates.
 
            Args type:
                 * k = k
@@ -58,6 +78,11 @@ class ItemKNNRecommender(Recommender):
                 * normalize: bool
                 * similarity: str
                 * sparse_weights: bool
+                * incremental: bool
+                * num_threads: int
+                * approximate: str
+                * lsh_bands: int
+                * lsh_band_size: int
 
         """
         super(ItemKNNRecommender, self).__init__()
@@ -67,13 +92,29 @@ class ItemKNNRecommender(Recommender):
         self.dataset = None
         self.similarity_name = similarity
         self.sparse_weights = sparse_weights
+        self.incremental = incremental
+        self.num_threads = num_threads
+        self.approximate = approximate
         self.scores = None
-        if similarity == 'cosine':
-            self.distance = Cosine(shrinkage=self.shrinkage)
+        self._X_transformed = None
+        self._topk_weights = None
+        if approximate is not None:
+            if approximate != 'lsh' or similarity != 'cosine':
+                raise NotImplementedError('Approximate {} for distance {} not implemented'.format(approximate, similarity))
+            if incremental:
+                raise NotImplementedError('Approximate {} cannot be used with incremental updates'.format(approximate))
+            self.distance = LSHCosine(shrinkage=self.shrinkage,
+                                      num_threads=self.num_threads,
+                                      n_bands=lsh_bands,
+                                      band_size=lsh_band_size)
+        elif similarity == 'cosine':
+            self.distance = Cosine(shrinkage=self.shrinkage, num_threads=self.num_threads)
         elif similarity == 'pearson':
-            self.distance = Pearson(shrinkage=self.shrinkage)
+            self.distance = Pearson(shrinkage=self.shrinkage, num_threads=self.num_threads)
         elif similarity == 'adj-cosine':
-            self.distance = AdjustedCosine(shrinkage=self.shrinkage)
+            self.distance = AdjustedCosine(shrinkage=self.shrinkage, num_threads=self.num_threads)
+        elif similarity == 'jaccard':
+            self.distance = Jaccard(shrinkage=self.shrinkage, num_threads=self.num_threads)
         else:
             raise NotImplementedError('Distance {} not implemented'.format(similarity))
 
@@ -83,6 +124,9 @@ class ItemKNNRecommender(Recommender):
 
     def __str__(self):
         """ String representation of the class. """
+        if self.approximate is not None:
+            return "ItemKNN(similarity={},approximate={},k={},shrinkage={},normalize={},sparse_weights={})".format(
+                self.similarity_name, self.approximate, self.k, self.shrinkage, self.normalize, self.sparse_weights)
         return "ItemKNN(similarity={},k={},shrinkage={},normalize={},sparse_weights={})".format(
             self.similarity_name, self.k, self.shrinkage, self.normalize, self.sparse_weights)
 
@@ -95,6 +139,14 @@ class ItemKNNRecommender(Recommender):
             most similar items to it and stores them inside a matrix that can
             be either dense matrix or Scipy.Sparse.
 
+            When the weights are sparse, or incremental, the top-k most similar
+            items are computed directly by `ISimilarity.compute_topk`, so the
+            dense similarity matrix is never built.
+
+            If `self.incremental` is True and the model was already fitted, only
+            the top-k lists of the items affected by the changed ratings are
+            computed again (see `_update_topk`).
+
             Args:
                 * X: User-Rating Matrix for which we will train the model.
 
@@ -106,29 +158,74 @@ class ItemKNNRecommender(Recommender):
         self.dataset = X
         self.scores = None
 
-        # Calculation of the similarity matrix.
-        item_weights = self.distance.compute(X)
+        if (self.incremental):
+            # Update the top-k most similar items of the previous fit.
+            W_sparse = self._update_topk(X)
+            if not self.sparse_weights:
+                self.W = W_sparse.toarray()
+            else:
+                self.W_sparse = W_sparse
+        elif (self.sparse_weights):
+            # Calculation of the top-k most similar items of each item, without
+            # building the dense similarity matrix.
+            self.W_sparse = self.distance.compute_topk(X, self.k)
+        else:
+            # Calculation of the similarity matrix.
+            item_weights = self.distance.compute(X)
+
+            # for each column, keep only the top-k most similar items
+            top_k = topKIndices(item_weights, self.k)
+            self.W = topKMatrix(item_weights, top_k, forceSparseOutput=False)
+
+    def _update_topk(self, X):
+        """Updates the top-k most similar items of the previous fit.
+
+            The top-k lists are computed again only for the items that may
+            have a different list: the items whose columns changed in the
+            transformed matrix (see `ISimilarity.transform`), the items that
+            had one of them among their neighbours and the items that share a
+            user with one of them. The positive similarities of any other item
+            did not change, so its list is kept. Between fits, only the
+            transformed matrix and the sparse top-k weights are stored.
 
-        # for each column, keep only the top-k most similar items
-        idx_sorted = np.argsort(item_weights, axis=0)
+            Args:
+                * X: User-Rating Matrix for which we will train the model.
+
+            Args type:
+                * X: Scipy.Sparse.csr_matrix.
+
+            Returns:
+                A Scipy.Sparse.csr_matrix whose column j holds the top-k
+                most similar items of the item j.
+        """
+        X_transformed = self.distance.transform(X)
+        W_sparse = self._topk_weights
+        nitems = X.shape[1]
 
-        # Decide to use sparse or dense representations.
-        if not self.sparse_weights:
-            self.W = item_weights.copy()
-            # index of the items that don't belong to the top-k similar items of each column
-            not_top_k = idx_sorted[:-self.k, :]
-            # use numpy fancy indexing to zero-out the values in sim without using a for loop
-            self.W[not_top_k, np.arange(item_weights.shape[1])] = 0.0
+        if (W_sparse is None or W_sparse.shape[0] != nitems):
+            W_sparse = self.distance.compute_topk(X, self.k)
         else:
-            # iterate over each column and keep only the top-k similar items
-            values, rows, cols = [], [], []
-            nitems = self.dataset.shape[1]
-            for i in range(nitems):
-                top_k_idx = idx_sorted[-self.k:, i]
-                values.extend(item_weights[top_k_idx, i])
-                rows.extend(np.arange(nitems)[top_k_idx])
-                cols.extend(np.ones(self.k) * i)
-            self.W_sparse = sps.csr_matrix((values, (rows, cols)), shape=(nitems, nitems), dtype=np.float32)
+            changed = changed_columns(self._X_transformed, X_transformed)
+            if (len(changed) > 0):
+                # the items with a changed item among their neighbours are in
+                # the rows of the changed items, and the items that share a
+                # user with them are the ratings of their users.
+                users = np.unique(X_transformed[:, changed].indices)
+                affected = np.unique(np.concatenate([changed, W_sparse[changed].indices, X[users].indices]))
+                if (2 * len(affected) > nitems):
+                    # Too many items affected, computing everything again is faster.
+                    W_sparse = self.distance.compute_topk(X, self.k)
+                else:
+                    keep = np.ones(nitems, dtype=np.float32)
+                    keep[affected] = 0.0
+                    W_sparse = W_sparse.dot(sps.diags(keep)) + self.distance.compute_topk(X, self.k, columns=affected)
+                    W_sparse = W_sparse.tocsr()
+                    W_sparse.eliminate_zeros()
+
+        # keep the state needed to update the top-k lists in the next fit.
+        self._X_transformed = X_transformed
+        self._topk_weights = W_sparse
+        return W_sparse
 
     def calculate_scores_matrix(self):
         """Calculates the score for all the items for all the users.
@@ -140,22 +237,7 @@ class ItemKNNRecommender(Recommender):
            All the scores are stored inside `self.scores`, and can be either
            normalized or not.
         """
-        if self.sparse_weights:
-            self.scores = self.dataset.dot(self.W_sparse).toarray()
-        else:
-            self.scores = self.dataset.dot(self.W)
-
-        if self.normalize:
-            # normalization will keep the scores in the same range
-            # of value of the ratings in dataset
-            rated = self.dataset.copy()
-            rated.data = np.ones_like(rated.data)
-            if self.sparse_weights:
-                den = rated.dot(self.W_sparse).toarray()
-            else:
-                den = rated.dot(self.W)
-            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
-            self.scores /= den
+        self.scores = self._scores(self.dataset)
 
     def calculate_scores_batch(self,users):
         """Calculates the score for all the items for a batch of users.
@@ -165,10 +247,13 @@ class ItemKNNRecommender(Recommender):
            multiplication returns the scores for each user and all the items.
 
            The batch process is done by partitioning the list of users into
-           different batches, of an specific size, then
+           different batches, of an specific size, then each batch is scored
+           with `score_batch`.
 
            All the scores are stored inside `self.scores`, and can be either
-           normalized or not.
+           normalized or not. `self.scores` has one row for each user in
+           `users`, in the same order, and not one row for each user of the
+           dataset.
 
            Args:
                 * users: list containing the users indices inside the system.
@@ -176,32 +261,12 @@ class ItemKNNRecommender(Recommender):
             Args type:
                 * users: list of int.
         """
-        u_begin, u_stop = users.min(), users.max()
+        users = np.asarray(users)
         partition_size = 1000
-        partitions = np.arange(start=u_begin,stop=u_stop+1,step=partition_size,dtype=np.int32)
-        self.scores = np.zeros(shape=self.dataset.shape,dtype=np.float32,order='C')
-        for low_user in partitions:
-            # As u_stop is an index to take into account and indices ranges slices
-            # don't take into account the last, we need to sum one to include
-            # this index.
-            high_user = min(low_user + partition_size, u_stop+1) # to not exceed csr matrices indices.
-            profiles = self._get_user_ratings(range(low_user,high_user))
-            if self.sparse_weights:
-                self.scores[low_user:high_user] = profiles.dot(self.W_sparse).toarray()
-            else:
-                self.scores[low_user:high_user] = profiles.dot(self.W)
-
-            if self.normalize:
-                # normalization will keep the scores in the same range
-                # of value of the ratings in dataset
-                rated = profiles.copy()
-                rated.data = np.ones_like(rated.data)
-                if self.sparse_weights:
-                    den = rated.dot(self.W_sparse).toarray()
-                else:
-                    den = rated.dot(self.W)
-                den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
-                self.scores[low_user:high_user] /= den
+        self.scores = np.empty(shape=(len(users), self.dataset.shape[1]),dtype=np.float32,order='C')
+        for low in range(0, len(users), partition_size):
+            high = min(low + partition_size, len(users))
+            self._scores(self._get_user_ratings(users[low:high]), out=self.scores[low:high])
 
     def calculate_scores_user(self,user_id):
         """Calculates the score for all the items for a batch of users.
@@ -222,23 +287,7 @@ class ItemKNNRecommender(Recommender):
         """
 
         user_profile = self._get_user_ratings(user_id)
-
-        if self.sparse_weights:
-            self.scores = user_profile.dot(self.W_sparse).toarray().ravel()
-        else:
-            self.scores = user_profile.dot(self.W).ravel()
-
-        if self.normalize:
-            # normalization will keep the scores in the same range
-            # of value of the ratings in dataset
-            rated = user_profile.copy()
-            rated.data = np.ones_like(rated.data)
-            if self.sparse_weights:
-                den = rated.dot(self.W_sparse).toarray().ravel()
-            else:
-                den = rated.dot(self.W).ravel()
-            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
-            self.scores /= den
+        self.scores = self._scores(user_profile).ravel()
 
     def recommend(self, user_id, n=None, exclude_seen=True, score_mode='user'):
         """Makes a top-N recommendation list for a specific user.
@@ -278,6 +327,9 @@ class ItemKNNRecommender(Recommender):
     def recommend_new_user(self, user_profile, n=None, exclude_seen=True):
         """Makes a top-N recommendation list for a new user user.
 
+            With sparse weights and a given `n`, the list is built by
+            `sparse_top_n` as in `recommend_batch`.
+
             Args:
                 * user_id: user index to which we will build the top-N list.
                 * n: size of the list.
@@ -295,21 +347,13 @@ class ItemKNNRecommender(Recommender):
         # compute the scores using the dot product
         if self.sparse_weights:
             assert user_profile.shape[1] == self.W_sparse.shape[0], 'The number of items does not match!'
-            scores = user_profile.dot(self.W_sparse).toarray().ravel()
+            if n is not None:
+                ranking = sparse_top_n(user_profile, self.W_sparse, n, normalize=self.normalize,
+                                       exclude_seen=exclude_seen)[0]
+                return ranking[ranking >= 0]
         else:
             assert user_profile.shape[1] == self.W.shape[0], 'The number of items does not match!'
-            scores = user_profile.dot(self.W).ravel()
-        if self.normalize:
-            # normalization will keep the scores in the same range
-            # of value of the ratings in dataset
-            rated = user_profile.copy()
-            rated.data = np.ones_like(rated.data)
-            if self.sparse_weights:
-                den = rated.dot(self.W_sparse).toarray().ravel()
-            else:
-                den = rated.dot(self.W).ravel()
-            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
-            scores /= den
+        scores = self._scores(user_profile).ravel()
         # rank items
         ranking = scores.argsort()[::-1]
         if exclude_seen:
@@ -341,7 +385,128 @@ class ItemKNNRecommender(Recommender):
         elif (score_mode == 'matrix'):
             return self.scores[user_id,rated_indices]
 
-    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='user'):
+    def score_batch(self, user_ids):
+        """Calculates the scores of all the items for a block of users.
+
+            For the ItemKNN class the scores are the product between the profiles
+            of the users and the similarity matrix, normalized as in
+            `calculate_scores_user`.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray of shape (len(user_ids), n_items) with the
+                scores of each user for all the items.
+        """
+        return self._scores(self._get_user_ratings(user_ids))
+
+    def _scores(self, profiles, out=None):
+        """Calculates the scores of all the items for some user profiles.
+
+            With sparse weights the numerator and the denominator of the
+            normalized scores are computed by `sparse_scores` in a single pass
+            over the ratings of each user and the rows of `W_sparse`, without
+            building the intermediate sparse products.
+
+            Args:
+                * profiles: the rows of the URM of the users.
+                * out: optional buffer of shape (n_users, n_items) where the
+                       scores are written.
+
+            Args type:
+                * profiles: Scipy.sparse.csr_matrix
+                * out: Numpy.ndarray of float32
+
+            Returns:
+                A Numpy.ndarray of shape (n_users, n_items) with the scores.
+        """
+        if self.sparse_weights:
+            return sparse_scores(profiles, self.W_sparse, normalize=self.normalize,
+                                 out=out, num_threads=self.num_threads)
+
+        scores = profiles.dot(self.W)
+        if self.normalize:
+            # normalization will keep the scores in the same range
+            # of value of the ratings in dataset
+            rated = profiles.copy()
+            rated.data = np.ones_like(rated.data)
+            den = rated.dot(self.W)
+            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
+            scores /= den
+        if out is None:
+            return scores
+        out[...] = scores
+        return out
+
+    def recommend_batch(self, user_ids, n=None, exclude_seen=True):
+        """Makes a top-N recommendation list for each user in a block.
+
+            With sparse weights and a given `n`, the lists are built by
+            `sparse_top_n` without computing the dense scores of the block:
+            the seen items are skipped while the scores are accumulated and
+            only the best `n` items of each user are sorted. The items without
+            any weight from the items rated by the user have a score of 0, as
+            in the dense scores, and fill the lists when needed. Otherwise, see
+            `base.Recommender.recommend_batch`.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+                * n: size of the lists.
+                * exclude_seen: tells if we should remove already-seen items from
+                                the lists.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+                * n: int
+                * exclude_seen: bool
+
+            Returns:
+                A list with a ranked list of items, represented by their indices,
+                for each user in the block.
+        """
+        if (not self.sparse_weights or n is None):
+            return super(ItemKNNRecommender, self).recommend_batch(user_ids, n, exclude_seen)
+        top_n = sparse_top_n(self._get_user_ratings(user_ids), self.W_sparse, n,
+                             normalize=self.normalize, exclude_seen=exclude_seen,
+                             num_threads=self.num_threads)
+        return [ranking[ranking >= 0] for ranking in top_n]
+
+    def score_pairs(self, users, items):
+        """Calculates the predicted score of a list of user-item pairs.
+
+            For the ItemKNN class the score of each pair is the dot product
+            between the profile of the user and the column of the item in the
+            similarity matrix, normalized as in `calculate_scores_user`. The
+            full score vector of each user is never computed.
+
+            Args:
+                * users: the user index of each pair.
+                * items: the item index of each pair.
+
+            Args type:
+                * users: Numpy.ndarray of int
+                * items: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray with the predicted score of each pair.
+        """
+        W = self.W_sparse if self.sparse_weights else self.W
+        scores = pairs_dot(self.dataset, W, users, items)
+        if self.normalize:
+            # normalization will keep the scores in the same range
+            # of value of the ratings in dataset
+            rated = self.dataset.copy()
+            rated.data = np.ones_like(rated.data)
+            den = pairs_dot(rated, W, users, items)
+            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
+            scores /= den
+        return scores
+
+    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='pairs'):
         """Rates new user-item pairs.
 
            This function is part of the Co-Training process in which we rate
@@ -369,7 +534,9 @@ class ItemKNNRecommender(Recommender):
                * score_mode: the type of score prediction, 'user' represents by
                              sequentially user-by-user, 'batch' represents by
                              taking batches of users, 'matrix' represents to
-                             make the preditions by a matrix multiplication.
+                             make the preditions by a matrix multiplication,
+                             'pairs' represents to score only the user-item
+                             pairs in the pool (see `score_pairs`).
 
            Args type:
                * unlabeled_list: Scipy.Sparse matrix.
@@ -392,7 +559,10 @@ class ItemKNNRecommender(Recommender):
         # it can decrease, example:
         # users = [0,0,0,0,0, 1,1,1, 2], items = [1,6,8,9,19, 0,4,5, 2]
 
-        if (score_mode == 'user'):
+        if (score_mode == 'pairs'):
+            filtered_scores = self.score_pairs(users, items)
+
+        elif (score_mode == 'user'):
             filtered_scores = np.zeros(shape=n_scores,dtype=np.float32)
             curr_user = None
             i = 0
@@ -408,7 +578,9 @@ class ItemKNNRecommender(Recommender):
             filtered_scores = []
             uniq_users, user_to_idx = np.unique(users,return_inverse=True)
             self.calculate_scores_batch(uniq_users)
-            filtered_scores = self.scores[users,items]
+            # As scores is not a n_user/n_item matrix but a partial matrix
+            # then we will need to see which user is mapped to which index.
+            filtered_scores = self.scores[user_to_idx,items]
 
         elif (score_mode == 'matrix'):
             if (self.scores is None):
@@ -453,15 +625,12 @@ class ItemKNNRecommender(Recommender):
         # Filtered the scores to have the n-most and p-most.
         # The p-most are sorted decreasingly.
         # The n-most are sorted incrementally.
-        p_sorted_scores = p_filtered_scores.argsort()[::-1]
-        n_sorted_scores = n_filtered_scores.argsort()
-
-        # Taking the p_most positive, in decreasing order, if len(p_sorted_scores) < p_most
-        # the final array will have length of len(p_sorted_scores)
-        p_sorted_scores = p_sorted_scores[:p_most]
+        # Taking the p_most positive, in decreasing order, if len(p_filtered_scores) < p_most
+        # the final array will have length of len(p_filtered_scores)
+        p_sorted_scores = top_k_indices(p_filtered_scores, p_most, largest=True)
 
         # Similar to p_most but with n_most.
-        n_sorted_scores = n_sorted_scores[:n_most]
+        n_sorted_scores = top_k_indices(n_filtered_scores, n_most, largest=False)
 
         scores = \
          [(p_users[i], p_items[i], p_filtered_scores[i] if p_filtered_scores[i] < 5.0 else 5.0) for i in p_sorted_scores] +\
@@ -472,9 +641,9 @@ class ItemKNNRecommender(Recommender):
         meta['pos_labels'] = len(p_sorted_scores)
         meta['neg_labels'] = len(n_sorted_scores)
         meta['total_labels'] = len(p_sorted_scores) + len(n_sorted_scores)
-        meta['pos_set'] = set(zip(p_users, p_items))
-        meta['neg_set'] = set(zip(n_users, n_items))
-        meta['neutral_set'] = set(zip(neutral_users, neutral_items))
+        meta['pos_keys'] = linear_keys(p_users, p_items, unlabeled_list.shape[1])
+        meta['neg_keys'] = linear_keys(n_users, n_items, unlabeled_list.shape[1])
+        meta['neutral_keys'] = linear_keys(neutral_users, neutral_items, unlabeled_list.shape[1])
 
         # We sort the indices by user, then by item in order to make the
         # assignment to the LIL matrix faster.
@@ -4,7 +4,8 @@ mf.py
 
 Description: This file contains the definition and implementation of
              Matrix-Factorization-based Recommenders, such as FunkSVD,
-             AsymmetricSVD, Alternating Least Squares, BPR-MF.
+             AsymmetricSVD, Alternating Least Squares, BPR-MF (compiled and
+             NumPy mini-batch).
 
 Created by: Massimo Quadrana.
 Modified by: Fernando Pérez.
@@ -12,9 +13,12 @@ Modified by: Fernando Pérez.
 Last modified on 05/09/2017.
 """
 
+import time
+
 import numpy as np
-from .base import Recommender, check_matrix
-from .._cython._mf import FunkSVD_sgd, AsySVD_sgd, AsySVD_compute_user_factors, BPRMF_sgd
+from .base import Recommender, check_matrix, linear_keys, top_k_indices, mask_seen_scores, top_n_rows, label_extremes
+from ..utils import metrics
+from .._cython._mf import FunkSVD_sgd, AsySVD_sgd, AsySVD_compute_user_factors, BPRMF_sgd, IALS_least_squares
 import logging
 
 logger = logging.getLogger(__name__)
@@ -23,6 +27,182 @@ logging.basicConfig(
     format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
 
 
+def _grow_factors(F, n_rows, init_mean, init_std):
+    """Adapts the latent factors of a previous fit to a new number of rows.
+
+        The factors of the rows that already existed are kept, the factors of
+        the new rows are drawn from a Normal distribution.
+
+        Args:
+            * F: the latent factors of the previous fit.
+            * n_rows: the number of rows of the new factors.
+            * init_mean: mean used to initialize the new latent factors.
+            * init_std: standard deviation used to initialize the new latent
+                        factors.
+
+        Args type:
+            * F: Numpy.ndarray
+            * n_rows: int
+            * init_mean: float
+            * init_std: float
+
+        Returns:
+            A Numpy.ndarray of shape (n_rows, F.shape[1]).
+    """
+    if (F.shape[0] >= n_rows):
+        return F[:n_rows]
+    new_rows = np.random.normal(init_mean, init_std, size=(n_rows - F.shape[0], F.shape[1]))
+    return np.vstack([F, new_rows.astype(F.dtype)])
+
+
+def _warm_start(recommender, factors, sizes):
+    """Returns the initial latent factors and the number of iterations of a fit.
+
+        If the recommender has warm start enabled and was already fitted, the
+        latent factors of the previous fit are reused as initial factors,
+        adapted to the new shape of the dataset, and the model is trained
+        for `warm_iters` iterations. Otherwise, the factors are not given
+        (they will be randomly initialized) and the model is trained for
+        `iters` iterations.
+
+        Args:
+            * recommender: the recommender to fit.
+            * factors: the names of the attributes that hold the factors.
+            * sizes: the number of rows of each one of the factors.
+
+        Args type:
+            * recommender: A Recommender instance.
+            * factors: list of str
+            * sizes: list of int
+
+        Returns:
+            A list with the initial factors (or None) and the number of
+            iterations.
+    """
+    previous = [getattr(recommender, name, None) for name in factors]
+    if (not recommender.warm_start or
+            any(F is None or F.shape[1] != recommender.num_factors for F in previous)):
+        return [None] * len(factors), recommender.iters
+
+    np.random.seed(recommender.rnd_seed)
+    initial = [_grow_factors(F, n_rows, recommender.init_mean, recommender.init_std)
+               for F, n_rows in zip(previous, sizes)]
+    iters = recommender.warm_iters
+    if (iters is None):
+        iters = max(1, recommender.iters // 10)
+    return initial, iters
+
+
+class _EpochMonitor(object):
+    """Keeps the per-epoch trace of a fit and stops it early on a validation set.
+
+        After each epoch the trace receives the epoch, the training loss and
+        the seconds elapsed since the start of the fit. If a validation set is
+        given, every `eval_every` epochs the top-`at` lists of a sample of its
+        users are built with the current factors (excluding the items seen in
+        the training set) and evaluated with `metric`. The factors of the best
+        evaluation are copied, and the fit is stopped after `patience`
+        evaluations without improvement.
+
+        Args:
+            * recommender: the recommender being fitted, it holds the training
+                           set in `dataset` and the seed in `rnd_seed`.
+            * score_fn: function that returns the scores of all the items
+                        for some users, given the users and the factors.
+            * validation: User-Rating Matrix with the validation ratings, or
+                          None to only keep the trace.
+            * metric: one of 'auc', 'precision', 'recall', 'map', 'ndcg' or
+                      'rr'.
+            * at: size of the top-N lists.
+            * patience: evaluations without improvement before stopping.
+            * eval_every: number of epochs between two evaluations.
+            * n_users: number of validation users to sample.
+
+        Args type:
+            * recommender: A Recommender instance.
+            * score_fn: function
+            * validation: Scipy.Sparse matrix
+            * metric: str
+            * at: int
+            * patience: int
+            * eval_every: int
+            * n_users: int
+    """
+    _metrics = {
+        'auc': lambda is_relevant, pos_items, ranked: metrics.roc_auc(is_relevant),
+        'precision': lambda is_relevant, pos_items, ranked: metrics.precision(is_relevant),
+        'recall': lambda is_relevant, pos_items, ranked: metrics.recall(is_relevant, pos_items),
+        'map': lambda is_relevant, pos_items, ranked: metrics.map(is_relevant, pos_items),
+        'ndcg': lambda is_relevant, pos_items, ranked: metrics.ndcg(ranked, pos_items, at=len(ranked)),
+        'rr': lambda is_relevant, pos_items, ranked: metrics.rr(is_relevant),
+    }
+
+    def __init__(self, recommender, score_fn, validation=None, metric='map', at=10, patience=3, eval_every=1,
+                 n_users=1000):
+        assert metric in self._metrics, 'Unsupported metric: {}'.format(metric)
+        self.recommender = recommender
+        self.score_fn = score_fn
+        self.metric = metric
+        self.at = at
+        self.patience = patience
+        self.eval_every = max(1, eval_every)
+        self.trace = []
+        self.best_value = -np.inf
+        self.best_epoch = None
+        self.best_factors = None
+        self.bad_evals = 0
+        self.start = time.time()
+        self.validation = None
+        if validation is not None:
+            self.validation = check_matrix(validation, 'csr', dtype=np.float32)
+            users = np.flatnonzero(np.diff(self.validation.indptr))
+            if len(users) > n_users:
+                rng = np.random.RandomState(recommender.rnd_seed)
+                users = np.sort(rng.choice(users, size=n_users, replace=False))
+            self.users = users
+
+    def _evaluate(self, factors):
+        scores = np.asarray(self.score_fn(self.users, factors), dtype=np.float32)
+        mask_seen_scores(scores, self.recommender.dataset[self.users])
+        ranked_lists = top_n_rows(scores, self.at)
+        metric = self._metrics[self.metric]
+        values = []
+        for user, ranked in zip(self.users, ranked_lists):
+            pos_items = self.validation.indices[self.validation.indptr[user]:self.validation.indptr[user + 1]]
+            is_relevant = np.in1d(ranked, pos_items, assume_unique=True)
+            values.append(metric(is_relevant, pos_items, ranked))
+        return float(np.mean(values))
+
+    def __call__(self, epoch, loss, *factors):
+        """Records an epoch and returns True if the fit must be stopped."""
+        entry = {'epoch': epoch + 1, 'loss': float(loss), 'time': time.time() - self.start}
+        self.trace.append(entry)
+        if self.validation is None or (epoch + 1) % self.eval_every != 0:
+            return False
+
+        value = self._evaluate(factors)
+        entry[self.metric] = value
+        logger.info('Epoch {} - loss: {:.4f} - validation {}@{}: {:.4f}'.format(
+            epoch + 1, loss, self.metric, self.at, value))
+        if value > self.best_value:
+            self.best_value = value
+            self.best_epoch = epoch + 1
+            self.best_factors = [F.copy() for F in factors]
+            self.bad_evals = 0
+            return False
+        self.bad_evals += 1
+        return self.bad_evals >= self.patience
+
+    def finish(self, factors):
+        """Stores the trace on the recommender and returns the factors to keep,
+        the best ones if there was a validation set."""
+        self.recommender.trace = self.trace
+        self.recommender.best_epoch = self.best_epoch
+        if self.best_factors is None:
+            return factors
+        return self.best_factors
+
+
 class FunkSVD(Recommender):
     """
     FunkSVD model
@@ -43,7 +223,10 @@ class FunkSVD(Recommender):
                  init_mean=0.0,
                  init_std=0.1,
                  lrate_decay=1.0,
-                 rnd_seed=42):
+                 rnd_seed=42,
+                 warm_start=False,
+                 warm_iters=None,
+                 n_threads=1):
         """
         Initialize the model
         :param num_factors: number of latent factors
@@ -54,6 +237,9 @@ class FunkSVD(Recommender):
         :param init_std: standard deviation used to initialize the latent factors
         :param lrate_decay: learning rate decay
         :param rnd_seed: random seed
+        :param warm_start: `True` to initialize the latent factors with the ones of the previous fit
+        :param warm_iters: number of iterations when warm starting, if `None` it is a tenth of `iters`
+        :param n_threads: number of threads running SGD in parallel without locks (Hogwild!), all the available ones if `None`
         """
         super(FunkSVD, self).__init__()
         self.num_factors = num_factors
@@ -64,6 +250,9 @@ class FunkSVD(Recommender):
         self.init_std = init_std
         self.lrate_decay = lrate_decay
         self.rnd_seed = rnd_seed
+        self.warm_start = warm_start
+        self.warm_iters = warm_iters
+        self.n_threads = n_threads
 
     def short_str(self):
         """ Short string used for dictionaries. """
@@ -77,23 +266,50 @@ class FunkSVD(Recommender):
             self.rnd_seed
         )
 
-    def fit(self, X):
+    def fit(self, X, validation=None, metric='map', at=10, patience=3, eval_every=1, n_eval_users=1000):
         """Trains and builds the model given a dataset.
 
             The fit function inside the FunkSVD class performs SGD to learn the
-            low-rank matrices U and V.
+            low-rank matrices U and V. If `warm_start` is enabled, the SGD starts
+            from the matrices of the previous fit.
+
+            The loss and the elapsed time of each epoch are stored in `trace`.
+            If a validation set is given, the model is evaluated on a sample of
+            its users every `eval_every` epochs, the training stops after
+            `patience` evaluations without improvement and the matrices of the
+            best evaluation are kept (its epoch is stored in `best_epoch`).
 
             Args:
                 * X: User-Rating Matrix for which we will train the model.
+                * validation: User-Rating Matrix with the validation ratings.
+                * metric: validation metric, one of 'auc', 'precision',
+                          'recall', 'map', 'ndcg' or 'rr'.
+                * at: size of the top-N lists evaluated.
+                * patience: evaluations without improvement before stopping.
+                * eval_every: number of epochs between two evaluations.
+                * n_eval_users: number of validation users to sample.
 
             Args type:
                 * X: Scipy.Sparse matrix.
+                * validation: Scipy.Sparse matrix.
+                * metric: str
+                * at: int
+                * patience: int
+                * eval_every: int
+                * n_eval_users: int
         """
         X = check_matrix(X, 'csr', dtype=np.float32)
         self.dataset = X
-        self.U, self.V = FunkSVD_sgd(X, self.num_factors, self.lrate, self.reg, self.iters, self.init_mean,
-                                     self.init_std,
-                                     self.lrate_decay, self.rnd_seed)
+        M, N = X.shape
+        (U_init, V_init), iters = _warm_start(self, ['U', 'V'], [M, N])
+        monitor = _EpochMonitor(self, lambda users, F: np.dot(F[0][users], F[1].T), validation,
+                                metric=metric, at=at, patience=patience, eval_every=eval_every,
+                                n_users=n_eval_users)
+        U, V = FunkSVD_sgd(X, self.num_factors, self.lrate, self.reg, iters, self.init_mean,
+                           self.init_std,
+                           self.lrate_decay, self.rnd_seed,
+                           U_init=U_init, V_init=V_init, n_threads=self.n_threads, callback=monitor)
+        self.U, self.V = monitor.finish([U, V])
 
     def user_score(self, user_id):
         return np.dot(self.U[user_id], self.V.T)
@@ -146,7 +362,45 @@ class FunkSVD(Recommender):
         scores = np.dot(self.U[user_id], self.V.T)
         return scores[rated_indices]
 
-    def label(self, unlabeled_list, binary_ratings=False, n=None, exclude_seen=True, p_most=1, n_most=3, score_mode='user'):
+    def score_batch(self, user_ids):
+        """Calculates the scores of all the items for a block of users.
+
+            For the FunkSVD class the scores are the product between the latent
+            factors of the users and the latent factors of all the items.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray of shape (len(user_ids), n_items) with the
+                scores of each user for all the items.
+        """
+        return np.dot(self.U[user_ids], self.V.T)
+
+    def score_pairs(self, users, items):
+        """Calculates the predicted score of a list of user-item pairs.
+
+            For the FunkSVD class the score of each pair is the dot product
+            between the latent factors of the user and the item, computed
+            row-wise on the gathered factors.
+
+            Args:
+                * users: the user index of each pair.
+                * items: the item index of each pair.
+
+            Args type:
+                * users: Numpy.ndarray of int
+                * items: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray with the predicted score of each pair.
+        """
+        return np.einsum('ij,ij->i', self.U[users], self.V[items])
+
+    def label(self, unlabeled_list, binary_ratings=False, n=None, exclude_seen=True, p_most=1, n_most=3, score_mode='pairs'):
         """Rates new user-item pairs.
 
            This function is part of the Co-Training process in which we rate
@@ -174,7 +428,9 @@ class FunkSVD(Recommender):
                * score_mode: the type of score prediction, 'user' represents by
                              sequentially user-by-user, 'batch' represents by
                              taking batches of users, 'matrix' represents to
-                             make the preditions by a matrix multiplication.
+                             make the preditions by a matrix multiplication,
+                             'pairs' represents to score only the user-item
+                             pairs in the pool (see `score_pairs`).
 
            Args type:
                * unlabeled_list: Scipy.Sparse matrix.
@@ -196,7 +452,10 @@ class FunkSVD(Recommender):
         # U'. Now we will filter the scores by keeping only the scores of the
         # items presented in U'. This will be an array where:
         # filtered_scores[i] = scores[users[i],items[i]]
-        if (score_mode == 'user'):
+        if (score_mode == 'pairs'):
+            filtered_scores = self.score_pairs(users, items)
+
+        elif (score_mode == 'user'):
             filtered_scores = np.zeros(shape=n_scores,dtype=np.float32)
             curr_user = None
             i = 0
@@ -250,15 +509,12 @@ class FunkSVD(Recommender):
         # Filtered the scores to have the n-most and p-most.
         # The p-most are sorted decreasingly.
         # The n-most are sorted incrementally.
-        p_sorted_scores = p_filtered_scores.argsort()[::-1]
-        n_sorted_scores = n_filtered_scores.argsort()
-
-        # Taking the p_most positive, in decreasing order, if len(p_sorted_scores) < p_most
-        # the final array will have length of len(p_sorted_scores)
-        p_sorted_scores = p_sorted_scores[:p_most]
+        # Taking the p_most positive, in decreasing order, if len(p_filtered_scores) < p_most
+        # the final array will have length of len(p_filtered_scores)
+        p_sorted_scores = top_k_indices(p_filtered_scores, p_most, largest=True)
 
         # Similar to p_most but with n_most.
-        n_sorted_scores = n_sorted_scores[:n_most]
+        n_sorted_scores = top_k_indices(n_filtered_scores, n_most, largest=False)
 
         scores = \
          [(p_users[i], p_items[i], p_filtered_scores[i] if p_filtered_scores[i] < 5.0 else 5.0) for i in p_sorted_scores] +\
@@ -269,9 +525,9 @@ class FunkSVD(Recommender):
         meta['pos_labels'] = len(p_sorted_scores)
         meta['neg_labels'] = len(n_sorted_scores)
         meta['total_labels'] = len(p_sorted_scores) + len(n_sorted_scores)
-        meta['pos_set'] = set(zip(p_users, p_items))
-        meta['neg_set'] = set(zip(n_users, n_items))
-        meta['neutral_set'] = set(zip(neutral_users, neutral_items))
+        meta['pos_keys'] = linear_keys(p_users, p_items, unlabeled_list.shape[1])
+        meta['neg_keys'] = linear_keys(n_users, n_items, unlabeled_list.shape[1])
+        meta['neutral_keys'] = linear_keys(neutral_users, neutral_items, unlabeled_list.shape[1])
 
         # We sort the indices by user, then by item in order to make the
         # assignment to the LIL matrix faster.
@@ -301,7 +557,10 @@ class AsySVD(Recommender):
                  init_mean=0.0,
                  init_std=0.1,
                  lrate_decay=1.0,
-                 rnd_seed=42):
+                 rnd_seed=42,
+                 warm_start=False,
+                 warm_iters=None,
+                 n_threads=1):
         '''
         Initialize the model
         :param num_factors: number of latent factors
@@ -312,6 +571,9 @@ class AsySVD(Recommender):
         :param init_std: standard deviation used to initialize the latent factors
         :param lrate_decay: learning rate decay
         :param rnd_seed: random seed
+        :param warm_start: `True` to initialize the latent factors with the ones of the previous fit
+        :param warm_iters: number of iterations when warm starting, if `None` it is a tenth of `iters`
+        :param n_threads: number of threads running SGD in parallel without locks (Hogwild!), all the available ones if `None`
         '''
         super(AsySVD, self).__init__()
         self.num_factors = num_factors
@@ -322,6 +584,9 @@ class AsySVD(Recommender):
         self.init_std = init_std
         self.lrate_decay = lrate_decay
         self.rnd_seed = rnd_seed
+        self.warm_start = warm_start
+        self.warm_iters = warm_iters
+        self.n_threads = n_threads
 
     def short_str(self):
         return "AsySVD"
@@ -333,15 +598,24 @@ class AsySVD(Recommender):
             self.rnd_seed
         )
 
-    def fit(self, R):
+    def fit(self, R, validation=None, metric='map', at=10, patience=3, eval_every=1, n_eval_users=1000):
+        # see `FunkSVD.fit` for the validation arguments
         R = check_matrix(R, 'csr', dtype=np.float32)
         self.dataset = R
-        self.X, self.Y = AsySVD_sgd(R, self.num_factors, self.lrate, self.reg, self.iters, self.init_mean,
-                                    self.init_std,
-                                    self.lrate_decay, self.rnd_seed)
-        # precompute the user factors
-        M = R.shape[0]
-        self.U = np.vstack([AsySVD_compute_user_factors(R[i], self.Y) for i in range(M)])
+        N = R.shape[1]
+        (X_init, Y_init), iters = _warm_start(self, ['X', 'Y'], [N, N])
+        # the user factors of the sampled users are computed from their ratings
+        score_fn = lambda users, F: np.dot(np.atleast_2d(AsySVD_compute_user_factors(R[users], F[1])), F[0].T)
+        monitor = _EpochMonitor(self, score_fn, validation,
+                                metric=metric, at=at, patience=patience, eval_every=eval_every,
+                                n_users=n_eval_users)
+        X, Y = AsySVD_sgd(R, self.num_factors, self.lrate, self.reg, iters, self.init_mean,
+                          self.init_std,
+                          self.lrate_decay, self.rnd_seed,
+                          X_init=X_init, Y_init=Y_init, n_threads=self.n_threads, callback=monitor)
+        self.X, self.Y = monitor.finish([X, Y])
+        # precompute the user factors of all the users at once
+        self.U = np.atleast_2d(AsySVD_compute_user_factors(R, self.Y))
 
     def user_score(self, user_id):
         return np.dot(self.X, self.U[user_id].T)
@@ -358,16 +632,19 @@ class AsySVD(Recommender):
         scores = np.dot(self.X, self.U[user_id].T)
         return scores[rated_indices]
 
+    def score_batch(self, user_ids):
+        return np.dot(self.U[user_ids], self.X.T)
+
+    def score_pairs(self, users, items):
+        return np.einsum('ij,ij->i', self.U[users], self.X[items])
+
     def label(self, unlabeled_list, binary_ratings=False, n=None, exclude_seen=True, p_most=1, n_most=3):
         unlabeled_list = check_matrix(unlabeled_list, 'lil', dtype=np.float32)
         users,items = unlabeled_list.nonzero()
-        uniq_users, user_to_idx = np.unique(users,return_inverse=True)
-        # At this point, we have all the predicted scores for the users inside
-        # U'. Now we will filter the scores by keeping only the scores of the
-        # items presented in U'. This will be an array where:
+        # We only compute the predicted scores of the pairs inside U'. This
+        # will be an array where:
         # filtered_scores[i] = scores[users[i],items[i]]
-        scores = np.dot(self.X, self.U[uniq_users].T)
-        filtered_scores = scores[user_to_idx,items]
+        filtered_scores = self.score_pairs(users, items)
 
         # positive ratings: explicit ->[4,5], implicit -> [0.75,1]
         # negative ratings: explicit -> [1,2,3], implicit -> [0,0.75)
@@ -394,15 +671,12 @@ class AsySVD(Recommender):
         # Filtered the scores to have the n-most and p-most.
         # The p-most are sorted decreasingly.
         # The n-most are sorted incrementally.
-        p_sorted_scores = p_filtered_scores.argsort()[::-1]
-        n_sorted_scores = n_filtered_scores.argsort()
-
-        # Taking the p_most positive, in decreasing order, if len(p_sorted_scores) < p_most
-        # the final array will have length of len(p_sorted_scores)
-        p_sorted_scores = p_sorted_scores[:p_most]
+        # Taking the p_most positive, in decreasing order, if len(p_filtered_scores) < p_most
+        # the final array will have length of len(p_filtered_scores)
+        p_sorted_scores = top_k_indices(p_filtered_scores, p_most, largest=True)
 
         # Similar to p_most but with n_most.
-        n_sorted_scores = n_sorted_scores[:n_most]
+        n_sorted_scores = top_k_indices(n_filtered_scores, n_most, largest=False)
 
         scores = [(p_users[i], p_items[i], p_filtered_scores[i]) for i in p_sorted_scores ] + [(n_users[i], n_items[i], n_filtered_scores[i]) for i in n_sorted_scores]
 
@@ -434,7 +708,12 @@ class IALS_numpy(Recommender):
                  epsilon=1.0,
                  init_mean=0.0,
                  init_std=0.1,
-                 rnd_seed=42):
+                 rnd_seed=42,
+                 warm_start=False,
+                 warm_iters=None,
+                 solver='cholesky',
+                 cg_steps=3,
+                 n_threads=1):
         '''
         Initialize the model
         :param num_factors: number of latent factors
@@ -446,10 +725,16 @@ class IALS_numpy(Recommender):
         :param init_mean: mean used to initialize the latent factors
         :param init_std: standard deviation used to initialize the latent factors
         :param rnd_seed: random seed
+        :param warm_start: `True` to initialize the latent factors with the ones of the previous fit
+        :param warm_iters: number of iterations when warm starting, if `None` it is a tenth of `iters`
+        :param solver: least-squares solver of each row, 'cholesky' (exact) or 'cg' (conjugate gradient)
+        :param cg_steps: number of conjugate-gradient steps for each row when `solver` is 'cg'
+        :param n_threads: number of threads among which the rows are distributed, all the available ones if `None`
         '''
 
         super(IALS_numpy, self).__init__()
         assert scaling in ['linear', 'log'], 'Unsupported scaling: {}'.format(scaling)
+        assert solver in ['cholesky', 'cg'], 'Unsupported solver: {}'.format(solver)
 
         self.num_factors = num_factors
         self.reg = reg
@@ -460,6 +745,11 @@ class IALS_numpy(Recommender):
         self.init_mean = init_mean
         self.init_std = init_std
         self.rnd_seed = rnd_seed
+        self.warm_start = warm_start
+        self.warm_iters = warm_iters
+        self.solver = solver
+        self.cg_steps = cg_steps
+        self.n_threads = n_threads
 
     def short_str(self):
         return "WRMK-iALS"
@@ -482,7 +772,8 @@ class IALS_numpy(Recommender):
         C.data = 1.0 + self.alpha * np.log(1.0 + C.data / self.epsilon)
         return C
 
-    def fit(self, R):
+    def fit(self, R, validation=None, metric='map', at=10, patience=3, eval_every=1, n_eval_users=1000):
+        # see `FunkSVD.fit` for the validation arguments
         R = check_matrix(R, 'csr', dtype=np.float32)
         self.dataset = R
         # compute the confidence matrix
@@ -494,17 +785,32 @@ class IALS_numpy(Recommender):
         Ct = C.T.tocsr()
         M, N = R.shape
 
-        # set the seed
-        np.random.seed(self.rnd_seed)
-
-        # initialize the latent factors
-        self.X = np.random.normal(self.init_mean, self.init_std, size=(M, self.num_factors))
-        self.Y = np.random.normal(self.init_mean, self.init_std, size=(N, self.num_factors))
-
-        for it in range(self.iters):
-            self.X = self._lsq_solver_fast(C, self.X, self.Y, self.reg)
-            self.Y = self._lsq_solver_fast(Ct, self.Y, self.X, self.reg)
+        (X_init, Y_init), iters = _warm_start(self, ['X', 'Y'], [M, N])
+        if (X_init is not None):
+            # reuse the latent factors of the previous fit
+            self.X = np.ascontiguousarray(X_init, dtype=np.float64)
+            self.Y = np.ascontiguousarray(Y_init, dtype=np.float64)
+        else:
+            # set the seed
+            np.random.seed(self.rnd_seed)
+
+            # initialize the latent factors
+            self.X = np.random.normal(self.init_mean, self.init_std, size=(M, self.num_factors))
+            self.Y = np.random.normal(self.init_mean, self.init_std, size=(N, self.num_factors))
+
+        # the rows of X and Y are solved in place by the compiled solver
+        monitor = _EpochMonitor(self, lambda users, F: np.dot(F[0][users], F[1].T), validation,
+                                metric=metric, at=at, patience=patience, eval_every=eval_every,
+                                n_users=n_eval_users)
+        for it in range(iters):
+            IALS_least_squares(C, self.X, self.Y, self.reg, solver=self.solver, cg_steps=self.cg_steps,
+                               n_threads=self.n_threads)
+            IALS_least_squares(Ct, self.Y, self.X, self.reg, solver=self.solver, cg_steps=self.cg_steps,
+                               n_threads=self.n_threads)
             logger.debug('Finished iter {}'.format(it + 1))
+            if monitor(it, self._loss(C, self.X, self.Y, self.reg), self.X, self.Y):
+                break
+        self.X, self.Y = monitor.finish([self.X, self.Y])
 
     def user_score(self, user_id):
         return np.dot(self.X[user_id], self.Y.T)
@@ -521,52 +827,21 @@ class IALS_numpy(Recommender):
         scores = np.dot(self.X[user_id], self.Y.T)
         return scores[rated_indices]
 
-    def _lsq_solver(self, C, X, Y, reg):
-        # precompute YtY
-        rows, factors = X.shape
-        YtY = np.dot(Y.T, Y)
-
-        for i in range(rows):
-            # accumulate YtCiY + reg*I in A
-            A = YtY + reg * np.eye(factors)
-
-            # accumulate Yt*Ci*p(i) in b
-            b = np.zeros(factors)
-
-            for j, cij in self._nonzeros(C, i):
-                vj = Y[j]
-                A += (cij - 1.0) * np.outer(vj, vj)
-                b += cij * vj
-
-            X[i] = np.linalg.solve(A, b)
-        return X
-
-    def _lsq_solver_fast(self, C, X, Y, reg):
-        # precompute YtY
-        rows, factors = X.shape
-        YtY = np.dot(Y.T, Y)
-
-        for i in range(rows):
-            # accumulate YtCiY + reg*I in A
-            A = YtY + reg * np.eye(factors)
+    def score_batch(self, user_ids):
+        return np.dot(self.X[user_ids], self.Y.T)
 
-            start, end = C.indptr[i], C.indptr[i + 1]
-            j = C.indices[start:end]  # indices of the non-zeros in Ci
-            ci = C.data[start:end]  # non-zeros in Ci
+    def score_pairs(self, users, items):
+        return np.einsum('ij,ij->i', self.X[users], self.Y[items])
 
-            Yj = Y[j]  # only the factors with non-zero confidence
-            # compute Yt(Ci-I)Y
-            aux = np.dot(Yj.T, np.diag(ci - 1.0))
-            A += np.dot(aux, Yj)
-            # compute YtCi
-            b = np.dot(Yj.T, ci)
-
-            X[i] = np.linalg.solve(A, b)
-        return X
-
-    def _nonzeros(self, R, row):
-        for i in range(R.indptr[row], R.indptr[row + 1]):
-            yield (R.indices[i], R.data[i])
+    def _loss(self, C, X, Y, reg):
+        # weighted squared error of the whole preference matrix plus the
+        # regularization, where the sum over the zeros is computed as the sum
+        # over all the entries, trace(XtX YtY), minus the sum over the non-zeros
+        rows = np.repeat(np.arange(C.shape[0]), np.diff(C.indptr))
+        pred = np.einsum('ij,ij->i', X[rows], Y[C.indices])
+        loss = np.sum(np.dot(X.T, X) * np.dot(Y.T, Y)) - np.dot(pred, pred)
+        loss += np.dot(C.data, (1.0 - pred) ** 2)
+        return loss + reg * (np.sum(X ** 2) + np.sum(Y ** 2))
 
 
 class BPRMF(Recommender):
@@ -590,7 +865,10 @@ class BPRMF(Recommender):
                  init_std=0.1,
                  lrate_decay=1.0,
                  rnd_seed=42,
-                 verbose=True):
+                 verbose=True,
+                 warm_start=False,
+                 warm_iters=None,
+                 n_threads=1):
         '''
         Initialize the model
         :param num_factors: number of latent factors
@@ -608,6 +886,9 @@ class BPRMF(Recommender):
         :param lrate_decay: learning rate decay
         :param rnd_seed: random seed
         :param verbose: controls verbosity in output
+        :param warm_start: `True` to initialize the latent factors with the ones of the previous fit
+        :param warm_iters: number of iterations when warm starting, if `None` it is a tenth of `iters`
+        :param n_threads: number of threads running SGD in parallel without locks (Hogwild!), all the available ones if `None`
         '''
         super(BPRMF, self).__init__()
         self.num_factors = num_factors
@@ -625,6 +906,9 @@ class BPRMF(Recommender):
         self.lrate_decay = lrate_decay
         self.rnd_seed = rnd_seed
         self.verbose = verbose
+        self.warm_start = warm_start
+        self.warm_iters = warm_iters
+        self.n_threads = n_threads
 
     def short_str(self):
         return "BPRMF"
@@ -642,25 +926,36 @@ class BPRMF(Recommender):
             self.verbose
         )
 
-    def fit(self, R):
+    def fit(self, R, validation=None, metric='map', at=10, patience=3, eval_every=1, n_eval_users=1000):
+        # see `FunkSVD.fit` for the validation arguments
         R = check_matrix(R, 'csr', dtype=np.float32)
         self.dataset = R
-        self.X, self.Y = BPRMF_sgd(R,
-                                   num_factors=self.num_factors,
-                                   lrate=self.lrate,
-                                   user_reg=self.user_reg,
-                                   pos_reg=self.pos_reg,
-                                   neg_reg=self.neg_reg,
-                                   iters=self.iters,
-                                   sampling_type=self.sampling_type,
-                                   sample_with_replacement=self.sample_with_replacement,
-                                   use_resampling=self.use_resampling,
-                                   sampling_pop_alpha=self.sampling_pop_alpha,
-                                   init_mean=self.init_mean,
-                                   init_std=self.init_std,
-                                   lrate_decay=self.lrate_decay,
-                                   rnd_seed=self.rnd_seed,
-                                   verbose=self.verbose)
+        M, N = R.shape
+        (X_init, Y_init), iters = _warm_start(self, ['X', 'Y'], [M, N])
+        monitor = _EpochMonitor(self, lambda users, F: np.dot(F[0][users], F[1].T), validation,
+                                metric=metric, at=at, patience=patience, eval_every=eval_every,
+                                n_users=n_eval_users)
+        X, Y = BPRMF_sgd(R,
+                         num_factors=self.num_factors,
+                         lrate=self.lrate,
+                         user_reg=self.user_reg,
+                         pos_reg=self.pos_reg,
+                         neg_reg=self.neg_reg,
+                         iters=iters,
+                         sampling_type=self.sampling_type,
+                         sample_with_replacement=self.sample_with_replacement,
+                         use_resampling=self.use_resampling,
+                         sampling_pop_alpha=self.sampling_pop_alpha,
+                         init_mean=self.init_mean,
+                         init_std=self.init_std,
+                         lrate_decay=self.lrate_decay,
+                         rnd_seed=self.rnd_seed,
+                         verbose=self.verbose,
+                         X_init=X_init,
+                         Y_init=Y_init,
+                         n_threads=self.n_threads,
+                         callback=monitor)
+        self.X, self.Y = monitor.finish([X, Y])
 
     def user_score(self, user_id):
         return np.dot(self.X[user_id], self.Y.T)
@@ -677,60 +972,163 @@ class BPRMF(Recommender):
         scores = np.dot(self.X[user_id], self.Y.T)
         return scores[rated_indices]
 
-    def label(self, unlabeled_list, binary_ratings=False, n=None, exclude_seen=True, p_most=1, n_most=3,score_mode='user'):
-        unlabeled_list = check_matrix(unlabeled_list, 'lil', dtype=np.float32)
-        users,items = unlabeled_list.nonzero()
-        n_scores = len(users)
-        uniq_users, user_to_idx = np.unique(users,return_inverse=True)
-        # At this point, we have all the predicted scores for the users inside
-        # U'. Now we will filter the scores by keeping only the scores of the
-        # items presented in U'. This will be an array where:
-        # filtered_scores[i] = scores[users[i],items[i]]
-        if (score_mode == 'user'):
-            filtered_scores = np.zeros(shape=n_scores,dtype=np.float32)
-            curr_user = None
-            i = 0
-            for user,item in zip(users,items):
-                if (curr_user != user):
-                    curr_user = user
-                    scores = np.dot(self.X[curr_user], self.Y.T)
+    def score_batch(self, user_ids):
+        return np.dot(self.X[user_ids], self.Y.T)
 
-                filtered_scores[i] = scores[item]
-                i += 1
+    def score_pairs(self, users, items):
+        return np.einsum('ij,ij->i', self.X[users], self.Y[items])
 
-        elif (score_mode == 'batch'):
-            pass
+    def label(self, unlabeled_list, binary_ratings=False, n=None, exclude_seen=True, p_most=1, n_most=3,score_mode='pairs'):
+        return label_extremes(unlabeled_list, self.score_pairs, lambda users: np.dot(self.X[users], self.Y.T),
+                              binary_ratings=binary_ratings, p_most=p_most, n_most=n_most, score_mode=score_mode)
 
-        elif (score_mode == 'matrix'):
-            scores = np.dot(self.X[uniq_users], self.Y.T)
-            # As scores is not a n_user/n_item matrix but a partial matrix
-            # then we will need to see which user is mapped to which index.
-            filtered_scores = scores[user_to_idx,items]
 
-        # At this point, we have all the predicted scores for the users inside
-        # U'. Now we will filter the scores by keeping only the scores of the
-        # items presented in U'. This will be an array where:
-        # filtered_scores[i] = scores[users[i],items[i]]
+class BPRMF_numpy(Recommender):
+    '''
+    BPRMF model trained with mini-batch gradient descent in NumPy.
+    Reference: BPR: Bayesian Personalized Ranking from Implicit Feedback (Rendle et al., 2009)
 
-        # Filtered the scores to have the n-most and p-most.
-        # sorted_filtered_scores is sorted incrementally
-        sorted_filtered_scores = filtered_scores.argsort()
-        p_sorted_scores = sorted_filtered_scores[-p_most:]
-        n_sorted_scores = sorted_filtered_scores[:n_most]
+    Drop-in replacement of `BPRMF_THEANO`, with the same parameters, objective and updates, but without Theano:
+    the triples of each mini-batch are sampled with vectorized operations and the gradients are scattered into the
+    factors with `np.add.at`, so that repeated users and items in a batch accumulate their updates.
+    W holds the user latent factors, H the item latent factors and B the item biases.
+    '''
 
-        if binary_ratings:
-            scores = [(users[i], items[i], 1.0) for i in p_sorted_scores] + [(users[i], items[i], 0.0) for i in n_sorted_scores]
-        else:
-            scores = [(users[i], items[i], 5.0) for i in p_sorted_scores] + [(users[i], items[i], 1.0) for i in n_sorted_scores]
+    def __init__(self,
+                 rank,
+                 n_users,
+                 n_items,
+                 lambda_u=0.0025,
+                 lambda_i=0.0025,
+                 lambda_j=0.00025,
+                 lambda_bias=0.0,
+                 learning_rate=0.05,
+                 epochs=10,
+                 batch_size=1000,
+                 rnd_seed=42):
+        '''
+        Initialize the model
+        :param rank: number of latent factors
+        :param n_users: number of users
+        :param n_items: number of items
+        :param lambda_u: regularization for the user factors
+        :param lambda_i: regularization for the factors of the positive sampled items
+        :param lambda_j: regularization for the factors of the negative sampled items
+        :param lambda_bias: regularization for the item biases
+        :param learning_rate: learning rate of the gradient descent
+        :param epochs: number of epochs, each one draws as many triples as the ratings in the dataset
+        :param batch_size: number of triples in each mini-batch
+        :param rnd_seed: random seed
+        '''
+        super(BPRMF_numpy, self).__init__()
+        self._rank = rank
+        self._n_users = n_users
+        self._n_items = n_items
+        self._lambda_u = lambda_u
+        self._lambda_i = lambda_i
+        self._lambda_j = lambda_j
+        self._lambda_bias = lambda_bias
+        self._learning_rate = learning_rate
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.rnd_seed = rnd_seed
 
-        meta = dict()
-        meta['pos_labels'] = len(p_sorted_scores)
-        meta['neg_labels'] = len(n_sorted_scores)
-        meta['total_labels'] = len(p_sorted_scores) + len(n_sorted_scores)
-        meta['pos_set'] = set([(users[i], items[i]) for i in p_sorted_scores])
-        meta['neg_set'] = set([(users[i], items[i]) for i in n_sorted_scores])
-        meta['neutral_set'] = set()
+    def short_str(self):
+        return "BPRMF_numpy"
 
-        # We sort the indices by user, then by item in order to make the
-        # assignment to the LIL matrix faster.
-        return sorted(scores, key=lambda triplet: (triplet[0],triplet[1])), meta
+    def __str__(self):
+        return "BPRMF_numpy(num_factors={},lrate={},user_reg={},pos_reg={},neg_reg={})".format(
+            self._rank, self._learning_rate, self._lambda_u, self._lambda_i, self._lambda_j
+        )
+
+    def fit(self, R):
+        self.train(R, epochs=self.epochs, batch_size=self.batch_size)
+
+    def train(self, train_data, epochs=10, batch_size=1000):
+        train_data = check_matrix(train_data, 'csr', dtype=np.float32)
+        if not train_data.has_sorted_indices:
+            train_data = train_data.copy()
+            train_data.sort_indices()
+        self.dataset = train_data
+        self.batch_size = batch_size
+        self._n_users, self._n_items = train_data.shape
+
+        rng = np.random.RandomState(self.rnd_seed)
+        self.W = rng.random_sample((self._n_users, self._rank)).astype(np.float32)
+        self.H = rng.random_sample((self._n_items, self._rank)).astype(np.float32)
+        self.B = np.zeros(self._n_items, dtype=np.float32)
+
+        self._initialize_sampling()
+        n_batches = epochs * train_data.nnz // batch_size
+        start = time.time()
+        for z in range(n_batches):
+            users, pos_items, neg_items = self._sample_batch(rng, batch_size)
+            self._update(users, pos_items, neg_items)
+        logger.info('Trained BPRMF_numpy on {} batches in {:.2f} seconds'.format(n_batches, time.time() - start))
+
+    def _initialize_sampling(self):
+        # the users with at least one positive and one negative item, the
+        # number of positive items of each user and the sorted linear keys of
+        # the positive user-item pairs to reject the sampled negative items
+        indptr = self.dataset.indptr
+        self._row_nnz = np.diff(indptr)
+        self._eligible_users = np.flatnonzero((self._row_nnz > 0) & (self._row_nnz < self._n_items))
+        users = np.repeat(np.arange(self._n_users, dtype=np.int64), self._row_nnz)
+        self._seen_keys = users * self._n_items + self.dataset.indices
+
+    def _sample_batch(self, rng, size):
+        users = self._eligible_users[rng.randint(len(self._eligible_users), size=size)]
+        # one positive item drawn uniformly among the items of each user
+        offsets = (rng.random_sample(size) * self._row_nnz[users]).astype(np.int64)
+        pos_items = self.dataset.indices[self.dataset.indptr[users] + offsets]
+        # negative items drawn uniformly, the seen ones are drawn again
+        neg_items = rng.randint(self._n_items, size=size)
+        rejected = np.arange(size)
+        while len(rejected) > 0:
+            keys = users[rejected].astype(np.int64) * self._n_items + neg_items[rejected]
+            pos = np.searchsorted(self._seen_keys, keys)
+            seen = self._seen_keys[np.minimum(pos, len(self._seen_keys) - 1)] == keys
+            rejected = rejected[seen]
+            neg_items[rejected] = rng.randint(self._n_items, size=len(rejected))
+        return users, pos_items, neg_items
+
+    def _update(self, u, i, j):
+        # gradient step on the sum over the batch of the BPR objective
+        # log(sigmoid(x_uij)) - lambda * ||factors||^2, as in BPRMF_THEANO
+        W_u, H_i, H_j = self.W[u], self.H[i], self.H[j]
+        x_uij = self.B[i] - self.B[j] + np.einsum('ij,ij->i', W_u, H_i - H_j)
+        g = (1.0 / (1.0 + np.exp(x_uij))).astype(np.float32)[:, None]  # 1 - sigmoid(x_uij)
+        lr = self._learning_rate
+        np.add.at(self.W, u, lr * (g * (H_i - H_j) - 2 * self._lambda_u * W_u))
+        np.add.at(self.H, i, lr * (g * W_u - 2 * self._lambda_i * H_i))
+        np.add.at(self.H, j, lr * (-g * W_u - 2 * self._lambda_j * H_j))
+        np.add.at(self.B, i, lr * (g[:, 0] - 2 * self._lambda_bias * self.B[i]))
+        np.add.at(self.B, j, lr * (-g[:, 0] - 2 * self._lambda_bias * self.B[j]))
+
+    def predictions(self, user_index):
+        return self.W[user_index].dot(self.H.T) + self.B
+
+    def user_score(self, user_id):
+        return self.predictions(user_id)
+
+    def recommend(self, user_id, n=None, exclude_seen=True):
+        scores = self.predictions(user_id)
+        ranking = scores.argsort()[::-1]
+        # rank items
+        if exclude_seen:
+            ranking = self._filter_seen(user_id, ranking)
+        return ranking[:n]
+
+    def predict(self, user_id, rated_indices):
+        scores = self.predictions(user_id)
+        return scores[rated_indices]
+
+    def score_batch(self, user_ids):
+        return self.predictions(user_ids)
+
+    def score_pairs(self, users, items):
+        return np.einsum('ij,ij->i', self.W[users], self.H[items]) + self.B[items]
+
+    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='pairs'):
+        return label_extremes(unlabeled_list, self.score_pairs, self.predictions,
+                              binary_ratings=binary_ratings, p_most=p_most, n_most=n_most, score_mode=score_mode)
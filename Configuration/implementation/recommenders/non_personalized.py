@@ -133,6 +133,45 @@ class Random(Recommender):
                 # For each rated index guess a rating by random choice.
                 return self.random_state.random_integers(low=1, high=5, size=shape)
 
+    def score_batch(self, user_ids):
+        """Calculates the scores of all the items for a block of users.
+
+            For the Random class the scores are drawn uniformly at random.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray of shape (len(user_ids), n_items) with the
+                scores of each user for all the items.
+        """
+        return self.random_state.rand(len(user_ids), self.nitems)
+
+    def score_pairs(self, users, items):
+        """Calculates the predicted score of a list of user-item pairs.
+
+            For the Random class it takes a value between 0 and 1 if using an
+            implicit dataset, otherwise, an integer between 1 and 5.
+
+            Args:
+                * users: the user index of each pair.
+                * items: the item index of each pair.
+
+            Args type:
+                * users: Numpy.ndarray of int
+                * items: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray with the predicted score of each pair.
+        """
+        if (self.binary_ratings):
+            return self.random_state.random_integers(low=0, high=1, size=len(users))
+        else:
+            return self.random_state.random_integers(low=1, high=5, size=len(users))
+
 class TopPop(Recommender):
     """Class that represents a Top Popular recommender.
 
@@ -219,6 +258,27 @@ class TopPop(Recommender):
         """
         pass
 
+    def score_batch(self, user_ids):
+        """Calculates the scores of all the items for a block of users.
+
+            For the TopPop class the score of an item is the inverse of its
+            position in `self.pop`, the same for all the users.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray of shape (len(user_ids), n_items) with the
+                scores of each user for all the items.
+        """
+        nitems = len(self.pop)
+        scores = np.empty(nitems, dtype=np.float32)
+        scores[self.pop] = np.arange(nitems, 0, -1)
+        return np.tile(scores, (len(user_ids), 1))
+
 class GlobalEffects(Recommender):
     """Class that represents a Global Effects recommender.
 
@@ -370,3 +430,40 @@ class GlobalEffects(Recommender):
             bu = self.bu[user_id]
             bi = self.bi[rated_indices]
             return mu + bu + bi
+
+    def score_batch(self, user_ids):
+        """Calculates the scores of all the items for a block of users.
+
+            For the GlobalEffects class the ranking only depends on the item
+            bias, as in `recommend`, so the scores are the item biases.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray of shape (len(user_ids), n_items) with the
+                scores of each user for all the items.
+        """
+        return np.tile(self.bi, (len(user_ids), 1))
+
+    def score_pairs(self, users, items):
+        """Calculates the predicted score of a list of user-item pairs.
+
+            For the GlobalEffects class the score of each pair is computed as
+            in `predict`, \hat{r}_{u,i} = \mu + b_{i} + b_{u}.
+
+            Args:
+                * users: the user index of each pair.
+                * items: the item index of each pair.
+
+            Args type:
+                * users: Numpy.ndarray of int
+                * items: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray with the predicted score of each pair.
+        """
+        return self.mu + self.bu[users] + self.bi[items]
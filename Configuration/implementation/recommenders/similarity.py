@@ -3,8 +3,9 @@ Politecnico di Milano.
 similarity.py
 
 Description: This file contains the definition of a ISimilarity abstract class
-             and the implementation of Cosine, Pearson and Adjusted Cosine
-             similarities.
+             and the implementation of Cosine, Pearson, Adjusted Cosine and
+             Jaccard similarities, and of an approximate Cosine similarity based on
+             Locality Sensitive Hashing.
 
 Created by: Massimo Quadrana.
 Modified by Fernando Pérez.
@@ -14,77 +15,267 @@ Last modified on 25/03/2017.
 
 import numpy as np
 import scipy.sparse as sps
-from .base import check_matrix
-from .._cython._similarity import cosine_common
+from .base import check_matrix, linear_keys, pairs_dot
+from .Recommender_utils import similarityMatrixTopK
+from .._cython._similarity import cosine_common, similarity_topk, normalize_columns, dot_shrink, \
+    binary_similarity
+
+
+def changed_columns(X_old, X_new):
+    """
+    Returns the indices of the columns that differ between two matrices, either
+    in their values or in their sparsity structure.
+    :param X_old: instance of scipy.sparse.csc_matrix
+    :param X_new: instance of scipy.sparse.csc_matrix, with the same shape as X_old
+    :return: sorted array of column indices
+    """
+    diff = X_new - X_old
+    X_old_ind, X_new_ind = X_old.copy(), X_new.copy()
+    X_old_ind.data = np.ones_like(X_old_ind.data)
+    X_new_ind.data = np.ones_like(X_new_ind.data)
+    diff_ind = X_new_ind - X_old_ind
+    return np.union1d(diff.nonzero()[1], diff_ind.nonzero()[1])
+
+
+def is_binary(X):
+    """
+    Tells if all the stored values of a matrix are ones, as in the implicit
+    datasets, in which case the similarities are computed from co-counts only.
+    :param X: instance of scipy.sparse matrix
+    :return: bool
+    """
+    return X.nnz > 0 and bool(np.all(X.data == 1.0))
 
 
 class ISimilarity(object):
     """Abstract interface for the similarity metrics"""
 
-    def __init__(self, shrinkage=10):
+    def __init__(self, shrinkage=10, num_threads=1):
         self.shrinkage = shrinkage
+        # number of threads used by the Cython kernels, all the available
+        # ones if None
+        self.num_threads = num_threads
 
     def compute(self, X):
         pass
 
+    def transform(self, X):
+        """
+        Returns the matrix whose columns are compared by the similarity. Two
+        items have the same similarities to the others if and only if their
+        columns in the transformed matrix did not change.
+        :param X: the User-Rating Matrix
+        :return: instance of scipy.sparse.csc_matrix
+        """
+        return check_matrix(X, 'csc', dtype=np.float32)
+
+    def compute_topk(self, X, k, columns=None):
+        """
+        Computes the k most similar items of every item without building the
+        dense n_items x n_items similarity matrix.
+        :param X: the User-Rating Matrix
+        :param k: number of neighbours to keep for each item
+        :param columns: array of the indices of the items whose neighbours are
+            computed, all of them if None
+        :return: instance of scipy.sparse.csr_matrix, whose column j holds the
+            top-k neighbours of the item j, the columns of the other items are
+            empty
+        """
+        X = self.transform(X)
+        return self._topk_matrix(X, k, common=True, columns=columns)
+
+    def _topk_matrix(self, X, k, common, columns=None):
+        columns = None if columns is None else np.unique(columns)
+        indptr, indices, data = similarity_topk(X, k, self.shrinkage, common=common, num_threads=self.num_threads,
+                                                columns=columns)
+        return self._weights_matrix(X.shape[1], indptr, indices, data, columns)
+
+    def _weights_matrix(self, nitems, indptr, indices, data, columns=None):
+        # the row t of the kernel output holds the neighbours of the item
+        # columns[t], which are the column columns[t] of the weights matrix.
+        if columns is not None:
+            # place the rows of the sorted items, the others are empty.
+            row_nnz = np.zeros(nitems, dtype=np.int32)
+            row_nnz[columns] = np.diff(indptr)
+            indptr = np.zeros(nitems + 1, dtype=np.int32)
+            np.cumsum(row_nnz, out=indptr[1:])
+        W_t = sps.csr_matrix((data, indices, indptr), shape=(nitems, nitems))
+        return W_t.T.tocsr()
+
 
 class Cosine(ISimilarity):
     def compute(self, X):
-        # convert to csc matrix for faster column-wise operations
-        X = check_matrix(X, 'csc', dtype=np.float32)
+        if is_binary(X):
+            # the cosine of binary columns only depends on the co-counts and
+            # the number of ratings of each item
+            return binary_similarity(X.tocsc(), self.shrinkage, jaccard=False, num_threads=self.num_threads)
 
-        # 1) normalize the columns in X
-        # compute the column-wise norm
-        # NOTE: this is slightly inefficient. We must copy X to compute the column norms.
-        # A faster solution is to  normalize the matrix inplace with a Cython function.
-        Xsq = X.copy()
-        Xsq.data **= 2
-        norm = np.sqrt(Xsq.sum(axis=0))
-        norm = np.asarray(norm).ravel()
-        norm += 1e-6
-        # compute the number of non-zeros in each column
-        # NOTE: this works only if X is instance of sparse.csc_matrix
-        col_nnz = np.diff(X.indptr)
-        # then normalize the values in each column
-        X.data /= np.repeat(norm, col_nnz)
+        # 1) normalize the columns in X, in place on a single csc copy of X
+        X = self.normalize(X)
+
+        # 2) compute the cosine similarity using the dot-product, the shrinkage
+        # is applied with the co-rated counts accumulated in the same pass and
+        # the diagonal values are zero
+        return dot_shrink(X, self.shrinkage, num_threads=self.num_threads)
+
+    def normalize(self, X):
+        """
+        Returns a csc copy of X with its columns normalized.
+        :param X: the User-Rating Matrix, it is not modified
+        :return: instance of scipy.sparse.csc_matrix
+        """
+        # convert to csc matrix for faster column-wise operations, copying
+        # X only once
+        X = X.tocsc(copy=True)
+        if X.dtype != np.float32:
+            X = X.astype(np.float32)
+        normalize_columns(X)
+        return X
 
-        # 2) compute the cosine similarity using the dot-product
-        dist = X.T.dot(X).toarray()
-        # zero out diagonal values
-        np.fill_diagonal(dist, 0.0)
+    def compute_topk(self, X, k, columns=None):
+        if is_binary(X):
+            X = X.tocsc()
+            columns = None if columns is None else np.unique(columns)
+            indptr, indices, data = binary_similarity(X, self.shrinkage, jaccard=False, k=k,
+                                                      num_threads=self.num_threads, columns=columns)
+            return self._weights_matrix(X.shape[1], indptr, indices, data, columns)
+
+        # normalize the columns in X as in `compute`
+        X = self.normalize(X)
+        return self._topk_matrix(X, k, common=False, columns=columns)
+
+
+class LSHCosine(Cosine):
+    """
+    Approximate cosine similarity with MinHash Locality Sensitive Hashing.
+    Each item gets a signature of n_bands * band_size MinHash values of the
+    set of users that rated it. Two items are candidates if all the values
+    of at least one band are equal, which happens with probability
+    1 - (1 - J^band_size)^n_bands for two items with Jaccard similarity J.
+    The exact cosine similarity is computed only for the candidate pairs,
+    the similarities of the other pairs are zero.
+    """
+
+    def __init__(self, shrinkage=10, num_threads=1, n_bands=32, band_size=2, max_bucket_size=100, seed=1024):
+        super(LSHCosine, self).__init__(shrinkage=shrinkage, num_threads=num_threads)
+        self.n_bands = n_bands
+        self.band_size = band_size
+        # items in larger buckets are only paired with their
+        # max_bucket_size - 1 neighbours in the bucket order
+        self.max_bucket_size = max_bucket_size
+        self.seed = seed
+
+    def compute(self, X):
+        return self.compute_candidates(X).toarray()
+
+    def compute_topk(self, X, k, columns=None):
+        if columns is not None:
+            raise NotImplementedError('The top-k neighbours of a subset of the items are not implemented for LSH')
+        return similarityMatrixTopK(self.compute_candidates(X), k=k)
+
+    def compute_candidates(self, X):
+        """
+        Computes the cosine similarity of the candidate pairs of items.
+        :param X: the User-Rating Matrix
+        :return: symmetric instance of scipy.sparse.csr_matrix with the positive
+            similarities of the candidate pairs
+        """
+        X = self.normalize(X)
+        nitems = X.shape[1]
+        first, second = self.candidates(X)
+
+        # exact cosine similarity of the candidate pairs, the columns of X are
+        # the rows of its transpose
+        Xt = X.T.tocsr()
+        dist = pairs_dot(Xt, X, first, second)
         if self.shrinkage > 0:
-            dist = self.apply_shrinkage(X, dist)
-        return dist
+            X_ind = X.copy()
+            X_ind.data = np.ones_like(X_ind.data)
+            co_counts = pairs_dot(X_ind.T.tocsr(), X_ind, first, second)
+            dist *= co_counts / (co_counts + self.shrinkage)
 
-    def apply_shrinkage(self, X, dist):
-        # create an "indicator" version of X (i.e. replace values in X with ones)
-        X_ind = X.copy()
-        X_ind.data = np.ones_like(X_ind.data)
-        # compute the co-rated counts
-        co_counts = X_ind.T.dot(X_ind).toarray().astype(np.float32)
-        # compute the shrinkage factor as co_counts_ij / (co_counts_ij + shrinkage)
-        # then multiply dist with it
-        dist *= co_counts / (co_counts + self.shrinkage)
-        return dist
+        positive = dist > 0.0
+        first, second, dist = first[positive], second[positive], dist[positive]
+        rows = np.concatenate((first, second))
+        cols = np.concatenate((second, first))
+        return sps.csr_matrix((np.concatenate((dist, dist)), (rows, cols)), shape=(nitems, nitems), dtype=np.float32)
+
+    def candidates(self, X):
+        """
+        Finds the candidate pairs of items, those with an equal band in their
+        signatures.
+        :param X: the User-Rating Matrix, instance of scipy.sparse.csc_matrix
+        :return: two arrays with the first and second item of each pair, the
+            first being the smallest
+        """
+        nusers, nitems = X.shape
+        rng = np.random.RandomState(self.seed)
+
+        # the items without ratings have no similarity with the others
+        rated = np.flatnonzero(np.diff(X.indptr))
+        X_rated = X[:, rated]
+        users = X_rated.indices.astype(np.int64)
+        starts = X_rated.indptr[:-1]
+
+        # MinHash signatures, each hash function is a random universal hash
+        # of the user indices and its value for an item is the minimum hash
+        # of the users that rated it
+        prime = 2147483647
+        n_hashes = self.n_bands * self.band_size
+        a = rng.randint(1, prime, size=n_hashes).astype(np.int64)
+        b = rng.randint(0, prime, size=n_hashes).astype(np.int64)
+        signatures = np.empty((len(rated), n_hashes), dtype=np.int64)
+        for h in range(n_hashes):
+            signatures[:, h] = np.minimum.reduceat((a[h] * users + b[h]) % prime, starts)
+
+        keys = []
+        for band in range(self.n_bands):
+            band_signatures = signatures[:, band * self.band_size:(band + 1) * self.band_size]
+            order = np.lexsort(band_signatures.T[::-1])
+            sorted_signatures = band_signatures[order]
+            # the items of a bucket are contiguous in the sorted order, pair
+            # each item with the following ones of the same bucket
+            for offset in range(1, self.max_bucket_size):
+                same = np.all(sorted_signatures[:-offset] == sorted_signatures[offset:], axis=1)
+                if not same.any():
+                    break
+                first = rated[order[:-offset][same]]
+                second = rated[order[offset:][same]]
+                keys.append(linear_keys(np.minimum(first, second), np.maximum(first, second), nitems))
+
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys = np.unique(np.concatenate(keys))
+        return keys // nitems, keys % nitems
 
 
 class Pearson(ISimilarity):
     def compute(self, X):
+        X = self.transform(X)
+        dist, co_counts = cosine_common(X, num_threads=self.num_threads)
+        if self.shrinkage > 0:
+            dist *= co_counts / (co_counts + self.shrinkage)
+        return dist
+
+    def transform(self, X):
         # convert to csc matrix for faster column-wise operations
         X = check_matrix(X, 'csc', dtype=np.float32)
         # subtract the item average rating
         col_nnz = np.diff(X.indptr)
         col_means = np.asarray(X.sum(axis=0) / (col_nnz + 1e-6)).ravel()
         X.data -= np.repeat(col_means, col_nnz)
+        return X
+
 
-        dist, co_counts = cosine_common(X)
+class AdjustedCosine(ISimilarity):
+    def compute(self, X):
+        X = self.transform(X)
+        dist, co_counts = cosine_common(X, num_threads=self.num_threads)
         if self.shrinkage > 0:
             dist *= co_counts / (co_counts + self.shrinkage)
         return dist
 
-
-class AdjustedCosine(ISimilarity):
-    def compute(self, X):
+    def transform(self, X):
         # convert X to csr matrix for faster row-wise operations
         X = check_matrix(X, 'csr', dtype=np.float32)
         # subtract the user average rating
@@ -93,8 +284,27 @@ class AdjustedCosine(ISimilarity):
         X.data -= np.repeat(row_means, row_nnz)
 
         # convert X to csc before applying cosine_common
-        X = X.tocsc()
-        dist, co_counts = cosine_common(X)
-        if self.shrinkage > 0:
-            dist *= co_counts / (co_counts + self.shrinkage)
-        return dist
+        return X.tocsc()
+
+
+class Jaccard(ISimilarity):
+    """
+    Jaccard similarity between the sets of users that rated each item, the
+    values of the ratings are ignored.
+    """
+
+    def compute(self, X):
+        return binary_similarity(self.transform(X), self.shrinkage, jaccard=True, num_threads=self.num_threads)
+
+    def transform(self, X):
+        # only the sparsity structure of X is compared
+        X = check_matrix(X, 'csc', dtype=np.float32)
+        X.data = np.ones_like(X.data)
+        return X
+
+    def compute_topk(self, X, k, columns=None):
+        X = self.transform(X)
+        columns = None if columns is None else np.unique(columns)
+        indptr, indices, data = binary_similarity(X, self.shrinkage, jaccard=True, k=k,
+                                                  num_threads=self.num_threads, columns=columns)
+        return self._weights_matrix(X.shape[1], indptr, indices, data, columns)
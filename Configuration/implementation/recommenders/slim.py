@@ -13,7 +13,8 @@ Last modified on 05/09/2017.
 
 import numpy as np
 import scipy.sparse as sps
-from .base import Recommender, check_matrix
+from .base import Recommender, check_matrix, linear_keys, top_k_indices, pairs_dot
+from .._cython._scoring import sparse_scores, sparse_top_n
 from sklearn.linear_model import ElasticNet
 
 # Memory consumption problem solved by:
@@ -173,8 +174,9 @@ class SLIM(Recommender):
             # finally, replace the original values of the j-th column
             X.data[startptr:endptr] = bak
 
-        # generate the sparse weight matrix
-        self.W_sparse = sps.csc_matrix((values, (rows, cols)), shape=(n_items, n_items), dtype=np.float32)
+        # generate the sparse weight matrix, in CSR format as needed by the
+        # scoring kernels
+        self.W_sparse = sps.csr_matrix((values, (rows, cols)), shape=(n_items, n_items), dtype=np.float32)
 
     def recommend(self, user_id, n=None, exclude_seen=True):
         """Makes a top-N recommendation list for a specific user.
@@ -237,7 +239,8 @@ class SLIM(Recommender):
 
             The score is calculated by the dot product between the user preferences
             and each item vector in the similarity matrix. The resulting scores
-            are then sorted from highest to lowest.
+            are then sorted from highest to lowest. With a given `n`, the list
+            is built by `sparse_top_n` as in `recommend_batch`.
 
             Args:
                 * user_id: user index to which we will build the top-N list.
@@ -255,8 +258,11 @@ class SLIM(Recommender):
                 A personalised ranked list of items represented by their indices.
         """
         assert user_profile.shape[1] == self.W_sparse.shape[0], 'The number of items does not match!'
+        if n is not None:
+            ranking = sparse_top_n(user_profile, self.W_sparse, n, exclude_seen=exclude_seen)[0]
+            return ranking[ranking >= 0]
         # compute the scores using the dot product
-        scores = user_profile.dot(self.W_sparse).toarray().ravel()
+        scores = sparse_scores(user_profile, self.W_sparse).ravel()
         ranking = scores.argsort()[::-1]
         # rank items
         if exclude_seen:
@@ -265,7 +271,76 @@ class SLIM(Recommender):
             ranking = ranking[unseen_mask]
         return ranking[:n]
 
-    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='user'):
+    def score_batch(self, user_ids):
+        """Calculates the scores of all the items for a block of users.
+
+            For the SLIM class the scores are the product between the profiles
+            of the users and the similarity matrix, computed by `sparse_scores`
+            without building the intermediate sparse product.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray of shape (len(user_ids), n_items) with the
+                scores of each user for all the items.
+        """
+        return sparse_scores(self._get_user_ratings(user_ids), self.W_sparse)
+
+    def recommend_batch(self, user_ids, n=None, exclude_seen=True):
+        """Makes a top-N recommendation list for each user in a block.
+
+            With a given `n`, the lists are built by `sparse_top_n` without
+            computing the dense scores of the block: the seen items are skipped
+            while the scores are accumulated and only the best `n` items of
+            each user are sorted. Otherwise, see
+            `base.Recommender.recommend_batch`.
+
+            Args:
+                * user_ids: the indices of the users in the block.
+                * n: size of the lists.
+                * exclude_seen: tells if we should remove already-seen items from
+                                the lists.
+
+            Args type:
+                * user_ids: Numpy.ndarray of int
+                * n: int
+                * exclude_seen: bool
+
+            Returns:
+                A list with a ranked list of items, represented by their indices,
+                for each user in the block.
+        """
+        if n is None:
+            return super(SLIM, self).recommend_batch(user_ids, n, exclude_seen)
+        top_n = sparse_top_n(self._get_user_ratings(user_ids), self.W_sparse, n,
+                             exclude_seen=exclude_seen)
+        return [ranking[ranking >= 0] for ranking in top_n]
+
+    def score_pairs(self, users, items):
+        """Calculates the predicted score of a list of user-item pairs.
+
+            For the SLIM class the score of each pair is the dot product between
+            the profile of the user and the column of the item in the
+            similarity matrix.
+
+            Args:
+                * users: the user index of each pair.
+                * items: the item index of each pair.
+
+            Args type:
+                * users: Numpy.ndarray of int
+                * items: Numpy.ndarray of int
+
+            Returns:
+                A Numpy.ndarray with the predicted score of each pair.
+        """
+        return pairs_dot(self.dataset, self.W_sparse, users, items)
+
+    def label(self, unlabeled_list, binary_ratings=False, exclude_seen=True, p_most=1, n_most=3, score_mode='pairs'):
         """Rates new user-item pairs.
 
            This function is part of the Co-Training process in which we rate
@@ -293,7 +368,9 @@ class SLIM(Recommender):
                * score_mode: the type of score prediction, 'user' represents by
                              sequentially user-by-user, 'batch' represents by
                              taking batches of users, 'matrix' represents to
-                             make the preditions by a matrix multiplication.
+                             make the preditions by a matrix multiplication,
+                             'pairs' represents to score only the user-item
+                             pairs in the pool (see `score_pairs`).
 
            Args type:
                * unlabeled_list: Scipy.Sparse matrix.
@@ -312,7 +389,10 @@ class SLIM(Recommender):
         users,items = unlabeled_list.nonzero()
         n_scores = len(users)
         uniq_users, user_to_idx = np.unique(users,return_inverse=True)
-        if (score_mode == 'user'):
+        if (score_mode == 'pairs'):
+            filtered_scores = self.score_pairs(users, items)
+
+        elif (score_mode == 'user'):
             filtered_scores = np.zeros(shape=n_scores,dtype=np.float32)
             curr_user = None
             i = 0
@@ -331,7 +411,7 @@ class SLIM(Recommender):
         elif (score_mode == 'matrix'):
             # compute the scores using the dot product
             profiles = self._get_user_ratings(uniq_users)
-            scores = profiles.dot(self.W_sparse).toarray()
+            scores = sparse_scores(profiles, self.W_sparse)
             filtered_scores = scores[user_to_idx,items]
 
         # At this point, we have all the predicted scores for the users inside
@@ -340,10 +420,10 @@ class SLIM(Recommender):
         # filtered_scores[i] = scores[users[i],items[i]]
 
         # Filtered the scores to have the n-most and p-most.
-        # sorted_filtered_scores is sorted incrementally
-        sorted_filtered_scores = filtered_scores.argsort()
-        p_sorted_scores = sorted_filtered_scores[-p_most:]
-        n_sorted_scores = sorted_filtered_scores[:n_most]
+        # The p-most are sorted decreasingly.
+        # The n-most are sorted incrementally.
+        p_sorted_scores = top_k_indices(filtered_scores, p_most, largest=True)
+        n_sorted_scores = top_k_indices(filtered_scores, n_most, largest=False)
 
         if binary_ratings:
             scores = [(users[i], items[i], 1.0) for i in p_sorted_scores] + [(users[i], items[i], 0.0) for i in n_sorted_scores]
@@ -355,15 +435,16 @@ class SLIM(Recommender):
         meta['pos_labels'] = len(p_sorted_scores)
         meta['neg_labels'] = len(n_sorted_scores)
         meta['total_labels'] = len(p_sorted_scores) + len(n_sorted_scores)
-        meta['pos_set'] = set([(users[i], items[i]) for i in p_sorted_scores])
-        meta['neg_set'] = set([(users[i], items[i]) for i in n_sorted_scores])
-        meta['neutral_set'] = set()
+        meta['pos_keys'] = linear_keys(users[p_sorted_scores], items[p_sorted_scores], unlabeled_list.shape[1])
+        meta['neg_keys'] = linear_keys(users[n_sorted_scores], items[n_sorted_scores], unlabeled_list.shape[1])
+        meta['neutral_keys'] = linear_keys([], [], unlabeled_list.shape[1])
 
         # We sort the indices by user, then by item in order to make the
         # assignment to the LIL matrix faster.
         return sorted(scores, key=lambda triplet: (triplet[0],triplet[1])), meta
 
 
+import os
 from multiprocessing import Pool
 from functools import partial
 
@@ -390,6 +471,8 @@ class MultiThreadSLIM(SLIM):
         * positive_only: consider positive samples only.
         * l1_ratio: ratio between l1_penalty and l1_penalty + l2_penalty
         * workers: maximum number of processes to use.
+        * pool: the pool of processes, created lazily by the process that
+                fits the model.
 
     """
     def __init__(self,
@@ -416,7 +499,30 @@ class MultiThreadSLIM(SLIM):
                                               l2_penalty=l2_penalty,
                                               positive_only=positive_only)
         self.workers = workers
-        self.pool = Pool(processes=self.workers)
+        self.pool = None
+        self._pool_pid = None
+
+    def __getstate__(self):
+        """ The pool of processes cannot be pickled, it is not sent. """
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['_pool_pid'] = None
+        return state
+
+    def _get_pool(self):
+        """Returns the pool of processes of the current process.
+
+           A pool inherited from a parent process (e.g. when the recommender
+           is fitted in a child process) does not own its workers, in that
+           case a new pool is created.
+
+           Returns:
+               A multiprocessing.Pool instance.
+        """
+        if (self.pool is None or self._pool_pid != os.getpid()):
+            self.pool = Pool(processes=self.workers)
+            self._pool_pid = os.getpid()
+        return self.pool
 
     def __str__(self):
         """ String representation of the class. """
@@ -454,7 +560,7 @@ class MultiThreadSLIM(SLIM):
         num_tasks = int((n_items / self.workers) + 1)
 
         args_triplet = ((j,self.l1_ratio,self.positive_only) for j in np.arange(n_items))
-        res = self.pool.map(_pfit, args_triplet)
+        res = self._get_pool().map(_pfit, args_triplet)
         # self.pool.close()
         # self.pool.join()
 
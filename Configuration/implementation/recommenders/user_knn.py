@@ -12,22 +12,32 @@ Last modified on 25/03/2017.
 '''
 
 
+from collections import OrderedDict
 from .item_knn import ItemKNNRecommender
-from .base import check_matrix
+from .base import Recommender, check_matrix, top_k_indices, pairs_dot
 import numpy as np
 import scipy.sparse as sps
 import pdb
 
 
 class UserKNNRecommender(ItemKNNRecommender):
-    def __init__(self, k=50, shrinkage=100, similarity='cosine', normalize=False, sparse_weights=True):
+    def __init__(self, k=50, shrinkage=100, similarity='cosine', normalize=False, sparse_weights=True, num_threads=1, score_block_size=1000, cache_blocks=1):
         super().__init__(
             k=k,
             shrinkage=shrinkage,
             similarity=similarity,
             normalize=normalize,
-            sparse_weights=sparse_weights
+            sparse_weights=sparse_weights,
+            num_threads=num_threads
         )
+        # the scores are computed on demand for blocks of score_block_size
+        # users, and the cache_blocks most recently used blocks are kept.
+        self.score_block_size = score_block_size
+        self.cache_blocks = cache_blocks
+        self._score_cache = OrderedDict()
+        self._W_t = None
+        self._rated = None
+        self._rated = None
 
     def short_str(self):
         return "UserKNN"
@@ -45,6 +55,9 @@ class UserKNNRecommender(ItemKNNRecommender):
         super().fit(Xt)
 
         self.dataset = X
+        self._score_cache = OrderedDict()
+        self._W_t = None
+        self._rated = None
 
         # # precompute the predicted scores for speed
         # if self.sparse_weights:
@@ -63,33 +76,92 @@ class UserKNNRecommender(ItemKNNRecommender):
         #         den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
         #         self.scores[:, i] /= den
 
-    def calculate_scores(self):
-        if self.sparse_weights:
-            self.scores = self.W_sparse.dot(self.dataset).toarray()
-        else:
-            self.scores = self.W.dot(self.dataset)
+    def user_scores(self, user_id):
+        """Returns the scores of all the items for a user.
 
-        if self.normalize:
-            # pdb.set_trace()
-            rated = self.dataset.T.copy()
-            rated.data = np.ones_like(rated.data)
-            if self.sparse_weights:
-                den = rated.dot(self.W_sparse).toarray()
-            else:
-                den = rated.dot(self.W)
-            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
-            self.scores /= den.T
+            The scores are computed with `score_batch` for the whole block of
+            users that contains `user_id`, the `cache_blocks` most recently
+            used blocks are kept so the following users of the block are not
+            scored again.
 
-    def recommend(self, user_id, n=None, exclude_seen=True):
-        # pdb.set_trace()
-        if (self.scores is None):
-            self.calculate_scores()
+            Args:
+                * user_id: the user index inside the system.
+
+            Args type:
+                * user_id: int
 
-        ranking = self.scores[user_id].argsort()[::-1]
+            Returns:
+                A Numpy.ndarray with the score of each item.
+        """
+        block = user_id // self.score_block_size
+        if (block in self._score_cache):
+            self._score_cache.move_to_end(block)
+            scores = self._score_cache[block]
+        else:
+            low_user = block * self.score_block_size
+            high_user = min(low_user + self.score_block_size, self.dataset.shape[0])
+            scores = self.score_batch(np.arange(low_user, high_user))
+            if (self.cache_blocks > 0):
+                self._score_cache[block] = scores
+                if (len(self._score_cache) > self.cache_blocks):
+                    # remove the least recently used block.
+                    self._score_cache.popitem(last=False)
+        return scores[user_id - block * self.score_block_size]
+
+    def recommend(self, user_id, n=None, exclude_seen=True):
+        ranking = self.user_scores(user_id).argsort()[::-1]
         if exclude_seen:
             ranking = self._filter_seen(user_id, ranking)
         return ranking[:n]
 
+    def score_batch(self, user_ids):
+        # the scores of the users are their rows in W times the dataset.
+        if self.sparse_weights:
+            scores = self.W_sparse[user_ids].dot(self.dataset).toarray()
+        else:
+            scores = self.dataset.T.dot(self.W[user_ids].T).T
+        if self.normalize:
+            # the normalization terms are the columns of the users in W times
+            # the raters of each item.
+            W_t, rated = self._normalization_terms()
+            if self.sparse_weights:
+                den = W_t[user_ids].dot(rated).toarray()
+            else:
+                den = rated.T.dot(W_t[user_ids].T).T
+            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
+            scores /= den
+        return scores
+
+    def _normalization_terms(self):
+        # the transpose of W, as CSR if sparse, and the binarized dataset are
+        # built once per fit and shared by score_batch and score_pairs.
+        if (self._W_t is None):
+            self._W_t = self.W_sparse.T.tocsr() if self.sparse_weights else self.W.T
+        if (self._rated is None):
+            self._rated = self.dataset.copy()
+            self._rated.data = np.ones_like(self._rated.data)
+        return self._W_t, self._rated
+
+    def recommend_batch(self, user_ids, n=None, exclude_seen=True):
+        # W holds user-user weights, so the sparse item-item top-N kernel of
+        # ItemKNN does not apply: the lists are built from `score_batch` as in
+        # `base.Recommender.recommend_batch`.
+        return Recommender.recommend_batch(self, user_ids, n=n, exclude_seen=exclude_seen)
+
+    def score_pairs(self, users, items):
+        # the score of the pair (u,i) is the dot product between the row of
+        # the user u in W and the column of the item i in the dataset.
+        W = self.W_sparse if self.sparse_weights else self.W
+        scores = pairs_dot(W, self.dataset, users, items)
+        if self.normalize:
+            # the normalization term of (u,i) is the dot product between the
+            # column of the user u in W and the raters of the item i.
+            W_t, rated = self._normalization_terms()
+            den = pairs_dot(W_t, rated, users, items)
+            den[np.abs(den) < 1e-6] = 1.0  # to avoid NaNs
+            scores /= den
+        return scores
+
     def label(self, unlabeled_list, binary_ratings=False, n=None, exclude_seen=True, p_most=1, n_most=3):
         # Calculate the scores only one time.
         # users = []
@@ -103,11 +175,10 @@ class UserKNNRecommender(ItemKNNRecommender):
         unlabeled_list = check_matrix(unlabeled_list, 'lil', dtype=np.float32)
         users,items = unlabeled_list.nonzero()
 
-        # At this point, we have all the predicted scores for the users inside
-        # U'. Now we will filter the scores by keeping only the scores of the
-        # items presented in U'. This will be an array where:
+        # We only compute the predicted scores of the pairs inside U'. This
+        # will be an array where:
         # filtered_scores[i] = scores[users[i],items[i]]
-        filtered_scores = self.scores[users,items]
+        filtered_scores = self.score_pairs(users, items)
 
         # positive ratings: explicit ->[4,5], implicit -> [0.75,1]
         # negative ratings: explicit -> [1,2,3], implicit -> [0,0.75)
@@ -134,15 +205,12 @@ class UserKNNRecommender(ItemKNNRecommender):
         # Filtered the scores to have the n-most and p-most.
         # The p-most are sorted decreasingly.
         # The n-most are sorted incrementally.
-        p_sorted_scores = p_filtered_scores.argsort()[::-1]
-        n_sorted_scores = n_filtered_scores.argsort()
-
-        # Taking the p_most positive, in decreasing order, if len(p_sorted_scores) < p_most
-        # the final array will have length of len(p_sorted_scores)
-        p_sorted_scores = p_sorted_scores[:p_most]
+        # Taking the p_most positive, in decreasing order, if len(p_filtered_scores) < p_most
+        # the final array will have length of len(p_filtered_scores)
+        p_sorted_scores = top_k_indices(p_filtered_scores, p_most, largest=True)
 
         # Similar to p_most but with n_most.
-        n_sorted_scores = n_sorted_scores[:n_most]
+        n_sorted_scores = top_k_indices(n_filtered_scores, n_most, largest=False)
         scores = [(p_users[i], p_items[i], p_filtered_scores[i]) for i in p_sorted_scores ] + [(n_users[i], n_items[i], n_filtered_scores[i]) for i in n_sorted_scores]
 
         # We sort the indices by user, then by item in order to make the
@@ -151,4 +219,4 @@ class UserKNNRecommender(ItemKNNRecommender):
 
     def predict(self, user_id, rated_indices):
         # return the scores for the rated items.
-        return self.scores[user_id,rated_indices]
+        return self.user_scores(user_id)[rated_indices]
@@ -58,10 +58,11 @@ class Evaluation(object):
             * eval_bins: calculate the popularity bins.
             * rec_evals: holds the evaluation for each metric for each recommender.
             * nbins: the number of popularity bins.
+            * block_size: number of users scored at once in `eval`.
 
     """
 
-    def __init__(self, results_path, results_file, test_set, val_set = None, at = 10, co_training=False, eval_bins = False):
+    def __init__(self, results_path, results_file, test_set, val_set = None, at = 10, co_training=False, eval_bins = False, block_size=1000):
         """Constructor of the class.
 
             Args:
@@ -75,6 +76,7 @@ class Evaluation(object):
                 * eval_bins: calculate the popularity bins.
                 * rec_evals: holds the evaluation for each metric for each
                              recommender.
+                * block_size: number of users scored at once in `eval`.
 
             Args type:
                 * results_path: str
@@ -86,6 +88,7 @@ class Evaluation(object):
                 * bins: Dictionary<int:int>
                 * eval_bins: bool
                 * rec_evals: Dictionary<str:Dictionary<str:[float]>>
+                * block_size: int
         """
         super(Evaluation, self).__init__()
         self.results_path = results_path
@@ -97,6 +100,7 @@ class Evaluation(object):
         self.bins = dict()
         self.eval_bins = eval_bins
         self.rec_evals = dict()
+        self.block_size = block_size
 
     def add_statistics(self,recommenders,both):
         """Add statistics info into the Evaluation instance.
@@ -369,6 +373,11 @@ class Evaluation(object):
             This method performs the evaluation only to the users in the test
             set that has more or equal ratings than `minRatingsPerUser`.
 
+            The users are evaluated in blocks of `self.block_size` users, each
+            recommender builds the top-N lists of the whole block with
+            `recommend_batch` and predicts the test ratings of the block with
+            `score_pairs`.
+
             After the evaluation is finished for all those users, the average
             of each metric is taken.
 
@@ -393,7 +402,6 @@ class Evaluation(object):
         numRatings = np.ediff1d(rows)
         mask = numRatings >= minRatingsPerUser
         usersToEvaluate = np.arange(nusers)[mask]
-        usersToEvaluate = list(usersToEvaluate)
 
         recommenders_to_evaluate = list(recommenders.keys())
         n_recs = len(recommenders_to_evaluate)
@@ -420,53 +428,67 @@ class Evaluation(object):
                 self.rec_evals[rec_key]['NDCG'] = list()
                 self.rec_evals[rec_key]['item_pop_bin'] = list()
 
-        for test_user in usersToEvaluate:
-            if (test_user % 10000 == 0):
-                logger.info("Evaluating user {}".format(test_user))
-
-            # Getting user_profile by it's rated items (relevant_items) in the test.
-            relevant_items = self.test_set[test_user].indices
-            relevant_predictions = self.test_set[test_user,relevant_items].toarray()
-            relevant_data = self.test_set[test_user].data
-            i = 0
+        for start in range(0, len(usersToEvaluate), self.block_size):
+            block = usersToEvaluate[start:start + self.block_size]
+            if (start % 10000 < self.block_size):
+                logger.info("Evaluating user {}".format(block[0]))
+
+            # Getting the test ratings of the block, the ratings of the user
+            # block[b] are in test_block[indptr[b]:indptr[b+1]].
+            test_block = self.test_set[block]
+            indptr = test_block.indptr
+            block_users = np.repeat(block, np.ediff1d(indptr))
+
+            # Building the top-N lists and the predicted ratings of the whole
+            # block at once for each recommender.
+            ranked_block = dict()
+            predicted_block = dict()
             for rec_key in recommenders_to_evaluate:
                 rec_to_eval = recommenders[rec_key]
-
-                ranked_items = rec_to_eval.recommend(user_id=test_user,
-                                                     n=at,
-                                                     exclude_seen=True
-                                                    )
-                predicted_relevant_items = rec_to_eval.predict(user_id=test_user,
-                                                               rated_indices=relevant_items
-                                                              )
-
-                # evaluate the recommendation list with RMSE and ranking metrics.
-                is_relevant = np.in1d(ranked_items,
-                                      relevant_items,
-                                      assume_unique=True
-                                     )
+                ranked_block[rec_key] = rec_to_eval.recommend_batch(user_ids=block,
+                                                                    n=at,
+                                                                    exclude_seen=True
+                                                                   )
                 # TopPop only works for ranking metrics.
-                if (rec_key == "TopPop1" or rec_key == "TopPop2"):
-                    rmse_[i] += 0.0
-                else:
-                    rmse_[i] += metrics.rmse(predicted_relevant_items, relevant_predictions)
-                roc_auc_[i] += metrics.roc_auc(is_relevant)
-                precision_[i] += metrics.precision(is_relevant)
-                recall_[i] += metrics.recall(is_relevant, relevant_items)
-                map_[i] += metrics.map(is_relevant, relevant_items)
-                mrr_[i] += metrics.rr(is_relevant)
-                ndcg_[i] += metrics.ndcg(ranked_items, relevant_items, relevance=relevant_data, at=at)
+                if (rec_key != "TopPop1" and rec_key != "TopPop2"):
+                    predicted_block[rec_key] = rec_to_eval.score_pairs(block_users, test_block.indices)
+
+            for b in range(len(block)):
+                # Getting user_profile by it's rated items (relevant_items) in the test.
+                relevant_items = test_block.indices[indptr[b]:indptr[b+1]]
+                relevant_data = test_block.data[indptr[b]:indptr[b+1]]
+                i = 0
+                for rec_key in recommenders_to_evaluate:
+                    ranked_items = ranked_block[rec_key][b]
+
+                    # evaluate the recommendation list with RMSE and ranking metrics.
+                    is_relevant = np.in1d(ranked_items,
+                                          relevant_items,
+                                          assume_unique=True
+                                         )
+                    # TopPop only works for ranking metrics.
+                    if (rec_key == "TopPop1" or rec_key == "TopPop2"):
+                        rmse_[i] += 0.0
+                    else:
+                        predicted_relevant_items = predicted_block[rec_key][indptr[b]:indptr[b+1]]
+                        rmse_[i] += metrics.rmse(predicted_relevant_items, relevant_data)
+                    roc_auc_[i] += metrics.roc_auc(is_relevant)
+                    precision_[i] += metrics.precision(is_relevant)
+                    recall_[i] += metrics.recall(is_relevant, relevant_items)
+                    map_[i] += metrics.map(is_relevant, relevant_items)
+                    mrr_[i] += metrics.rr(is_relevant)
+                    ndcg_[i] += metrics.ndcg(ranked_items, relevant_items, relevance=relevant_data, at=at)
 
-                if (self.eval_bins):
-                    if (not rec_key in pop_bins_by_recommender.keys()):
-                        pop_bins_by_recommender[rec_key] = np.zeros(self.nbins, dtype=np.int32)
+                    if (self.eval_bins):
+                        if (not rec_key in pop_bins_by_recommender.keys()):
+                            pop_bins_by_recommender[rec_key] = np.zeros(self.nbins, dtype=np.int32)
 
-                    pop_bins_by_recommender[rec_key] += self.check_ranked_in_bins(ranked_list=ranked_items,rec_key=rec_key)
+                        pop_bins_by_recommender[rec_key] += self.check_ranked_in_bins(ranked_list=ranked_items,rec_key=rec_key)
 
-                i += 1
+                    i += 1
 
-            # Increase the number of evaluations performed.
-            n_eval += 1
+                # Increase the number of evaluations performed.
+                n_eval += 1
 
         # Recommender evaluation.
         i = 0
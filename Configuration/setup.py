@@ -9,9 +9,14 @@ _directive_defaults['binding'] = True
 
 extensions = [
     Extension(name='implementation._cython._similarity',
-              sources=["implementation/_cython/_similarity.pyx"], define_macros=[('CYTHON_TRACE', '1')]),
+              sources=["implementation/_cython/_similarity.pyx"], define_macros=[('CYTHON_TRACE', '1')],
+              extra_compile_args=['-fopenmp'], extra_link_args=['-fopenmp']),
+    Extension(name='implementation._cython._scoring',
+              sources=["implementation/_cython/_scoring.pyx"], define_macros=[('CYTHON_TRACE', '1')],
+              extra_compile_args=['-fopenmp'], extra_link_args=['-fopenmp']),
     Extension(name='implementation._cython._mf',
-              sources=["implementation/_cython/_mf.pyx"], define_macros=[('CYTHON_TRACE', '1')]),
+              sources=["implementation/_cython/_mf.pyx"], define_macros=[('CYTHON_TRACE', '1')],
+              extra_compile_args=['-fopenmp'], extra_link_args=['-fopenmp']),
 ]
 
 setup(
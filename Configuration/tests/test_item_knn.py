@@ -0,0 +1,112 @@
+import numpy as np
+import scipy.sparse as sps
+
+from implementation.recommenders.item_knn import ItemKNNRecommender
+from implementation.recommenders.user_knn import UserKNNRecommender
+from implementation.recommenders.slim import SLIM
+from implementation.utils import metrics
+
+
+def _sparse_dataset(n_users=600, n_items=400, density=0.005, seed=1234):
+    # a dataset sparse enough that many users reach less than n items
+    # through the top-k weights
+    rng = np.random.RandomState(seed)
+    X = sps.random(n_users, n_items, density=density, format='csr', random_state=rng, dtype=np.float32)
+    X.data = np.ceil(X.data * 5.0)
+    X = X[np.diff(X.indptr) > 0]
+    return sps.csr_matrix(X)
+
+
+def test_recommend_batch_matches_recommend_on_sparse_weights():
+    X = _sparse_dataset()
+    n = 10
+    for normalize in (False, True):
+        recommender = ItemKNNRecommender(k=5, shrinkage=0, normalize=normalize, sparse_weights=True)
+        recommender.fit(X)
+        users = np.arange(X.shape[0])
+        scores = np.asarray(recommender.score_batch(users))
+        batch = recommender.recommend_batch(users, n=n, exclude_seen=True)
+        for user in users:
+            expected = recommender.recommend(user, n=n, exclude_seen=True)
+            ranked = batch[user]
+            # the ties (e.g. the items without any weight) can be ranked in
+            # any order, so the lists are compared through their scores
+            assert len(ranked) == len(expected) == n
+            assert len(np.unique(ranked)) == n
+            assert not np.any(np.in1d(ranked, X[user].indices))
+            np.testing.assert_allclose(scores[user, ranked], scores[user, expected], rtol=1e-5, atol=1e-6)
+
+
+def test_recommend_batch_lists_can_be_evaluated():
+    X = _sparse_dataset()
+    recommender = ItemKNNRecommender(k=5, shrinkage=0, sparse_weights=True)
+    recommender.fit(X)
+    for ranked in recommender.recommend_batch(np.arange(X.shape[0]), n=10):
+        is_relevant = np.zeros(len(ranked), dtype=bool)
+        assert 0.0 <= metrics.precision(is_relevant) <= 1.0
+
+
+def test_user_knn_recommend_batch_matches_recommend():
+    X = _sparse_dataset(n_users=300, n_items=120, density=0.03)
+    n = 10
+    for sparse_weights in (True, False):
+        recommender = UserKNNRecommender(k=20, shrinkage=0, sparse_weights=sparse_weights)
+        recommender.fit(X)
+        users = np.arange(X.shape[0])
+        scores = np.asarray(recommender.score_batch(users))
+        batch = recommender.recommend_batch(users, n=n, exclude_seen=True)
+        for user in users:
+            expected = recommender.recommend(user, n=n, exclude_seen=True)
+            ranked = batch[user]
+            assert len(ranked) == len(expected)
+            assert np.all(ranked < X.shape[1])
+            np.testing.assert_allclose(scores[user, ranked], scores[user, expected], rtol=1e-5, atol=1e-6)
+
+
+def test_slim_recommend_batch_matches_recommend():
+    X = _sparse_dataset(n_users=200, n_items=80, density=0.05)
+    n = 10
+    recommender = SLIM(l1_penalty=0.01, l2_penalty=1.0)
+    recommender.fit(X)
+    assert recommender.W_sparse.nnz > 0
+    users = np.arange(X.shape[0])
+    scores = np.asarray(recommender.score_batch(users))
+    np.testing.assert_allclose(scores, X.dot(recommender.W_sparse).toarray(), rtol=1e-5, atol=1e-6)
+    batch = recommender.recommend_batch(users, n=n, exclude_seen=True)
+    for user in users:
+        expected = recommender.recommend(user, n=n, exclude_seen=True)
+        ranked = batch[user]
+        assert len(ranked) == len(expected) == n
+        assert not np.any(np.in1d(ranked, X[user].indices))
+        np.testing.assert_allclose(scores[user, ranked], scores[user, expected], rtol=1e-5, atol=1e-6)
+        np.testing.assert_array_equal(recommender.recommend_new_user(X[user], n=n), ranked)
+
+
+def _with_new_ratings(X, n_ratings, seed=4321):
+    # a training set with a few ratings added, overwritten or removed, half
+    # of the removed ones among the existing ratings
+    rng = np.random.RandomState(seed)
+    users, items = X.nonzero()
+    rated = rng.randint(0, len(users), n_ratings // 2)
+    X = X.tolil(copy=True)
+    for user, item in zip(users[rated], items[rated]):
+        X[user, item] = 0.0
+    for user, item in zip(rng.randint(0, X.shape[0], n_ratings), rng.randint(0, X.shape[1], n_ratings)):
+        X[user, item] = float(rng.randint(0, 6))
+    X = sps.csr_matrix(X)
+    X.eliminate_zeros()
+    return X
+
+
+def test_incremental_fit_matches_full_fit():
+    for similarity in ('cosine', 'pearson', 'adj-cosine', 'jaccard'):
+        X = _sparse_dataset(n_users=1000, n_items=800, density=0.005)
+        recommender = ItemKNNRecommender(k=10, shrinkage=5, similarity=similarity, incremental=True)
+        recommender.fit(X)
+        # a few new ratings update some of the lists, many of them update all
+        for seed, n_ratings in enumerate((3, 3, 400)):
+            X = _with_new_ratings(X, n_ratings, seed=seed)
+            recommender.fit(X)
+            full = ItemKNNRecommender(k=10, shrinkage=5, similarity=similarity)
+            full.fit(X)
+            np.testing.assert_allclose(recommender.W_sparse.toarray(), full.W_sparse.toarray(), rtol=1e-5, atol=1e-6)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import scipy.sparse as sps
+
+from implementation._cython._mf import BPRSampler
+
+
+def _implicit_dataset(n_users=200, n_items=150, density=0.05, seed=1234):
+    X = sps.random(n_users, n_items, density=density, format='csr', random_state=seed, dtype=np.float32)
+    X.data[:] = 1.0
+    return X
+
+
+@pytest.mark.parametrize('sampling_type,replace', [
+    ('user_uniform_item_uniform', True),
+    ('user_uniform_item_uniform', False),
+    ('user_uniform_item_pop', True),
+])
+def test_bpr_sampler_is_deterministic_and_valid(sampling_type, replace):
+    X = _implicit_dataset()
+    sampler = BPRSampler(X, sampling_type=sampling_type, replace=replace)
+    size = sampler.n_samples
+    first = sampler.sample(size, seed=3)
+    # the same seed gives the same triples, also after other epochs
+    sampler.sample(size, seed=4)
+    np.testing.assert_array_equal(sampler.sample(size, seed=3), first)
+    np.testing.assert_array_equal(BPRSampler(X, sampling_type=sampling_type, replace=replace).sample(size, seed=3),
+                                  first)
+    assert not np.array_equal(sampler.sample(size, seed=4), first)
+
+    users, pos_items, neg_items = first.T
+    assert np.all(np.asarray(X[users, pos_items]).ravel() > 0)
+    assert np.all(np.asarray(X[users, neg_items]).ravel() == 0)
+    if not replace:
+        # every positive pair is drawn exactly once per epoch
+        keys = users * X.shape[1] + pos_items
+        rows, cols = X.nonzero()
+        np.testing.assert_array_equal(np.sort(keys), np.sort(rows.astype(np.int64) * X.shape[1] + cols))
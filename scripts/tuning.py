@@ -34,11 +34,15 @@ from implementation.utils.evaluation import Evaluation
 from implementation.recommenders.item_knn import ItemKNNRecommender
 from implementation.recommenders.user_knn import UserKNNRecommender
 from implementation.recommenders.slim import SLIM, MultiThreadSLIM
-from implementation.recommenders.mf import FunkSVD, IALS_numpy, AsySVD, BPRMF
+from implementation.recommenders.mf import FunkSVD, IALS_numpy, AsySVD, BPRMF, BPRMF_numpy
 from implementation.recommenders.non_personalized import Random, TopPop, GlobalEffects
 from implementation.recommenders.content import ContentBasedRecommender
 from implementation.recommenders.cotraining import CoTraining
-from implementation.recommenders.bpr import BPRMF_THEANO
+try:
+    # Theano is optional, BPRMF_numpy is its drop-in replacement
+    from implementation.recommenders.bpr import BPRMF_THEANO
+except ImportError:
+    BPRMF_THEANO = None
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -57,8 +61,11 @@ available_recommenders = OrderedDict([
     ('AsySVD', AsySVD),
     ('IALS_np', IALS_numpy),
     ('BPRMF', BPRMF),
-    ('BPRMF_THEANO', BPRMF_THEANO)
+    ('BPRMF_THEANO', BPRMF_THEANO),
+    ('BPRMF_np', BPRMF_numpy)
 ])
+if BPRMF_THEANO is None:
+    del available_recommenders['BPRMF_THEANO']
 
 # let's use an ArgumentParser to read input arguments
 parser = argparse.ArgumentParser()